@@ -3,21 +3,76 @@ import math
 import random
 import numpy as np
 import asyncio
+import contextlib
+import copyreg
+import csv
+import heapq
+import json
+import os
 import platform
-from collections import deque
+import struct
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
 from dataclasses import dataclass
-from typing import List, Tuple
+from types import MappingProxyType
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+# Startup is measured from here; see startup_times.
+IMPORT_START = time.perf_counter()
 
 # Constants
 SCREEN_WIDTH = 800
 SCREEN_HEIGHT = 600
 FPS = 60
+# The simulation advances in fixed ticks of 1 / TICK_RATE seconds; every speed,
+# timer and cooldown in the game is expressed per tick. Rendering runs at up to
+# FPS frames per second and interpolates between the last two ticks.
+TICK_RATE = 60
+MAX_CATCHUP_STEPS = 5
 TILE_SIZE = 32
 MAP_WIDTH = 50
 MAP_HEIGHT = 50
+MAP_CHUNK_TILES = 16
+MAP_CHUNK_CACHE = 256  # decoded tile chunks kept in memory
+MAP_SURFACE_CACHE = 16  # baked chunk surfaces kept for drawing
+ACTIVE_CHUNKS = 5  # side of the simulated window around the player, in chunks
+MAP_WALL_DENSITY = 0.48  # share of walls in the noise the caves are grown from
+MAP_SMOOTHING_STEPS = 4  # cellular-automaton passes, at most MAP_CHUNK_TILES
 MAX_ENEMIES = 8
+ENEMY_CAPACITY = 64
+MAX_PATH_SEARCHES_PER_TICK = 4
+PATH_CACHE_SIZE = 256
+PATHFINDING_MODE = 'flow_field'  # or 'a_star' for per-enemy searches
 PARTICLE_LIFETIME = 20
+TEXT_CACHE_SIZE = 256
+CULL_MARGIN = 40  # pixels past the screen edge still drawn; covers the boss and its health bar
+DIRTY_RECT_LIMIT = 256  # changed areas over the last two frames past which a frame is flipped whole
+ASSET_WARM_BUDGET = 0.004  # seconds per title-screen frame spent building assets
+SOUND_SEED = 7
+SOUND_CACHE_VERSION = 1
+SOUND_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sound_cache.npz')
+AUDIO_CHANNELS = 8
+SOUND_PITCHES = (0.94, 1.0, 1.06)
+SOUND_VOLUMES = (0.75, 1.0)
+# name: (minimum seconds between two plays, maximum simultaneous voices)
+SOUND_LIMITS = {'explosion': (0.04, 3), 'shot': (0.03, 2), 'pickup': (0.0, 2)}
+PROFILE_WINDOW = 300  # frames kept for the rolling p50/p99
+PROFILE_OVERLAY_REFRESH = 30  # frames between overlay redraws
+PROFILE_EXPORT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profile_trace.json')
+REPLAY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'last_replay.sgr')
+LOOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'loot.json')  # optional LOOT_TABLES override
+HISTORY_SECONDS = 180  # rewind history kept in memory
+SNAPSHOT_INTERVAL = 30  # ticks between history snapshots
+KEYFRAME_INTERVAL = 20  # history snapshots per keyframe, the others are deltas against it
+REWIND_SECONDS = 5
+MAX_PARTICLES = 2048
 CHEST_SPAWN_RATE = 0.002
+SPAWN_ATTEMPTS = 200  # random tiles tried per spawn before taking the farthest open one
+CHEST_ITEMS = (1, 3)  # fewest and most items in a chest
+LOOT_MAX_LEVEL = 20  # loot weight curves stay flat past this player level
+BULLET_CAPACITY = 1024
 
 # Colors
 WHITE = (255, 255, 255)
@@ -32,75 +87,771 @@ PURPLE = (128, 0, 128)
 ORANGE = (255, 165, 0)
 CYAN = (0, 255, 255)
 
-# Initialize Pygame
-pygame.init()
-screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
-pygame.display.set_caption("Space Survivor")
-clock = pygame.time.Clock()
-font = pygame.font.SysFont('arial', 20)
-title_font = pygame.font.SysFont('arial', 40)
-
-# Sprites
-player_sprite = pygame.Surface((20, 20))
-player_sprite.fill(GREEN)
-enemy_drone_sprite = pygame.Surface((30, 30))
-enemy_drone_sprite.fill(RED)
-enemy_tank_sprite = pygame.Surface((30, 30))
-enemy_tank_sprite.fill(YELLOW)
-boss_sprite = pygame.Surface((50, 50))
-boss_sprite.fill(CYAN)
-item_sprite = pygame.Surface((10, 10))
-item_sprite.fill(BLUE)
-chest_sprite = pygame.Surface((20, 20))
-chest_sprite.fill(PURPLE)
-health_sprite = pygame.Surface((10, 10))
-health_sprite.fill(ORANGE)
+# The display is opened by init_display(); fonts, sprites and sounds are built
+# on first use through assets so that World can be imported and stepped
+# without a display or audio device.
+screen = None
+startup_times = {}
 
-@dataclass
-class Particle:
-    pos: Tuple[float, float]
-    vel: Tuple[float, float]
-    color: Tuple[int, int, int]
-    lifetime: int
-    size: float
+class Assets:
+    # Named resources built by their loader the first time they are requested.
+    # warm() builds the remaining ones a few at a time, e.g. behind the title screen.
+    def __init__(self):
+        self.loaders: Dict[str, Callable] = {}
+        self.cache = {}
+
+    def register(self, name: str, loader: Callable):
+        self.loaders[name] = loader
+
+    def __getitem__(self, name: str):
+        if name not in self.cache:
+            self.cache[name] = self.loaders[name]()
+        return self.cache[name]
+
+    def warm(self, budget: float) -> bool:
+        deadline = time.perf_counter() + budget
+        for name in self.loaders:
+            if name not in self.cache:
+                if time.perf_counter() >= deadline:
+                    return False
+                self[name]
+        return True
+
+assets = Assets()
+
+class RenderBackend:
+    # Puts surfaces into the display's pixel format and presents frames.
+    # present() takes a key for what the frame shows (the screen, camera
+    # offset, map and so on) and the areas drawn to that change from frame to
+    # frame. While the key stays the same, only those areas, this frame's and
+    # the last one's, are pushed with display.update; otherwise, or past
+    # DIRTY_RECT_LIMIT areas, the whole screen is flipped.
+    def __init__(self):
+        self._scene = None
+        self._rects = []
+
+    def convert(self, surface: pygame.Surface) -> pygame.Surface:
+        # Without a display mode (headless runs) there is nothing to match.
+        if pygame.display.get_surface() is None:
+            return surface
+        return surface.convert_alpha() if surface.get_flags() & pygame.SRCALPHA else surface.convert()
+
+    def present(self, scene: tuple, rects: List[pygame.Rect]):
+        if scene == self._scene and len(rects) + len(self._rects) <= DIRTY_RECT_LIMIT:
+            pygame.display.update(self._rects + rects)
+            profiler.set('dirty_rects', len(rects) + len(self._rects))
+        else:
+            pygame.display.flip()
+        self._scene, self._rects = scene, rects
+
+render_backend = RenderBackend()
+
+def make_sprite(size: Tuple[int, int], color: Tuple[int, int, int]) -> pygame.Surface:
+    sprite = pygame.Surface(size)
+    sprite.fill(color)
+    return render_backend.convert(sprite)
+
+def make_dot(radius: int, color: Tuple[int, int, int]) -> pygame.Surface:
+    sprite = pygame.Surface((radius * 2, radius * 2))
+    sprite.set_colorkey(BLACK)
+    pygame.draw.circle(sprite, color, (radius, radius), radius)
+    return render_backend.convert(sprite)
+
+def blit_batch(surface: pygame.Surface, batch: list, dirty: Optional[List[pygame.Rect]]):
+    # Surface.blits, adding the areas drawn to dirty when one is given.
+    if dirty is None:
+        surface.blits(batch, doreturn=False)
+    else:
+        dirty.extend(surface.blits(batch))
+
+# Fonts and sprites
+assets.register('font', lambda: pygame.font.SysFont('arial', 20))
+assets.register('title_font', lambda: pygame.font.SysFont('arial', 40))
+assets.register('player', lambda: make_sprite((20, 20), GREEN))
+assets.register('drone', lambda: make_sprite((30, 30), RED))
+assets.register('tank', lambda: make_sprite((30, 30), YELLOW))
+assets.register('boss', lambda: make_sprite((50, 50), CYAN))
+assets.register('item', lambda: make_sprite((10, 10), BLUE))
+assets.register('chest', lambda: make_sprite((20, 20), PURPLE))
+assets.register('health', lambda: make_sprite((10, 10), ORANGE))
+assets.register('bullet', lambda: make_dot(3, WHITE))
+# Health bars are blitted cropped to the bar and fill widths.
+assets.register('bar_back', lambda: make_sprite((64, 5), RED))
+assets.register('bar_fill', lambda: make_sprite((64, 5), GREEN))
+assets.register('small_font', lambda: pygame.font.SysFont('arial', 14))
+
+class ProfileSection:
+    __slots__ = ('times', 'name', 'start')
+
+    def __init__(self, times: dict, name: str):
+        self.times = times
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.times[self.name] = self.times.get(self.name, 0.0) + time.perf_counter() - self.start
+
+NULL_SECTION = contextlib.nullcontext()
+
+class Profiler:
+    # Named scoped timers and counters, collected per frame into a rolling
+    # window. Sections include the time of sections nested inside them. While
+    # disabled, section() hands back a shared no-op and the rest return at once.
+    def __init__(self, window: int = PROFILE_WINDOW):
+        self.enabled = False
+        self.frames = deque(maxlen=window)
+        self.times = {}
+        self.counters = {}
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.frames.clear()
+        self.times = {}
+        self.counters = {}
+
+    def section(self, name: str):
+        if not self.enabled:
+            return NULL_SECTION
+        return ProfileSection(self.times, name)
+
+    def add(self, name: str, seconds: float):
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name: str, value: int):
+        if self.enabled:
+            self.counters[name] = value
+
+    def end_frame(self):
+        if self.enabled:
+            self.frames.append((self.times, self.counters))
+            self.times = {}
+            self.counters = {}
+
+    def summary(self) -> List[Tuple[str, float, float]]:
+        # (section, p50 ms, p99 ms) over the window; 'frame' first, then slowest first.
+        names = {name for times, _ in self.frames for name in times}
+        rows = []
+        for name in names:
+            values = np.array([times.get(name, 0.0) for times, _ in self.frames]) * 1000
+            rows.append((name, float(np.percentile(values, 50)), float(np.percentile(values, 99))))
+        rows.sort(key=lambda row: (row[0] != 'frame', -row[1]))
+        return rows
+
+    def export(self, path: str):
+        # CSV for a .csv path (one row per frame), JSON otherwise.
+        names = sorted({name for times, _ in self.frames for name in times})
+        counters = sorted({name for _, counts in self.frames for name in counts})
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['frame'] + [name + '_ms' for name in names] + counters)
+                for i, (times, counts) in enumerate(self.frames):
+                    writer.writerow([i] + [round(times.get(name, 0.0) * 1000, 4) for name in names] + [counts.get(name, 0) for name in counters])
+        else:
+            with open(path, 'w') as f:
+                json.dump([{'times_ms': {name: round(value * 1000, 4) for name, value in times.items()}, 'counters': counts}
+                           for times, counts in self.frames], f)
+
+profiler = Profiler()
 
 @dataclass
-class Bullet:
-    pos: Tuple[float, float]
-    vel: Tuple[float, float]
+class Inputs:
+    # One tick of player input. aim is in world coordinates; the one-shot
+    # actions are set only on the tick their key was pressed.
+    up: bool = False
+    down: bool = False
+    left: bool = False
+    right: bool = False
+    fire: bool = False
+    aim: Tuple[float, float] = (0.0, 0.0)
+    pickup: bool = False
+    open_chest: bool = False
+    select_weapon: int = -1
+    cycle_weapon: int = 0
+    choose_upgrade: int = -1
+    restart: bool = False
+
+class Weapon(NamedTuple):
+    # Shared by every item and inventory slot of the weapon. A NamedTuple
+    # rather than dataclass(slots=True), which needs Python 3.10: immutable,
+    # no per-instance __dict__, and it copies and pickles.
+    name: str
     damage: int
-    owner: str
-    spread: float = 0.0
+    fire_rate: int
+    speed: float
+    spread: float
+    bullet_count: int = 1
+    ammo: int = -1  # -1 for unlimited
+    max_ammo: int = -1
 
-@dataclass
-class Item:
+class ItemType(NamedTuple):
+    # What all items of a kind share, defined once in ITEM_TYPES. stats is the
+    # Weapon of a weapon and a read-only mapping for temp_health (duration)
+    # and ammo (weapon, max_ammo), None otherwise. A NamedTuple like Weapon.
     name: str
     type: str
-    value: int
-    pos: Tuple[float, float]
-    stats: dict = None
+    value: int = 0
+    stats: object = None
+
+class Item:
+    # A dropped, carried or chest-held item: only its prototype and position.
+    __slots__ = ('prototype', 'pos')
+
+    def __init__(self, prototype: ItemType, pos: Tuple[float, float]):
+        self.prototype = prototype
+        self.pos = pos
+
+    @property
+    def name(self) -> str:
+        return self.prototype.name
+
+    @property
+    def type(self) -> str:
+        return self.prototype.type
+
+    @property
+    def value(self) -> int:
+        return self.prototype.value
+
+    @property
+    def stats(self):
+        return self.prototype.stats
 
 @dataclass
 class Chest:
     pos: Tuple[float, float]
     contents: List[Item]
 
-@dataclass
-class Weapon:
-    name: str
-    damage: int
-    fire_rate: int
-    speed: float
-    spread: float
-    bullet_count: int = 1
-    ammo: int = -1
-    max_ammo: int = -1
+def read_only(stats: dict) -> MappingProxyType:
+    return MappingProxyType(stats)
+
+# mappingproxy cannot be pickled or copied by default; this makes the
+# prototypes that hold one behave like the rest.
+copyreg.pickle(MappingProxyType, lambda stats: (read_only, (dict(stats),)))
+
+def ammo_type(name: str, value: int, weapon: str, max_ammo: int) -> ItemType:
+    return ItemType(name, 'ammo', value, read_only({"weapon": weapon, "max_ammo": max_ammo}))
+
+ITEM_TYPES = (
+    ItemType('Pistol', 'weapon', 0, Weapon('Pistol', 10, 10, 10, 0.0, 1, -1, -1)),
+    ItemType('Shotgun', 'weapon', 0, Weapon('Shotgun', 30, 20, 8, 0.2, 5, 50, 100)),
+    ItemType('Sniper', 'weapon', 0, Weapon('Sniper', 50, 30, 12, 0.0, 1, 20, 50)),
+    ItemType('Laser', 'weapon', 0, Weapon('Laser', 15, 5, 15, 0.0, 1, 100, 150)),
+    ItemType('Grenade Launcher', 'weapon', 0, Weapon('Grenade Launcher', 80, 60, 6, 0.3, 1, 10, 20)),
+    ItemType('Flamethrower', 'weapon', 0, Weapon('Flamethrower', 5, 3, 10, 0.4, 3, 150, 200)),
+    ItemType('Plasma Rifle', 'weapon', 0, Weapon('Plasma Rifle', 25, 15, 10, 0.1, 2, 40, 80)),
+    ItemType('Rocket Launcher', 'weapon', 0, Weapon('Rocket Launcher', 100, 90, 5, 0.4, 1, 8, 15)),
+    ItemType('Freeze Shotgun', 'weapon', 0, Weapon('Freeze Shotgun', 20, 25, 7, 0.25, 6, 30, 60)),
+    ItemType('Health Pack', 'health', 50),
+    ItemType('Temp Health Boost', 'temp_health', 50, read_only({"duration": 600})),
+    ItemType('Armor', 'armor', 5),
+    ItemType('Resource', 'resource', 2),
+    ammo_type('Shotgun Ammo', 20, 'Shotgun', 100),
+    ammo_type('Sniper Ammo', 10, 'Sniper', 50),
+    ammo_type('Laser Ammo', 30, 'Laser', 150),
+    ammo_type('Grenade Ammo', 5, 'Grenade Launcher', 20),
+    ammo_type('Flamethrower Ammo', 50, 'Flamethrower', 200),
+    ammo_type('Plasma Ammo', 15, 'Plasma Rifle', 80),
+    ammo_type('Rocket Ammo', 5, 'Rocket Launcher', 15),
+    ammo_type('Freeze Ammo', 10, 'Freeze Shotgun', 60),
+)
+ITEM_CODES = {item_type.name: code for code, item_type in enumerate(ITEM_TYPES)}
+PISTOL = ITEM_TYPES[ITEM_CODES['Pistol']]
+
+def shared_item_type(prototype: ItemType) -> ItemType:
+    # The equal ITEM_TYPES entry if there is one, so that rebuilt items share it.
+    code = ITEM_CODES.get(prototype.name)
+    return ITEM_TYPES[code] if code is not None and ITEM_TYPES[code] == prototype else prototype
+
+def shared_weapon(weapon: Weapon) -> Weapon:
+    return shared_item_type(ItemType(weapon.name, 'weapon', 0, weapon)).stats
+
+@dataclass(frozen=True)
+class LootEntry:
+    item: str  # an ITEM_TYPES name
+    weight: float
+    per_level: float = 0.0  # added to weight for every player level past the first
+
+class LootTable:
+    # Weighted draws from ITEM_TYPES. Weights follow each entry's per-level
+    # curve up to LOOT_MAX_LEVEL and never go below 0. Each level gets an
+    # alias table (Vose's method) on first use, so a draw is one rng.random()
+    # and two lookups whatever the table size.
+    def __init__(self, entries: Tuple[LootEntry, ...]):
+        unknown = [entry.item for entry in entries if entry.item not in ITEM_CODES]
+        if unknown:
+            raise ValueError('unknown items: ' + ', '.join(unknown))
+        self.entries = entries
+        self.items = [ITEM_TYPES[ITEM_CODES[entry.item]] for entry in entries]
+        self._alias: Dict[int, Tuple[List[float], List[int]]] = {}
+        for level in range(1, LOOT_MAX_LEVEL + 1):
+            if sum(self.weights(level)) <= 0:
+                raise ValueError(f'no item has a positive weight at level {level}')
+
+    def weights(self, level: int) -> List[float]:
+        level = min(max(level, 1), LOOT_MAX_LEVEL)
+        return [max(entry.weight + entry.per_level * (level - 1), 0.0) for entry in self.entries]
+
+    def _table(self, level: int) -> Tuple[List[float], List[int]]:
+        level = min(max(level, 1), LOOT_MAX_LEVEL)
+        table = self._alias.get(level)
+        if table is None:
+            weights = self.weights(level)
+            n = len(weights)
+            total = sum(weights)
+            scaled = [weight * n / total for weight in weights]
+            prob, alias = [1.0] * n, list(range(n))
+            small = [i for i, p in enumerate(scaled) if p < 1.0]
+            large = [i for i, p in enumerate(scaled) if p >= 1.0]
+            while small and large:
+                less, more = small.pop(), large.pop()
+                prob[less], alias[less] = scaled[less], more
+                scaled[more] += scaled[less] - 1.0
+                (small if scaled[more] < 1.0 else large).append(more)
+            table = self._alias[level] = (prob, alias)
+        return table
+
+    def _draw_index(self, rng: random.Random, table: Tuple[List[float], List[int]]) -> int:
+        prob, alias = table
+        u = rng.random() * len(prob)
+        i = int(u)
+        return i if u - i < prob[i] else alias[i]
+
+    def draw(self, rng: random.Random, level: int) -> ItemType:
+        return self.items[self._draw_index(rng, self._table(level))]
+
+    def sample(self, rng: random.Random, level: int, k: int) -> List[ItemType]:
+        # k different items, or all that can be drawn at this level if fewer;
+        # repeats are drawn again.
+        table = self._table(level)
+        k = min(k, sum(1 for weight in self.weights(level) if weight > 0))
+        picked = []
+        while len(picked) < k:
+            i = self._draw_index(rng, table)
+            if i not in picked:
+                picked.append(i)
+        return [self.items[i] for i in picked]
+
+# Level 1 weights match the old uniform picks. Later on, drops lean towards
+# health and away from resources, and chests towards the heavier weapons.
+LOOT_TABLES = {
+    'drop': LootTable((
+        LootEntry('Health Pack', 1.0, 0.1), LootEntry('Temp Health Boost', 1.0, 0.05), LootEntry('Armor', 1.0, 0.05),
+        LootEntry('Resource', 1.0, -0.05), LootEntry('Shotgun Ammo', 1.0), LootEntry('Sniper Ammo', 1.0),
+        LootEntry('Laser Ammo', 1.0), LootEntry('Grenade Ammo', 1.0), LootEntry('Flamethrower Ammo', 1.0),
+        LootEntry('Plasma Ammo', 1.0), LootEntry('Rocket Ammo', 1.0), LootEntry('Freeze Ammo', 1.0),
+    )),
+    'chest': LootTable((
+        LootEntry('Health Pack', 1.0), LootEntry('Temp Health Boost', 1.0), LootEntry('Armor', 1.0),
+        LootEntry('Shotgun', 1.0, -0.03), LootEntry('Sniper', 1.0), LootEntry('Laser', 1.0),
+        LootEntry('Grenade Launcher', 1.0), LootEntry('Flamethrower', 1.0), LootEntry('Plasma Rifle', 1.0, 0.05),
+        LootEntry('Rocket Launcher', 1.0, 0.05), LootEntry('Freeze Shotgun', 1.0, 0.05),
+    )),
+}
+
+def load_loot_tables(path: str) -> Dict[str, LootTable]:
+    # LOOT_TABLES with the tables in the JSON file at path swapped in, e.g.
+    # {"drop": [{"item": "Health Pack", "weight": 2, "per_level": 0.1}, ...]}.
+    with open(path) as f:
+        data = json.load(f)
+    tables = dict(LOOT_TABLES)
+    for name, entries in data.items():
+        if name not in tables:
+            raise ValueError(f'unknown loot table {name!r}')
+        tables[name] = LootTable(tuple(LootEntry(entry['item'], float(entry['weight']), float(entry.get('per_level', 0)))
+                                       for entry in entries))
+    return tables
+
+try:
+    LOOT_TABLES = load_loot_tables(LOOT_FILE)
+except OSError:
+    pass
+except (ValueError, KeyError, TypeError) as error:
+    print(f"Loot: ignoring {LOOT_FILE}: {error}")
+
+class TileCollider:
+    # Dense copy of the tiles in the active window, ACTIVE_CHUNKS chunks square
+    # around the player (the whole map when that is smaller). Collision,
+    # pathfinding, flow fields and the minimap all read this window, so their
+    # cost follows the window and not the map size. follow() re-cuts it from
+    # the map when the player enters another chunk; version changes whenever
+    # its position or contents do. Answers wall-overlap queries by looking
+    # only at the tiles a box covers.
+    def __init__(self, game_map: 'Map'):
+        self.map = game_map
+        self.width = min(game_map.width, ACTIVE_CHUNKS * MAP_CHUNK_TILES)
+        self.height = min(game_map.height, ACTIVE_CHUNKS * MAP_CHUNK_TILES)
+        self.solid = np.zeros((self.height, self.width), dtype=bool)
+        self.x0, self.y0 = self._origin((game_map.width * TILE_SIZE / 2, game_map.height * TILE_SIZE / 2))
+        self.version = 0
+
+    def _origin(self, pos: Tuple[float, float]) -> Tuple[int, int]:
+        # Chunk-aligned window with pos's chunk in the middle, kept on the map.
+        half = ACTIVE_CHUNKS // 2 * MAP_CHUNK_TILES
+        x0 = int(pos[0] // TILE_SIZE) // MAP_CHUNK_TILES * MAP_CHUNK_TILES - half
+        y0 = int(pos[1] // TILE_SIZE) // MAP_CHUNK_TILES * MAP_CHUNK_TILES - half
+        return (min(max(x0, 0), self.map.width - self.width), min(max(y0, 0), self.map.height - self.height))
+
+    def follow(self, pos: Tuple[float, float]):
+        origin = self._origin(pos)
+        if origin != (self.x0, self.y0):
+            self.x0, self.y0 = origin
+            self.refresh()
+
+    def refresh(self):
+        self.solid[:, :] = self.map.region(self.x0, self.y0, self.x0 + self.width, self.y0 + self.height) == 1
+        self.version += 1
+
+    def set_tile(self, x: int, y: int, value: int):
+        if 0 <= x - self.x0 < self.width and 0 <= y - self.y0 < self.height:
+            self.solid[y - self.y0, x - self.x0] = value == 1
+            self.version += 1
+
+    def collides(self, rect: pygame.Rect) -> bool:
+        # Same overlap rule as Rect.colliderect: touching edges do not count.
+        # Off the map counts as free; off the window the map is asked directly.
+        x0 = max(rect.left // TILE_SIZE, 0)
+        y0 = max(rect.top // TILE_SIZE, 0)
+        x1 = min((rect.right - 1) // TILE_SIZE, self.map.width - 1)
+        y1 = min((rect.bottom - 1) // TILE_SIZE, self.map.height - 1)
+        if x0 > x1 or y0 > y1:
+            return False
+        if self.x0 <= x0 and x1 < self.x0 + self.width and self.y0 <= y0 and y1 < self.y0 + self.height:
+            return bool(self.solid[y0 - self.y0:y1 + 1 - self.y0, x0 - self.x0:x1 + 1 - self.x0].any())
+        return bool(self.map.region(x0, y0, x1 + 1, y1 + 1).any())
+
+    def collides_many(self, boxes) -> np.ndarray:
+        # boxes: (N, 4) array-like of (left, top, width, height), or a list of
+        # Rects. Only the window is checked; tiles outside it count as free.
+        boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+        hits = np.zeros(len(boxes), dtype=bool)
+        if len(boxes) == 0:
+            return hits
+        left, top = boxes[:, 0], boxes[:, 1]
+        x0 = left // TILE_SIZE - self.x0
+        y0 = top // TILE_SIZE - self.y0
+        x1 = (left + boxes[:, 2] - 1) // TILE_SIZE - self.x0
+        y1 = (top + boxes[:, 3] - 1) // TILE_SIZE - self.y0
+        span_x = int((x1 - x0).max())
+        span_y = int((y1 - y0).max())
+        for dy in range(span_y + 1):
+            ty = y0 + dy
+            row_ok = (ty <= y1) & (ty >= 0) & (ty < self.height)
+            ty = np.minimum(np.maximum(ty, 0), self.height - 1)
+            for dx in range(span_x + 1):
+                tx = x0 + dx
+                ok = row_ok & (tx <= x1) & (tx >= 0) & (tx < self.width)
+                tx = np.minimum(np.maximum(tx, 0), self.width - 1)
+                hits |= ok & self.solid[ty, tx]
+        return hits
+
+# Bullet owner codes stored in BulletPool.owner
+OWNER_PLAYER = 0
+OWNER_ENEMY = 1
+OWNER_BOSS = 2
+
+ROW_COUNT = struct.Struct('<I')
+
+def pack_rows(columns: List[np.ndarray], n: int) -> bytes:
+    # The first n rows of each column back to back, behind the row count.
+    return ROW_COUNT.pack(n) + b''.join(column[:n].tobytes() for column in columns)
+
+def unpack_rows(data: bytes, columns: List[np.ndarray], offset: int = 0) -> Tuple[List[np.ndarray], int]:
+    # Reads pack_rows output at offset back as read-only arrays; columns only
+    # give the dtypes and row shapes. Also returns the offset past the rows.
+    n, = ROW_COUNT.unpack_from(data, offset)
+    offset += ROW_COUNT.size
+    rows = []
+    for column in columns:
+        shape = (n,) + column.shape[1:]
+        size = math.prod(shape)
+        rows.append(np.frombuffer(data, column.dtype, size, offset).reshape(shape))
+        offset += size * column.itemsize
+    return rows, offset
+
+def pack_paths(paths: List[List[Tuple[int, int]]]) -> bytes:
+    # Tile paths as their lengths followed by all of their tiles.
+    lengths = np.array([len(path) for path in paths], dtype=np.int32)
+    tiles = np.array([tile for path in paths for tile in path], dtype=np.int32).reshape(-1, 2)
+    return pack_rows([lengths], len(paths)) + pack_rows([tiles], len(tiles))
+
+def unpack_paths(data: bytes, offset: int = 0) -> Tuple[List[List[Tuple[int, int]]], int]:
+    (lengths,), offset = unpack_rows(data, [np.zeros(0, dtype=np.int32)], offset)
+    (tiles,), offset = unpack_rows(data, [np.zeros((0, 2), dtype=np.int32)], offset)
+    tiles = [tuple(tile) for tile in tiles.tolist()]
+    paths, start = [], 0
+    for length in lengths.tolist():
+        paths.append(tiles[start:start + length])
+        start += length
+    return paths, offset
+
+class BulletPool:
+    # Structure-of-arrays bullet storage. Live bullets occupy [0, count);
+    # dead slots are filled from the tail in compact(). Every bullet gets an
+    # id from a running counter, and player bullets remember the id of the
+    # player who fired them in shooter (-1 for enemy bullets).
+    _columns = (('pos', np.float64, 2), ('vel', np.float64, 2), ('damage', np.int32, 1), ('owner', np.uint8, 1),
+                ('shooter', np.int32, 1), ('id', np.uint32, 1), ('alive', bool, 1))
+
+    def __init__(self, capacity: int = BULLET_CAPACITY):
+        self.count = 0
+        self.next_id = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        for name, dtype, width in self._columns:
+            setattr(self, name, np.zeros((capacity, width) if width > 1 else capacity, dtype=dtype))
+
+    def _grow(self):
+        old = [getattr(self, name) for name, _, _ in self._columns]
+        self._allocate(len(self.alive) * 2)
+        for (name, _, _), old_arr in zip(self._columns, old):
+            getattr(self, name)[:self.count] = old_arr[:self.count]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def clear(self):
+        self.alive[:self.count] = False
+        self.count = 0
+
+    def spawn(self, x: float, y: float, vx: float, vy: float, damage: int, owner: int, shooter: int = -1):
+        if self.count == len(self.alive):
+            self._grow()
+        i = self.count
+        self.pos[i] = (x, y)
+        self.vel[i] = (vx, vy)
+        self.damage[i] = damage
+        self.owner[i] = owner
+        self.shooter[i] = shooter
+        self.id[i] = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.alive[i] = True
+        self.count += 1
+
+    def spawn_many(self, pos: np.ndarray, vel: np.ndarray, damage: np.ndarray, owner: int):
+        k = len(pos)
+        while self.count + k > len(self.alive):
+            self._grow()
+        live = slice(self.count, self.count + k)
+        self.pos[live] = pos
+        self.vel[live] = vel
+        self.damage[live] = damage
+        self.owner[live] = owner
+        self.shooter[live] = -1
+        self.id[live] = (self.next_id + np.arange(k)) & 0xFFFFFFFF
+        self.next_id = (self.next_id + k) & 0xFFFFFFFF
+        self.alive[live] = True
+        self.count += k
+
+    def boxes(self, half: int = 5) -> np.ndarray:
+        # (count, 4) int boxes matching Rect(x - half, y - half, 2 * half, 2 * half)
+        boxes = np.empty((self.count, 4), dtype=np.int64)
+        boxes[:, :2] = np.floor(self.pos[:self.count] - half)
+        boxes[:, 2:] = 2 * half
+        return boxes
+
+    def step(self, collider: TileCollider) -> np.ndarray:
+        # Moves every bullet, kills those that hit a wall or leave the active
+        # window and returns the positions of the wall hits.
+        n = self.count
+        self.pos[:n] += self.vel[:n]
+        hit_wall = collider.collides_many(self.boxes())
+        pos = self.pos[:n]
+        left, top = (collider.x0 - 1) * TILE_SIZE, (collider.y0 - 1) * TILE_SIZE
+        right, bottom = (collider.x0 + collider.width + 1) * TILE_SIZE, (collider.y0 + collider.height + 1) * TILE_SIZE
+        outside = (pos[:, 0] < left) | (pos[:, 1] < top) | (pos[:, 0] > right) | (pos[:, 1] > bottom)
+        self.alive[:n] &= ~(hit_wall | outside)
+        return pos[hit_wall].copy()
+
+    def overlapping(self, rect: pygame.Rect, owner: int, half: int = 5) -> np.ndarray:
+        # Indices of live bullets of the given owner whose box overlaps rect.
+        n = self.count
+        left = np.floor(self.pos[:n, 0] - half)
+        top = np.floor(self.pos[:n, 1] - half)
+        mask = (self.alive[:n] & (self.owner[:n] == owner) &
+                (left < rect.right) & (rect.left < left + 2 * half) &
+                (top < rect.bottom) & (rect.top < top + 2 * half))
+        return np.flatnonzero(mask)
+
+    def compact(self):
+        n = self.count
+        m = int(self.alive[:n].sum())
+        holes = np.flatnonzero(~self.alive[:m])
+        tail = np.flatnonzero(self.alive[m:n]) + m
+        for name, _, _ in self._columns[:-1]:
+            arr = getattr(self, name)
+            arr[holes] = arr[tail]
+        self.alive[holes] = True
+        self.alive[m:n] = False
+        self.count = m
+
+    def pack(self) -> bytes:
+        # Live bullets only; call between ticks, when the pool is compacted.
+        return ROW_COUNT.pack(self.next_id) + pack_rows([getattr(self, name) for name, _, _ in self._columns[:-1]], self.count)
+
+    def unpack(self, data: bytes):
+        rows, _ = unpack_rows(data, [getattr(self, name) for name, _, _ in self._columns[:-1]], ROW_COUNT.size)
+        n = len(rows[0])
+        self.clear()
+        while n > len(self.alive):
+            self._grow()
+        for (name, _, _), values in zip(self._columns, rows):
+            getattr(self, name)[:n] = values
+        self.alive[:n] = True
+        self.count = n
+        self.next_id, = ROW_COUNT.unpack_from(data)
+
+class ParticleEmitter:
+    # Fixed-capacity ring buffer. Every particle lives PARTICLE_LIFETIME ticks,
+    # so the slot at the write head is always the oldest one and is simply
+    # overwritten once the buffer is full.
+    colors = (RED, YELLOW, WHITE)
+
+    def __init__(self, capacity: int = MAX_PARTICLES):
+        self.capacity = capacity
+        self.pos = np.zeros((capacity, 2), dtype=np.float64)
+        self.vel = np.zeros((capacity, 2), dtype=np.float64)
+        self.lifetime = np.zeros(capacity, dtype=np.int32)
+        self.size = np.zeros(capacity, dtype=np.float64)
+        self.color = np.zeros(capacity, dtype=np.uint8)
+        self.head = 0
+        self._sprites = {}
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.lifetime > 0))
+
+    def clear(self):
+        self.lifetime[:] = 0
+        self.head = 0
+
+    def emit(self, pos: Tuple[float, float], count: int, rng: np.random.Generator):
+        count = min(count, self.capacity)
+        idx = (self.head + np.arange(count)) % self.capacity
+        self.head = (self.head + count) % self.capacity
+        angle = rng.random(count) * 2 * math.pi
+        speed = rng.random(count) * 4
+        self.pos[idx] = pos
+        self.vel[idx, 0] = np.cos(angle) * speed
+        self.vel[idx, 1] = np.sin(angle) * speed
+        self.color[idx] = rng.integers(0, len(self.colors), count)
+        self.size[idx] = rng.uniform(2, 4, count)
+        self.lifetime[idx] = PARTICLE_LIFETIME
+
+    def update(self):
+        alive = self.lifetime > 0
+        self.pos[alive] += self.vel[alive]
+        self.size[alive] *= 0.95
+        self.lifetime[alive] -= 1
+
+    def pack(self) -> bytes:
+        # The write head plus the slots still alive.
+        live = np.flatnonzero(self.lifetime > 0).astype(np.int32)
+        columns = [live] + [column[live] for column in (self.pos, self.vel, self.lifetime, self.size, self.color)]
+        return ROW_COUNT.pack(self.head) + pack_rows(columns, len(live))
+
+    def unpack(self, data: bytes):
+        self.clear()
+        columns = (self.pos, self.vel, self.lifetime, self.size, self.color)
+        (live, *rows), _ = unpack_rows(data, [np.zeros(0, dtype=np.int32), *columns], ROW_COUNT.size)
+        for column, values in zip(columns, rows):
+            column[live] = values
+        self.head, = ROW_COUNT.unpack_from(data)
+
+    def _sprite(self, color: int, radius: int) -> pygame.Surface:
+        key = (color, radius)
+        sprite = self._sprites.get(key)
+        if sprite is None:
+            sprite = self._sprites[key] = make_dot(radius, self.colors[color])
+        return sprite
+
+    def draw(self, surface: pygame.Surface, camera: 'Camera', alpha: float = 1.0,
+             dirty: Optional[List[pygame.Rect]] = None):
+        radius = self.size.astype(np.int32)
+        screen_pos = self.pos - self.vel * (1 - alpha) - camera.offset
+        visible = np.flatnonzero((self.lifetime > 0) & (radius >= 1) & on_screen(screen_pos))
+        if len(visible) == 0:
+            return
+        # Group by (color, radius) so each group shares one pre-drawn sprite.
+        keys = self.color[visible].astype(np.int32) * 256 + radius[visible]
+        corners = screen_pos[visible] - radius[visible, None]
+        batch = []
+        for key in np.unique(keys).tolist():
+            sprite = self._sprite(key // 256, key % 256)
+            batch.extend((sprite, corner) for corner in corners[keys == key].tolist())
+        blit_batch(surface, batch, dirty)
+
+class SpatialHash:
+    # Uniform grid of cell_size cells, each listing the entities whose box
+    # touches it. Cell keys are packed into one int (cx << 32) + cy.
+    def __init__(self, cell_size: int = TILE_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.entries = {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _keys(self, rect: pygame.Rect) -> List[int]:
+        cs = self.cell_size
+        return [(cx << 32) + cy
+                for cy in range(rect.top // cs, (rect.bottom - 1) // cs + 1)
+                for cx in range(rect.left // cs, (rect.right - 1) // cs + 1)]
+
+    def clear(self):
+        self.cells.clear()
+        self.entries.clear()
+
+    def insert(self, obj, half: int):
+        rect = pygame.Rect(obj.pos[0] - half, obj.pos[1] - half, half * 2, half * 2)
+        keys = self._keys(rect)
+        self.entries[id(obj)] = (obj, rect, keys)
+        for key in keys:
+            self.cells.setdefault(key, []).append(obj)
+
+    def remove(self, obj):
+        entry = self.entries.pop(id(obj), None)
+        if entry is None:
+            return
+        for key in entry[2]:
+            bucket = self.cells[key]
+            bucket[:] = [other for other in bucket if other is not obj]
+            if not bucket:
+                del self.cells[key]
+
+    def query_rect(self, rect: pygame.Rect) -> list:
+        # A rect spanning more cells than are occupied, like the view, is
+        # answered by walking the occupied cells instead.
+        cs = self.cell_size
+        span = ((rect.right - 1) // cs - rect.left // cs + 1) * ((rect.bottom - 1) // cs - rect.top // cs + 1)
+        if span > len(self.cells):
+            buckets = self.cells.values()
+        else:
+            buckets = [self.cells.get(key, ()) for key in self._keys(rect)]
+        found = {}
+        for bucket in buckets:
+            for obj in bucket:
+                if id(obj) not in found and self.entries[id(obj)][1].colliderect(rect):
+                    found[id(obj)] = obj
+        return list(found.values())
+
+    def query_radius(self, pos: Tuple[float, float], radius: float) -> list:
+        rect = pygame.Rect(pos[0] - radius, pos[1] - radius, radius * 2 + 1, radius * 2 + 1)
+        return [obj for obj in self.query_rect(rect)
+                if math.hypot(obj.pos[0] - pos[0], obj.pos[1] - pos[1]) <= radius]
 
 class Inventory:
     def __init__(self):
         self.items: List[Item] = []
         self.capacity = 20
-        self.weapons = [Weapon("Pistol", 10, 10, 10, 0.0, 1, -1, -1)]
+        self.weapons = [PISTOL.stats]
         self.selected_weapon = 0
         self.ammo = {"Pistol": -1}
 
@@ -125,8 +876,14 @@ class Inventory:
         return False
 
 class Player:
-    def __init__(self, x: float, y: float):
-        self.pos = [x, y]
+    def __init__(self, x: float, y: float, player_id: int = 0):
+        self.id = player_id
+        self.respawn(x, y)
+
+    def respawn(self, x: float, y: float):
+        # Back to a fresh, unarmed player at (x, y), keeping the id.
+        self.pos = [float(x), float(y)]
+        self.prev_pos = self.pos[:]
         self.vel = [0, 0]
         self.speed = 5
         self.health = 100
@@ -144,15 +901,15 @@ class Player:
         self.temp_health_boost = 0
         self.temp_health_timer = 0
 
-    def move(self, keys: pygame.key.ScancodeWrapper, walls: List[pygame.Rect]):
+    def move(self, inputs: Inputs, collider: TileCollider):
         self.vel = [0, 0]
-        if keys[pygame.K_w]:
+        if inputs.up:
             self.vel[1] = -self.speed
-        if keys[pygame.K_s]:
+        if inputs.down:
             self.vel[1] = self.speed
-        if keys[pygame.K_a]:
+        if inputs.left:
             self.vel[0] = -self.speed
-        if keys[pygame.K_d]:
+        if inputs.right:
             self.vel[0] = self.speed
 
         if self.vel[0] != 0 and self.vel[1] != 0:
@@ -160,60 +917,54 @@ class Player:
             self.vel[1] *= 0.707
 
         new_rect = pygame.Rect(self.pos[0] + self.vel[0], self.pos[1], 20, 20)
-        if not any(new_rect.colliderect(wall) for wall in walls):
+        if not collider.collides(new_rect):
             self.pos[0] += self.vel[0]
         new_rect = pygame.Rect(self.pos[0], self.pos[1] + self.vel[1], 20, 20)
-        if not any(new_rect.colliderect(wall) for wall in walls):
+        if not collider.collides(new_rect):
             self.pos[1] += self.vel[1]
 
-    def shoot(self, mouse_pos: Tuple[int, int]) -> List[Bullet]:
+    def shoot(self, aim: Tuple[float, float], bullets: BulletPool, rng: random.Random) -> int:
         weapon = self.inventory.get_weapon()
         if not self.inventory.use_ammo(weapon.name):
-            return []
-        bullets = []
-        dx = mouse_pos[0] - (self.pos[0] - camera.offset[0])
-        dy = mouse_pos[1] - (self.pos[1] - camera.offset[1])
+            return 0
+        dx = aim[0] - self.pos[0]
+        dy = aim[1] - self.pos[1]
         angle = math.atan2(dy, dx)
         for _ in range(weapon.bullet_count):
-            spread = random.uniform(-weapon.spread, weapon.spread)
-            bullets.append(Bullet(
-                pos=(self.pos[0], self.pos[1]),
-                vel=(math.cos(angle + spread) * weapon.speed, math.sin(angle + spread) * weapon.speed),
-                damage=int(weapon.damage * self.damage_modifier),
-                owner='player',
-                spread=weapon.spread
-            ))
-        return bullets
-
-    def gain_exp(self, amount: int):
+            spread = rng.uniform(-weapon.spread, weapon.spread)
+            bullets.spawn(self.pos[0], self.pos[1],
+                          math.cos(angle + spread) * weapon.speed, math.sin(angle + spread) * weapon.speed,
+                          int(weapon.damage * self.damage_modifier), OWNER_PLAYER, self.id)
+        return weapon.bullet_count
+
+    def gain_exp(self, amount: int) -> List[int]:
+        # Returns the levels reached so the world can react to each one.
         self.exp += amount
+        levels = []
         while self.exp >= self.exp_to_next:
             self.level_up()
+            levels.append(self.level)
+        return levels
 
     def level_up(self):
-        global upgrade_menu_active, boss_active
         self.level += 1
         self.exp -= self.exp_to_next
         self.exp_to_next = int(self.exp_to_next * 1.5)
         self.max_health += 20
         self.health = min(self.health + 20, self.max_health + self.temp_health_boost)
-        if self.level % 5 == 0 and not boss_active:
-            spawn_boss()
-            boss_active = True
-        else:
-            upgrade_menu_active = True
-            global upgrade_options
-            upgrade_options = self.get_upgrade_options()
 
-    def get_upgrade_options(self) -> List[dict]:
-        options = [
+    def upgrades(self) -> List[dict]:
+        return [
             {"name": "Damage +20%", "effect": lambda: setattr(self, "damage_modifier", self.damage_modifier + 0.2)},
             {"name": "Speed +10%", "effect": lambda: setattr(self, "speed", self.speed * 1.1)},
             {"name": "Armor +3", "effect": lambda: setattr(self, "armor", self.armor + 3)},
             {"name": "Health Regen +1/s", "effect": lambda: setattr(self, "regen_rate", self.regen_rate + 1)},
             {"name": "Max Health +20", "effect": lambda: setattr(self, "max_health", self.max_health + 20) or setattr(self, "health", min(self.health + 20, self.max_health + self.temp_health_boost))},
         ]
-        return random.sample(options, min(3, len(options)))
+
+    def get_upgrade_options(self, rng: random.Random) -> List[dict]:
+        options = self.upgrades()
+        return rng.sample(options, min(3, len(options)))
 
     def apply_item(self, item: Item):
         if item.type == "health":
@@ -248,117 +999,277 @@ class Player:
         if self.health < 0:
             self.health = 0
 
-class Enemy:
-    def __init__(self, x: float, y: float, type: str):
-        self.pos = [x, y]
-        self.type = type
-        self.health = 80 if type == 'drone' else 150
-        self.max_health = self.health
-        self.speed = 2.5 if type == 'drone' else 1.8
-        self.damage = 10 if type == 'drone' else 20
-        self.fire_rate = 60 if type == 'drone' else 90
-        self.fire_timer = random.randint(0, self.fire_rate)
-        self.path = []
-        self.path_timer = 0
-        self.behavior = 'ranged' if type == 'drone' else 'charge'
-
-    def move_toward(self, target_pos: Tuple[float, float], walls: List[pygame.Rect]):
-        self.path_timer -= 1
-        if (not self.path or self.path_timer <= 0) and random.random() < 0.05:
-            self.path = a_star(self.pos, target_pos, walls)
-            self.path_timer = 30
-        if self.path:
-            next_pos = self.path[0]
-            dx = next_pos[0] * TILE_SIZE + TILE_SIZE // 2 - self.pos[0]
-            dy = next_pos[1] * TILE_SIZE + TILE_SIZE // 2 - self.pos[1]
-            dist = math.hypot(dx, dy)
-            if dist > 5:
-                self.pos[0] += (dx / dist) * self.speed
-                self.pos[1] += (dy / dist) * self.speed
-            else:
-                self.path.pop(0)
-        elif self.behavior == 'charge':
-            dx = target_pos[0] - self.pos[0]
-            dy = target_pos[1] - self.pos[1]
-            dist = max(math.hypot(dx, dy), 1)
-            self.pos[0] += (dx / dist) * self.speed
-            self.pos[1] += (dy / dist) * self.speed
-
-    def shoot(self, target_pos: Tuple[float, float]) -> Bullet:
-        dx = target_pos[0] - self.pos[0]
-        dy = target_pos[1] - self.pos[1]
-        angle = math.atan2(dy, dx)
-        speed = 8
-        return Bullet(
-            pos=(self.pos[0], self.pos[1]),
-            vel=(math.cos(angle) * speed, math.sin(angle) * speed),
-            damage=self.damage,
-            owner='enemy'
-        )
+# Enemy behavior codes stored in EnemyStore.behavior
+BEHAVIOR_RANGED = 0  # closes in to hold_range, then stands and shoots
+BEHAVIOR_CHARGE = 1  # always closes in, straight at the target when there is no path
+BEHAVIOR_BOSS = 2  # always closes in along the path and cycles through its volleys
 
-    def take_damage(self, amount: int):
-        self.health -= amount
-        if self.health <= 0:
-            return True
-        return False
-
-class Boss:
-    def __init__(self, x: float, y: float):
-        self.pos = [x, y]
-        self.health = 500 + player.level * 100
-        self.max_health = self.health
-        self.speed = 1.5
-        self.damage = 30
-        self.fire_rate = 30
-        self.fire_timer = 0
-        self.path = []
-        self.path_timer = 0
-        self.attack_phase = 0
-
-    def move_toward(self, target_pos: Tuple[float, float], walls: List[pygame.Rect]):
-        self.path_timer -= 1
-        if (not self.path or self.path_timer <= 0) and random.random() < 0.1:
-            self.path = a_star(self.pos, target_pos, walls)
-            self.path_timer = 20
-        if self.path:
-            next_pos = self.path[0]
-            dx = next_pos[0] * TILE_SIZE + TILE_SIZE // 2 - self.pos[0]
-            dy = next_pos[1] * TILE_SIZE + TILE_SIZE // 2 - self.pos[1]
-            dist = math.hypot(dx, dy)
-            if dist > 5:
-                self.pos[0] += (dx / dist) * self.speed
-                self.pos[1] += (dy / dist) * self.speed
-            else:
-                self.path.pop(0)
-
-    def shoot(self, target_pos: Tuple[float, float]) -> List[Bullet]:
-        bullets = []
-        dx = target_pos[0] - self.pos[0]
-        dy = target_pos[1] - self.pos[1]
-        angle = math.atan2(dy, dx)
-        if self.attack_phase == 0:
-            for i in range(-2, 3):
-                bullets.append(Bullet(
-                    pos=(self.pos[0], self.pos[1]),
-                    vel=(math.cos(angle + i * 0.2) * 6, math.sin(angle + i * 0.2) * 6),
-                    damage=self.damage,
-                    owner='boss'
-                ))
+@dataclass(frozen=True)
+class Volley:
+    # Bullets fired together: angle offsets from the aim, speed, and the
+    # divisor applied to the shooter's damage.
+    offsets: Tuple[float, ...]
+    speed: float
+    damage_divisor: int = 1
+
+@dataclass(frozen=True)
+class EnemyType:
+    name: str  # also the sprite name
+    behavior: int
+    health: int
+    health_per_level: int
+    speed: float
+    damage: int
+    half: int  # half the side of the collision box
+    exp: int
+    exp_per_level: int
+    marker: Tuple[int, int, int] = RED
+    hold_range: float = 0.0
+    fire_rate: int = 0
+    fire_range: float = 0.0
+    volleys: Tuple[Volley, ...] = ()
+    owner: int = OWNER_ENEMY
+    path_chance: float = 0.05  # per tick, for A* searches once the path runs out
+    path_interval: int = 30
+    item_chance: float = 0.0
+    chests: int = 0
+
+ENEMY_TYPES = (
+    EnemyType('drone', BEHAVIOR_RANGED, 80, 20, 2.5, 10, 15, 50, 10, hold_range=200, fire_rate=60, fire_range=400,
+              volleys=(Volley((0.0,), 8),), item_chance=0.5),
+    EnemyType('tank', BEHAVIOR_CHARGE, 150, 20, 1.8, 20, 15, 100, 20, fire_rate=90, item_chance=0.5),
+    EnemyType('boss', BEHAVIOR_BOSS, 500, 100, 1.5, 30, 25, 500, 100, marker=CYAN, fire_rate=30, fire_range=500,
+              volleys=(Volley((-0.4, -0.2, 0.0, 0.2, 0.4), 6), Volley((0.0,), 10, 2)),
+              owner=OWNER_BOSS, path_chance=0.1, path_interval=20, chests=2),
+)
+ENEMY_CODES = {enemy_type.name: code for code, enemy_type in enumerate(ENEMY_TYPES)}
+WAVE_ENEMY_CODES = (ENEMY_CODES['drone'], ENEMY_CODES['tank'])
+BOSS = ENEMY_CODES['boss']
+
+class EnemyStore:
+    # Structure-of-arrays storage for every enemy, bosses included, laid out
+    # like BulletPool: live enemies occupy [0, count) and dead slots are filled
+    # from the tail in compact(). Per-type constants are looked up through the
+    # type column, so steering, firing and hit tests work on whole arrays.
+    # Only the A* paths are kept per enemy, in self.paths. ENEMY_TYPES is
+    # read when the store is created, so it can be swapped for tuning runs.
+    # Like bullets, every enemy gets an id from a running counter.
+    _columns = (('pos', np.float64, 2), ('prev', np.float64, 2), ('type', np.uint8, 1), ('behavior', np.uint8, 1),
+                ('speed', np.float64, 1), ('health', np.int32, 1), ('max_health', np.int32, 1),
+                ('damage', np.int32, 1), ('fire_timer', np.int32, 1), ('phase', np.uint8, 1),
+                ('path_timer', np.int32, 1), ('id', np.uint32, 1), ('alive', bool, 1))
+
+    def __init__(self, capacity: int = ENEMY_CAPACITY):
+        self._half = np.array([t.half for t in ENEMY_TYPES], dtype=np.int64)
+        self._hold_range = np.array([t.hold_range for t in ENEMY_TYPES])
+        self._fire_rate = np.array([t.fire_rate for t in ENEMY_TYPES], dtype=np.int32)
+        self._fire_range = np.array([t.fire_range for t in ENEMY_TYPES])
+        self.count = 0
+        self.next_id = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        for name, dtype, width in self._columns:
+            setattr(self, name, np.zeros((capacity, width) if width > 1 else capacity, dtype=dtype))
+        self.paths = [[] for _ in range(capacity)]
+
+    def _grow(self):
+        old = [getattr(self, name) for name, _, _ in self._columns]
+        paths = self.paths
+        self._allocate(len(self.alive) * 2)
+        for (name, _, _), old_arr in zip(self._columns, old):
+            getattr(self, name)[:self.count] = old_arr[:self.count]
+        self.paths[:self.count] = paths[:self.count]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def clear(self):
+        self.alive[:self.count] = False
+        for i in range(self.count):
+            self.paths[i] = []
+        self.count = 0
+
+    def spawn(self, code: int, x: float, y: float, level: int, fire_timer: int = 0) -> int:
+        if self.count == len(self.alive):
+            self._grow()
+        enemy_type = ENEMY_TYPES[code]
+        i = self.count
+        self.pos[i] = self.prev[i] = (x, y)
+        self.type[i] = code
+        self.behavior[i] = enemy_type.behavior
+        self.speed[i] = enemy_type.speed
+        self.health[i] = self.max_health[i] = enemy_type.health + enemy_type.health_per_level * level
+        self.damage[i] = enemy_type.damage
+        self.fire_timer[i] = fire_timer
+        self.phase[i] = 0
+        self.path_timer[i] = 0
+        self.paths[i] = []
+        self.id[i] = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.alive[i] = True
+        self.count += 1
+        return i
+
+    def boxes(self) -> np.ndarray:
+        # (count, 4) int collision boxes, matching Rect(x - half, y - half, 2 * half, 2 * half)
+        half = self._half[self.type[:self.count]]
+        boxes = np.empty((self.count, 4), dtype=np.int64)
+        boxes[:, :2] = np.floor(self.pos[:self.count] - half[:, None])
+        boxes[:, 2] = boxes[:, 3] = 2 * half
+        return boxes
+
+    def update(self, targets: np.ndarray, bullets: BulletPool, pathfinder: 'Pathfinder',
+               rng: random.Random, flow_field: 'FlowField' = None):
+        # Each enemy goes for the nearest of the (P, 2) target positions.
+        # Distances are taken before anyone moves; ranged enemies only close
+        # in while beyond hold_range, and everyone armed fires from fire_range.
+        n = self.count
+        if n == 0 or len(targets) == 0:
+            return
+        codes = self.type[:n]
+        offsets = targets[None, :, :] - self.pos[:n, None, :]
+        nearest = np.argmin((offsets ** 2).sum(axis=2), axis=1)
+        goal = targets[nearest]
+        offset = offsets[np.arange(n), nearest]
+        dist = np.hypot(offset[:, 0], offset[:, 1])
+        moving = (self.behavior[:n] != BEHAVIOR_RANGED) | (dist > self._hold_range[codes])
+        if flow_field is not None:
+            self._follow_field(flow_field, moving, offset)
         else:
-            bullets.append(Bullet(
-                pos=(self.pos[0], self.pos[1]),
-                vel=(math.cos(angle) * 10, math.sin(angle) * 10),
-                damage=self.damage // 2,
-                owner='boss'
-            ))
-        self.attack_phase = (self.attack_phase + 1) % 2
-        return bullets
-
-    def take_damage(self, amount: int):
-        self.health -= amount
-        if self.health <= 0:
-            return True
-        return False
+            self._follow_paths(goal, pathfinder, rng, np.flatnonzero(moving).tolist())
+        self._fire(goal, bullets, dist)
+
+    def _follow_field(self, flow_field: 'FlowField', moving: np.ndarray, offset: np.ndarray):
+        n = self.count
+        pos = self.pos[:n]
+        tiles, found = flow_field.next_tiles(pos)
+        charge = moving & ~found & (self.behavior[:n] == BEHAVIOR_CHARGE)
+        step = np.where(charge[:, None], offset, tiles * TILE_SIZE + TILE_SIZE // 2 - pos)
+        dist = np.maximum(np.hypot(step[:, 0], step[:, 1]), 1)
+        pos += step * (self.speed[:n] * (moving & (found | charge)) / dist)[:, None]
+
+    def _follow_paths(self, goal: np.ndarray, pathfinder: 'Pathfinder', rng: random.Random, movers: List[int]):
+        # A* mode: per-enemy paths, refreshed at random once they run out or expire.
+        for i in movers:
+            enemy_type = ENEMY_TYPES[self.type[i]]
+            target_pos = goal[i].tolist()
+            x, y = self.pos[i].tolist()
+            speed = float(self.speed[i])
+            self.path_timer[i] -= 1
+            if (not self.paths[i] or self.path_timer[i] <= 0) and rng.random() < enemy_type.path_chance:
+                path = pathfinder.find_path((x, y), target_pos)
+                if path is not None:
+                    self.paths[i] = path
+                    self.path_timer[i] = enemy_type.path_interval
+            path = self.paths[i]
+            if path:
+                dx = path[0][0] * TILE_SIZE + TILE_SIZE // 2 - x
+                dy = path[0][1] * TILE_SIZE + TILE_SIZE // 2 - y
+                dist = math.hypot(dx, dy)
+                if dist > 5:
+                    self.pos[i] = (x + dx / dist * speed, y + dy / dist * speed)
+                else:
+                    path.pop(0)
+            elif enemy_type.behavior == BEHAVIOR_CHARGE:
+                dx, dy = target_pos[0] - x, target_pos[1] - y
+                dist = max(math.hypot(dx, dy), 1)
+                self.pos[i] = (x + dx / dist * speed, y + dy / dist * speed)
+
+    def _fire(self, goal: np.ndarray, bullets: BulletPool, dist: np.ndarray):
+        n = self.count
+        codes = self.type[:n]
+        armed = self._fire_range[codes] > 0
+        timer = self.fire_timer[:n]
+        fire = armed & (timer <= 0) & (dist < self._fire_range[codes])
+        timer[armed & ~fire] -= 1
+        timer[fire] = self._fire_rate[codes[fire]]
+        if not fire.any():
+            return
+        offset = goal - self.pos[:n]
+        angle = np.arctan2(offset[:, 1], offset[:, 0])
+        phase = self.phase[:n]
+        for code in np.unique(codes[fire]).tolist():
+            enemy_type = ENEMY_TYPES[code]
+            shooters = fire & (codes == code)
+            for volley_index, volley in enumerate(enemy_type.volleys):
+                group = np.flatnonzero(shooters & (phase == volley_index))
+                for spread in volley.offsets:
+                    aim = angle[group] + spread
+                    vel = np.stack((np.cos(aim), np.sin(aim)), axis=1) * volley.speed
+                    bullets.spawn_many(self.pos[group], vel, self.damage[group] // volley.damage_divisor, enemy_type.owner)
+            phase[shooters] = (phase[shooters] + 1) % len(enemy_type.volleys)
+
+    def first_hits(self, boxes: np.ndarray) -> Tuple[np.ndarray, int]:
+        # For (N, 4) int boxes: the slot of the lowest-indexed enemy each box
+        # overlaps (-1 for none), plus the number of candidate pairs tested.
+        # Enemies are bucketed by the grid cell of their centre; the cells are
+        # large enough that an overlapping enemy is always bucketed in the
+        # box's own cell or one of its 8 neighbours.
+        hits = np.full(len(boxes), -1, dtype=np.int64)
+        n = self.count
+        if n == 0 or len(boxes) == 0:
+            return hits, 0
+        enemy_boxes = self.boxes()
+        cell = int(boxes[:, 2:].max() + enemy_boxes[:, 2:].max())
+        centre = self.pos[:n] // cell
+        keys = (centre[:, 0].astype(np.int64) << 32) + centre[:, 1].astype(np.int64)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        box_cx = (boxes[:, 0] + boxes[:, 2] // 2) // cell
+        box_cy = (boxes[:, 1] + boxes[:, 3] // 2) // cell
+        # Probe all 9 cells around every box in one pass.
+        around = np.arange(-1, 2)
+        probe = (((box_cx[:, None, None] + around[None, None, :]) << 32) +
+                 box_cy[:, None, None] + around[None, :, None]).ravel()
+        start = np.searchsorted(keys, probe, 'left')
+        counts = np.searchsorted(keys, probe, 'right') - start
+        pairs = int(counts.sum())
+        first = np.full(len(boxes), n, dtype=np.int64)
+        if pairs:
+            box_index = np.repeat(np.arange(len(probe)) // 9, counts)
+            ends = np.cumsum(counts)
+            enemy = order[np.repeat(start - (ends - counts), counts) + np.arange(pairs)]
+            a, b = boxes[box_index], enemy_boxes[enemy]
+            overlap = ((a[:, 0] < b[:, 0] + b[:, 2]) & (b[:, 0] < a[:, 0] + a[:, 2]) &
+                       (a[:, 1] < b[:, 1] + b[:, 3]) & (b[:, 1] < a[:, 1] + a[:, 3]))
+            np.minimum.at(first, box_index[overlap], enemy[overlap])
+        hits[first < n] = first[first < n]
+        return hits, pairs
+
+    def compact(self):
+        n = self.count
+        m = int(self.alive[:n].sum())
+        holes = np.flatnonzero(~self.alive[:m])
+        tail = np.flatnonzero(self.alive[m:n]) + m
+        for name, _, _ in self._columns[:-1]:
+            arr = getattr(self, name)
+            arr[holes] = arr[tail]
+        for hole, i in zip(holes.tolist(), tail.tolist()):
+            self.paths[hole] = self.paths[i]
+        for i in range(m, n):
+            self.paths[i] = []
+        self.alive[holes] = True
+        self.alive[m:n] = False
+        self.count = m
+
+    def pack(self) -> bytes:
+        columns = [getattr(self, name) for name, _, _ in self._columns[:-1]]
+        return ROW_COUNT.pack(self.next_id) + pack_rows(columns, self.count) + pack_paths(self.paths[:self.count])
+
+    def unpack(self, data: bytes):
+        rows, offset = unpack_rows(data, [getattr(self, name) for name, _, _ in self._columns[:-1]], ROW_COUNT.size)
+        paths, _ = unpack_paths(data, offset)
+        n = len(paths)
+        self.clear()
+        while n > len(self.alive):
+            self._grow()
+        for (name, _, _), values in zip(self._columns, rows):
+            getattr(self, name)[:n] = values
+        self.paths[:n] = paths
+        self.alive[:n] = True
+        self.count = n
+        self.next_id, = ROW_COUNT.unpack_from(data)
 
 class Camera:
     def __init__(self):
@@ -368,90 +1279,395 @@ class Camera:
         self.offset[0] = target_pos[0] - SCREEN_WIDTH // 2
         self.offset[1] = target_pos[1] - SCREEN_HEIGHT // 2
 
-class Map:
-    def __init__(self):
-        self.tiles = [[0 for _ in range(MAP_WIDTH)] for _ in range(MAP_HEIGHT)]
-        self.generate_map()
-
-    def generate_map(self):
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                if random.random() < 0.15:
-                    self.tiles[y][x] = 1
-                else:
-                    self.tiles[y][x] = 0
-        self.tiles[MAP_HEIGHT // 2][MAP_WIDTH // 2] = 0
+    def view_rect(self, margin: int = CULL_MARGIN) -> pygame.Rect:
+        # The visible part of the world, grown by margin on every side.
+        return pygame.Rect(self.offset[0] - margin, self.offset[1] - margin,
+                           SCREEN_WIDTH + margin * 2, SCREEN_HEIGHT + margin * 2)
+
+def on_screen(screen_pos: np.ndarray, margin: int = CULL_MARGIN) -> np.ndarray:
+    # True for the (N, 2) screen positions within margin pixels of the screen.
+    return ((screen_pos[:, 0] > -margin) & (screen_pos[:, 0] < SCREEN_WIDTH + margin) &
+            (screen_pos[:, 1] > -margin) & (screen_pos[:, 1] < SCREEN_HEIGHT + margin))
 
-    def get_walls(self) -> List[pygame.Rect]:
-        walls = []
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                if self.tiles[y][x] == 1:
-                    walls.append(pygame.Rect(x * TILE_SIZE, y * TILE_SIZE, TILE_SIZE, TILE_SIZE))
-        return walls
+class Map:
+    # Tiles live in MAP_CHUNK_TILES-square uint8 chunks generated from the map
+    # seed the first time anything reads them, so the map can be far larger
+    # than what is ever visited. At most MAP_CHUNK_CACHE chunks stay decoded;
+    # evicting an edited chunk keeps it zlib-compressed, an untouched one is
+    # simply generated again when needed.
+    #
+    # Generation: per-chunk seeded noise is smoothed into caves by a cellular
+    # automaton, then two-tile corridors are cut along every MAP_CHUNK_TILES-th
+    # row and column through the spawn tile and around the map edge. All
+    # corridors meet, and open tiles that cannot reach one inside their own
+    # chunk are filled in, so every open tile is reachable from the spawn.
+    def __init__(self, rng: random.Random, width: int = MAP_WIDTH, height: int = MAP_HEIGHT):
+        self.width = width
+        self.height = height
+        self.chunks = OrderedDict()
+        self.edited = set()
+        self.packed = {}
+        self._chunk_surfaces = OrderedDict()
+        self._noise_cache = OrderedDict()
+        self.seed = None
+        self.collider = TileCollider(self)
+        self.generate_map(rng)
+
+    def generate_map(self, rng: random.Random):
+        self.load(rng.randrange(2 ** 32), {})
+
+    def load(self, seed: int, edited: Dict[Tuple[int, int], np.ndarray]):
+        # Starts over from seed, with the given chunks as edited over the
+        # generated ones. Decoded and baked chunks that were generated from
+        # the same seed stay valid and are kept.
+        if seed != self.seed:
+            self.chunks.clear()
+            self._chunk_surfaces.clear()
+            self._noise_cache.clear()
+        for key in self.edited | set(edited):
+            self.chunks.pop(key, None)
+            self._chunk_surfaces.pop(key, None)
+        self.seed = seed
+        self.edited = set(edited)
+        self.packed = {key: zlib.compress(chunk.tobytes()) for key, chunk in edited.items()}
+        self.collider.refresh()
+
+    def pack(self) -> bytes:
+        # The seed plus the edited chunks as bitmaps (tiles are 0 or 1); every
+        # other chunk is generated again from the seed.
+        keys = sorted(self.edited)
+        chunks = [self.chunks[key].ravel() if key in self.chunks else
+                  np.frombuffer(zlib.decompress(self.packed[key]), dtype=np.uint8) for key in keys]
+        bits = np.packbits(np.array(chunks, dtype=np.uint8).reshape(len(keys), MAP_CHUNK_TILES ** 2), axis=1)
+        return ROW_COUNT.pack(self.seed) + pack_rows([np.array(keys, dtype=np.int32).reshape(-1, 2), bits], len(keys))
+
+    def unpack(self, data: bytes):
+        templates = [np.zeros((0, 2), dtype=np.int32), np.zeros((0, MAP_CHUNK_TILES ** 2 // 8), dtype=np.uint8)]
+        (keys, bits), _ = unpack_rows(data, templates, ROW_COUNT.size)
+        chunks = np.unpackbits(bits, axis=1).reshape(-1, MAP_CHUNK_TILES, MAP_CHUNK_TILES)
+        self.load(ROW_COUNT.unpack_from(data)[0], {tuple(key): chunk for key, chunk in zip(keys.tolist(), chunks)})
+
+    def _noise(self, cx: int, cy: int) -> np.ndarray:
+        # Every chunk reads the noise of its 8 neighbours, so the last few
+        # rings of noise are kept around while a window is being generated.
+        key = (cx, cy)
+        noise = self._noise_cache.get(key)
+        if noise is not None:
+            self._noise_cache.move_to_end(key)
+            return noise
+        if 0 <= cx * MAP_CHUNK_TILES < self.width and 0 <= cy * MAP_CHUNK_TILES < self.height:
+            rng = np.random.default_rng((self.seed, cx, cy))
+            noise = (rng.random((MAP_CHUNK_TILES, MAP_CHUNK_TILES)) < MAP_WALL_DENSITY).astype(np.uint8)
+        else:
+            noise = np.zeros((MAP_CHUNK_TILES, MAP_CHUNK_TILES), dtype=np.uint8)
+        self._noise_cache[key] = noise
+        if len(self._noise_cache) > (ACTIVE_CHUNKS + 2) ** 2:
+            self._noise_cache.popitem(last=False)
+        return noise
+
+    def _generate_chunk(self, cx: int, cy: int) -> np.ndarray:
+        # Each smoothing pass needs one ring of neighbours, so the automaton
+        # runs on the chunk plus a MAP_SMOOTHING_STEPS margin cut from the
+        # surrounding chunks' noise. That keeps chunk borders seamless no
+        # matter which chunk is generated first.
+        n, m = MAP_CHUNK_TILES, MAP_SMOOTHING_STEPS
+        noise = np.block([[self._noise(cx + dx, cy + dy) for dx in (-1, 0, 1)] for dy in (-1, 0, 1)])
+        walls = noise[n - m:2 * n + m, n - m:2 * n + m]
+        for _ in range(m):
+            h, w = walls.shape
+            neighbours = sum(walls[dy:h - 2 + dy, dx:w - 2 + dx] for dy in range(3) for dx in range(3)) - walls[1:-1, 1:-1]
+            walls = ((neighbours >= 5) | ((walls[1:-1, 1:-1] == 1) & (neighbours >= 4))).astype(np.uint8)
+
+        ys = np.arange(cy * n, cy * n + n)[:, None]
+        xs = np.arange(cx * n, cx * n + n)[None, :]
+        on_map = (xs < self.width) & (ys < self.height)
+        sx, sy = self.width // 2 % n, self.height // 2 % n
+        corridor = ((xs - sx) % n < 2) | ((ys - sy) % n < 2) | (xs < 2) | (ys < 2) | (xs >= self.width - 2) | (ys >= self.height - 2)
+        corridor &= on_map
+        open_tiles = on_map & ((walls == 0) | corridor)
+
+        # Flood fill from the corridors, one 4-neighbour step per pass.
+        reached = corridor.copy()
+        while True:
+            grown = reached.copy()
+            grown[1:, :] |= reached[:-1, :]
+            grown[:-1, :] |= reached[1:, :]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            grown &= open_tiles
+            if (grown == reached).all():
+                break
+            reached = grown
+        return (on_map & ~reached).astype(np.uint8)
+
+    def chunk(self, cx: int, cy: int) -> np.ndarray:
+        key = (cx, cy)
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            return chunk
+        packed = self.packed.pop(key, None)
+        if packed is not None:
+            chunk = np.frombuffer(zlib.decompress(packed), dtype=np.uint8).reshape(MAP_CHUNK_TILES, MAP_CHUNK_TILES).copy()
+        else:
+            chunk = self._generate_chunk(cx, cy)
+        self.chunks[key] = chunk
+        if len(self.chunks) > MAP_CHUNK_CACHE:
+            old_key, old_chunk = self.chunks.popitem(last=False)
+            if old_key in self.edited:
+                self.packed[old_key] = zlib.compress(old_chunk.tobytes())
+        return chunk
+
+    def get_tile(self, x: int, y: int) -> int:
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            return 0
+        return int(self.chunk(x // MAP_CHUNK_TILES, y // MAP_CHUNK_TILES)[y % MAP_CHUNK_TILES, x % MAP_CHUNK_TILES])
+
+    def set_tile(self, x: int, y: int, value: int):
+        key = (x // MAP_CHUNK_TILES, y // MAP_CHUNK_TILES)
+        self.chunk(*key)[y % MAP_CHUNK_TILES, x % MAP_CHUNK_TILES] = value
+        self.edited.add(key)
+        self._chunk_surfaces.pop(key, None)
+        self.collider.set_tile(x, y, value)
+
+    def region(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        # Tiles of columns x0..x1-1 and rows y0..y1-1; off the map reads as 0.
+        out = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        left, top = max(x0, 0), max(y0, 0)
+        right, bottom = min(x1, self.width), min(y1, self.height)
+        for cy in range(top // MAP_CHUNK_TILES, (bottom - 1) // MAP_CHUNK_TILES + 1):
+            for cx in range(left // MAP_CHUNK_TILES, (right - 1) // MAP_CHUNK_TILES + 1):
+                cx0, cy0 = cx * MAP_CHUNK_TILES, cy * MAP_CHUNK_TILES
+                ax, ay = max(left, cx0), max(top, cy0)
+                bx, by = min(right, cx0 + MAP_CHUNK_TILES), min(bottom, cy0 + MAP_CHUNK_TILES)
+                out[ay - y0:by - y0, ax - x0:bx - x0] = self.chunk(cx, cy)[ay - cy0:by - cy0, ax - cx0:bx - cx0]
+        return out
+
+    def _bake_chunk(self, cx: int, cy: int) -> pygame.Surface:
+        # One pixel per tile, scaled up: nearest-neighbour scaling turns each
+        # pixel into an exact TILE_SIZE square.
+        w = min(MAP_CHUNK_TILES, self.width - cx * MAP_CHUNK_TILES)
+        h = min(MAP_CHUNK_TILES, self.height - cy * MAP_CHUNK_TILES)
+        pixels = np.zeros((w, h, 3), dtype=np.uint8)
+        pixels[self.chunk(cx, cy)[:h, :w].T == 1] = GRAY
+        surface = pygame.transform.scale(pygame.surfarray.make_surface(pixels), (w * TILE_SIZE, h * TILE_SIZE))
+        return render_backend.convert(surface)
 
     def draw(self, surface: pygame.Surface, camera: Camera):
+        # Chunks are baked into surfaces when they come into view and kept in
+        # a MAP_SURFACE_CACHE-sized LRU; set_tile drops the one it changes.
         surface.fill(DARK_GRAY)
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                screen_x = x * TILE_SIZE - camera.offset[0]
-                screen_y = y * TILE_SIZE - camera.offset[1]
-                if -TILE_SIZE <= screen_x < SCREEN_WIDTH + TILE_SIZE and -TILE_SIZE <= screen_y < SCREEN_HEIGHT + TILE_SIZE:
-                    color = GRAY if self.tiles[y][x] == 1 else BLACK
-                    pygame.draw.rect(surface, color, (screen_x, screen_y, TILE_SIZE, TILE_SIZE))
-
-def a_star(start: Tuple[float, float], goal: Tuple[float, float], walls: List[pygame.Rect]) -> List[Tuple[int, int]]:
-    start_node = (int(start[0] // TILE_SIZE), int(start[1] // TILE_SIZE))
-    goal_node = (int(goal[0] // TILE_SIZE), int(goal[1] // TILE_SIZE))
-    open_set = {start_node}
-    closed_set = set()
+        chunk_px = MAP_CHUNK_TILES * TILE_SIZE
+        cx0 = max(int(camera.offset[0] // chunk_px), 0)
+        cy0 = max(int(camera.offset[1] // chunk_px), 0)
+        cx1 = min(int((camera.offset[0] + SCREEN_WIDTH) // chunk_px), (self.width - 1) // MAP_CHUNK_TILES)
+        cy1 = min(int((camera.offset[1] + SCREEN_HEIGHT) // chunk_px), (self.height - 1) // MAP_CHUNK_TILES)
+        batch = []
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                key = (cx, cy)
+                chunk = self._chunk_surfaces.get(key)
+                if chunk is None:
+                    chunk = self._chunk_surfaces[key] = self._bake_chunk(cx, cy)
+                    if len(self._chunk_surfaces) > MAP_SURFACE_CACHE:
+                        self._chunk_surfaces.popitem(last=False)
+                else:
+                    self._chunk_surfaces.move_to_end(key)
+                batch.append((chunk, (cx * chunk_px - camera.offset[0], cy * chunk_px - camera.offset[1])))
+        surface.blits(batch, doreturn=False)
+
+class Minimap:
+    # Shows the collider's active window, which is the whole map for small
+    # maps. The wall layer is rendered once per collider version; callers get
+    # a copy to draw the moving markers on (see to_minimap).
+    def __init__(self, size: int = 100):
+        self.size = size
+        self._base = None
+        self._version = -1
+
+    def render(self, collider: TileCollider) -> pygame.Surface:
+        if self._base is None or self._version != collider.version:
+            pixels = np.zeros((collider.width, collider.height, 3), dtype=np.uint8)
+            pixels[collider.solid.T] = GRAY
+            base = pygame.transform.scale(pygame.surfarray.make_surface(pixels), (self.size, self.size))
+            self._base = render_backend.convert(base)
+            self._version = collider.version
+        return self._base.copy()
+
+    def to_minimap(self, pos: Tuple[float, float], collider: TileCollider) -> Tuple[float, float]:
+        return ((pos[0] / TILE_SIZE - collider.x0) * self.size / collider.width,
+                (pos[1] / TILE_SIZE - collider.y0) * self.size / collider.height)
+
+def a_star(start_node: Tuple[int, int], goal_node: Tuple[int, int], walkable: List[bool], width: int, height: int) -> List[Tuple[int, int]]:
+    # walkable is a flat row-major grid; nodes are indexed as y * width + x.
+    start = start_node[1] * width + start_node[0]
+    goal = goal_node[1] * width + goal_node[0]
+    gx, gy = goal_node
     came_from = {}
-    g_score = {start_node: 0}
-    f_score = {start_node: math.hypot(start_node[0] - goal_node[0], start_node[1] - goal_node[1])}
+    g_score = {start: 0.0}
+    open_heap = [(math.hypot(start_node[0] - gx, start_node[1] - gy), 0.0, start)]
+    closed = set()
 
-    while open_set:
-        current = min(open_set, key=lambda node: f_score.get(node, float('inf')))
-        if current == goal_node:
+    while open_heap:
+        _, g, current = heapq.heappop(open_heap)
+        if current == goal:
             path = []
             while current in came_from:
-                path.append(current)
+                path.append((current % width, current // width))
                 current = came_from[current]
+            profiler.count('a_star_nodes', len(closed))
             return path[::-1][:10]
+        if current in closed:
+            continue
+        closed.add(current)
 
-        open_set.remove(current)
-        closed_set.add(current)
-
-        for dx, dy in [(0, 1), (1, 0), (0, -1), (-1, 0)]:
-            neighbor = (current[0] + dx, current[1] + dy)
-            if 0 <= neighbor[0] < MAP_WIDTH and 0 <= neighbor[1] < MAP_HEIGHT:
-                neighbor_rect = pygame.Rect(neighbor[0] * TILE_SIZE, neighbor[1] * TILE_SIZE, TILE_SIZE, TILE_SIZE)
-                if any(neighbor_rect.colliderect(wall) for wall in walls):
-                    continue
-                if neighbor in closed_set:
-                    continue
-                tentative_g_score = g_score[current] + 1.0
-                if neighbor not in open_set:
-                    open_set.add(neighbor)
-                elif tentative_g_score >= g_score.get(neighbor, float('inf')):
-                    continue
-                came_from[neighbor] = current
-                g_score[neighbor] = tentative_g_score
-                f_score[neighbor] = g_score[neighbor] + math.hypot(neighbor[0] - goal_node[0], neighbor[1] - goal_node[1])
+        cx, cy = current % width, current // width
+        for nx, ny in ((cx, cy + 1), (cx + 1, cy), (cx, cy - 1), (cx - 1, cy)):
+            if not (0 <= nx < width and 0 <= ny < height):
+                continue
+            neighbor = ny * width + nx
+            if not walkable[neighbor] or neighbor in closed:
+                continue
+            tentative_g_score = g + 1.0
+            if tentative_g_score >= g_score.get(neighbor, float('inf')):
+                continue
+            came_from[neighbor] = current
+            g_score[neighbor] = tentative_g_score
+            heapq.heappush(open_heap, (tentative_g_score + math.hypot(nx - gx, ny - gy), tentative_g_score, neighbor))
 
+    profiler.count('a_star_nodes', len(closed))
     return []
 
-def generate_explosion_sound():
+class Pathfinder:
+    # Wraps a_star with a walkability grid taken from the collider, a path cache
+    # keyed by (start tile, goal tile) and a per-tick limit on fresh searches.
+    def __init__(self, collider: TileCollider):
+        self.collider = collider
+        self.cache = OrderedDict()
+        self.walkable = []
+        self.version = -1
+        self.budget = MAX_PATH_SEARCHES_PER_TICK
+
+    def begin_tick(self):
+        self.budget = MAX_PATH_SEARCHES_PER_TICK
+
+    def _sync(self):
+        if self.version != self.collider.version:
+            self.walkable = (~self.collider.solid).ravel().tolist()
+            self.cache.clear()
+            self.version = self.collider.version
+
+    def find_path(self, start: Tuple[float, float], goal: Tuple[float, float]) -> Optional[List[Tuple[int, int]]]:
+        # Returns None when this tick's search budget is spent; callers keep
+        # their old path. Searches stay inside the collider's active window.
+        self._sync()
+        collider = self.collider
+        start_node = (int(start[0] // TILE_SIZE), int(start[1] // TILE_SIZE))
+        goal_node = (int(goal[0] // TILE_SIZE), int(goal[1] // TILE_SIZE))
+        key = (start_node, goal_node)
+        path = self.cache.get(key)
+        if path is not None:
+            self.cache.move_to_end(key)
+            return list(path)
+        if not all(0 <= x - collider.x0 < collider.width and 0 <= y - collider.y0 < collider.height
+                   for x, y in key):
+            return []
+        if self.budget <= 0:
+            return None
+        self.budget -= 1
+        with profiler.section('a_star'):
+            path = a_star((start_node[0] - collider.x0, start_node[1] - collider.y0),
+                          (goal_node[0] - collider.x0, goal_node[1] - collider.y0),
+                          self.walkable, collider.width, collider.height)
+            path = [(x + collider.x0, y + collider.y0) for x, y in path]
+        profiler.count('a_star_calls')
+        self.cache[key] = path
+        if len(self.cache) > PATH_CACHE_SIZE:
+            self.cache.popitem(last=False)
+        return list(path)
+
+    def pack(self) -> bytes:
+        # The cached paths in LRU order; a cache the collider has moved on from is dropped.
+        entries = list(self.cache.items()) if self.version == self.collider.version else []
+        keys = np.array([start + goal for (start, goal), _ in entries], dtype=np.int32).reshape(-1, 4)
+        return pack_rows([keys], len(entries)) + pack_paths([path for _, path in entries])
+
+    def unpack(self, data: bytes):
+        # Call once the collider holds the restored window.
+        (keys,), offset = unpack_rows(data, [np.zeros((0, 4), dtype=np.int32)])
+        paths, _ = unpack_paths(data, offset)
+        self._sync()
+        self.cache.clear()
+        for (x0, y0, x1, y1), path in zip(keys.tolist(), paths):
+            self.cache[((x0, y0), (x1, y1))] = path
+
+class FlowField:
+    # One BFS from the targets' tiles gives every reachable tile the next step
+    # toward the nearest target, so any number of chasers can read their
+    # direction in O(1). The field covers the collider's active window.
+    def __init__(self, collider: TileCollider):
+        self.collider = collider
+        self.next = np.full(collider.width * collider.height, -1, dtype=np.int64)
+        self.goals = None
+        self.version = -1
+
+    def update(self, targets: List[Tuple[float, float]]):
+        goals = tuple(dict.fromkeys((int(x // TILE_SIZE), int(y // TILE_SIZE)) for x, y in targets))
+        if goals == self.goals and self.version == self.collider.version:
+            return
+        self.goals = goals
+        self.version = self.collider.version
+        width, height = self.collider.width, self.collider.height
+        self.next = np.full(width * height, -1, dtype=np.int64)
+        # BFS over flat indices of the window padded with a ring of walls, so
+        # neighbours need no bounds checks. A tile is closed as soon as it is
+        # queued, and the queue is a list walked while it grows; it starts
+        # with every goal tile inside the window.
+        stride = width + 2
+        open_tiles = bytearray(np.pad(~self.collider.solid, 1).tobytes())
+        came_from = [-1] * len(open_tiles)
+        queue = []
+        for x, y in goals:
+            gx, gy = x - self.collider.x0, y - self.collider.y0
+            if 0 <= gx < width and 0 <= gy < height:
+                start = (gy + 1) * stride + gx + 1
+                open_tiles[start] = 0
+                queue.append(start)
+        if not queue:
+            return
+        for current in queue:
+            for neighbor in (current + stride, current + 1, current - stride, current - 1):
+                if open_tiles[neighbor]:
+                    open_tiles[neighbor] = 0
+                    came_from[neighbor] = current
+                    queue.append(neighbor)
+        came_from = np.array(came_from, dtype=np.int64).reshape(height + 2, stride)[1:-1, 1:-1].ravel()
+        found = came_from >= 0
+        self.next[found] = (came_from[found] // stride - 1) * width + came_from[found] % stride - 1
+
+    def next_tiles(self, pos: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # Next global tile for each of (N, 2) positions, plus a mask that is
+        # False where a position is on the goal tile, off the window or cannot
+        # reach the goal.
+        collider = self.collider
+        width = collider.width
+        tx = (pos[:, 0] // TILE_SIZE).astype(np.int64) - collider.x0
+        ty = (pos[:, 1] // TILE_SIZE).astype(np.int64) - collider.y0
+        inside = (tx >= 0) & (tx < width) & (ty >= 0) & (ty < collider.height)
+        index = np.minimum(np.maximum(ty, 0), collider.height - 1) * width + np.minimum(np.maximum(tx, 0), width - 1)
+        steps = np.where(inside, self.next[index], -1)
+        return np.stack((steps % width + collider.x0, steps // width + collider.y0), axis=1), steps >= 0
+
+def generate_explosion_sound(rng: np.random.Generator) -> np.ndarray:
     sample_rate = 44100
     duration = 0.2
     t = np.linspace(0, duration, int(sample_rate * duration), False)
-    noise = np.random.normal(0, 0.5, t.shape)
+    noise = rng.normal(0, 0.5, t.shape)
     envelope = np.exp(-5 * t / duration)
     sound_data = (noise * envelope * 32767).astype(np.int16)
-    sound_array = np.column_stack((sound_data, sound_data))
-    sound = pygame.sndarray.make_sound(sound_array)
-    return sound
+    return np.column_stack((sound_data, sound_data))
 
-def generate_shot_sound():
+def generate_shot_sound(rng: np.random.Generator) -> np.ndarray:
     sample_rate = 44100
     duration = 0.1
     t = np.linspace(0, duration, int(sample_rate * duration), False)
@@ -459,11 +1675,9 @@ def generate_shot_sound():
     wave = np.sin(2 * np.pi * freq * t)
     envelope = np.exp(-10 * t / duration)
     sound_data = (wave * envelope * 32767).astype(np.int16)
-    sound_array = np.column_stack((sound_data, sound_data))
-    sound = pygame.sndarray.make_sound(sound_array)
-    return sound
+    return np.column_stack((sound_data, sound_data))
 
-def generate_pickup_sound():
+def generate_pickup_sound(rng: np.random.Generator) -> np.ndarray:
     sample_rate = 44100
     duration = 0.1
     t = np.linspace(0, duration, int(sample_rate * duration), False)
@@ -471,191 +1685,1043 @@ def generate_pickup_sound():
     wave = np.sin(2 * np.pi * freq * t)
     envelope = np.exp(-10 * t / duration)
     sound_data = (wave * envelope * 32767).astype(np.int16)
-    sound_array = np.column_stack((sound_data, sound_data))
-    sound = pygame.sndarray.make_sound(sound_array)
-    return sound
-
-# Sound effects
-explosion_sound = generate_explosion_sound()
-shot_sound = generate_shot_sound()
-pickup_sound = generate_pickup_sound()
-
-# Game state
-player = Player(MAP_WIDTH * TILE_SIZE // 2, MAP_HEIGHT * TILE_SIZE // 2)
-enemies = []
-bullets = []
-particles = []
-items = []
-chests = []
-boss = None
-camera = Camera()
-game_map = Map()
-walls = game_map.get_walls()
-running = True
-game_over = False
-title_screen = True
-upgrade_menu_active = False
-upgrade_options = []
-selected_upgrade = 0
-paused = False
-pause_selection = 0
-boss_active = False
-
-def spawn_enemy():
-    while len(enemies) < MAX_ENEMIES and not boss_active:
-        x = random.randint(0, MAP_WIDTH - 1) * TILE_SIZE + TILE_SIZE // 2
-        y = random.randint(0, MAP_HEIGHT - 1) * TILE_SIZE + TILE_SIZE // 2
-        enemy_rect = pygame.Rect(x - 15, y - 15, 30, 30)
-        if not any(enemy_rect.colliderect(wall) for wall in walls) and math.hypot(x - player.pos[0], y - player.pos[1]) > 300:
-            enemy_type = random.choice(['drone', 'tank'])
-            enemy = Enemy(x, y, enemy_type)
-            enemy.health += player.level * 20
-            enemy.max_health = enemy.health
-            enemies.append(enemy)
-
-def spawn_boss():
-    global boss, enemies
-    enemies = []
-    x = random.randint(0, MAP_WIDTH - 1) * TILE_SIZE + TILE_SIZE // 2
-    y = random.randint(0, MAP_HEIGHT - 1) * TILE_SIZE + TILE_SIZE // 2
-    boss_rect = pygame.Rect(x - 25, y - 25, 50, 50)
-    while any(boss_rect.colliderect(wall) for wall in walls) or math.hypot(x - player.pos[0], y - player.pos[1]) < 500:
-        x = random.randint(0, MAP_WIDTH - 1) * TILE_SIZE + TILE_SIZE // 2
-        y = random.randint(0, MAP_HEIGHT - 1) * TILE_SIZE + TILE_SIZE // 2
-        boss_rect = pygame.Rect(x - 25, y - 25, 50, 50)
-    boss = Boss(x, y)
-
-def spawn_item(pos: Tuple[float, float]):
-    item_types = [
-        Item('Health Pack', 'health', 50, pos),
-        Item('Temp Health Boost', 'temp_health', 50, pos, {"duration": 600}),
-        Item('Armor', 'armor', 5, pos),
-        Item('Resource', 'resource', 2, pos),
-        Item('Shotgun Ammo', 'ammo', 20, pos, {"weapon": "Shotgun", "max_ammo": 100}),
-        Item('Sniper Ammo', 'ammo', 10, pos, {"weapon": "Sniper", "max_ammo": 50}),
-        Item('Laser Ammo', 'ammo', 30, pos, {"weapon": "Laser", "max_ammo": 150}),
-        Item('Grenade Ammo', 'ammo', 5, pos, {"weapon": "Grenade Launcher", "max_ammo": 20}),
-        Item('Flamethrower Ammo', 'ammo', 50, pos, {"weapon": "Flamethrower", "max_ammo": 200}),
-        Item('Plasma Ammo', 'ammo', 15, pos, {"weapon": "Plasma Rifle", "max_ammo": 80}),
-        Item('Rocket Ammo', 'ammo', 5, pos, {"weapon": "Rocket Launcher", "max_ammo": 15}),
-        Item('Freeze Ammo', 'ammo', 10, pos, {"weapon": "Freeze Shotgun", "max_ammo": 60}),
-    ]
-    items.append(random.choice(item_types))
-
-def spawn_chest():
-    x = random.randint(0, MAP_WIDTH - 1) * TILE_SIZE + TILE_SIZE // 2
-    y = random.randint(0, MAP_HEIGHT - 1) * TILE_SIZE + TILE_SIZE // 2
-    chest_rect = pygame.Rect(x - 10, y - 10, 20, 20)
-    if not any(chest_rect.colliderect(wall) for wall in walls) and math.hypot(x - player.pos[0], y - player.pos[1]) > 200:
-        weapon_types = [
-            Item('Shotgun', 'weapon', 0, (x, y), Weapon('Shotgun', 30, 20, 8, 0.2, 5, 50, 100)),
-            Item('Sniper', 'weapon', 0, (x, y), Weapon('Sniper', 50, 30, 12, 0.0, 1, 20, 50)),
-            Item('Laser', 'weapon', 0, (x, y), Weapon('Laser', 15, 5, 15, 0.0, 1, 100, 150)),
-            Item('Grenade Launcher', 'weapon', 0, (x, y), Weapon('Grenade Launcher', 80, 60, 6, 0.3, 1, 10, 20)),
-            Item('Flamethrower', 'weapon', 0, (x, y), Weapon('Flamethrower', 5, 3, 10, 0.4, 3, 150, 200)),
-            Item('Plasma Rifle', 'weapon', 0, (x, y), Weapon('Plasma Rifle', 25, 15, 10, 0.1, 2, 40, 80)),
-            Item('Rocket Launcher', 'weapon', 0, (x, y), Weapon('Rocket Launcher', 100, 90, 5, 0.4, 1, 8, 15)),
-            Item('Freeze Shotgun', 'weapon', 0, (x, y), Weapon('Freeze Shotgun', 20, 25, 7, 0.25, 6, 30, 60)),
-        ]
-        contents = random.sample([
-            Item('Health Pack', 'health', 50, (x, y)),
-            Item('Temp Health Boost', 'temp_health', 50, (x, y), {"duration": 600}),
-            Item('Armor', 'armor', 5, (x, y)),
-            *weapon_types
-        ], k=random.randint(1, 3))
-        chests.append(Chest(pos=(x, y), contents=contents))
-
-def create_explosion(pos: Tuple[float, float]):
-    for _ in range(10):
-        angle = random.random() * 2 * math.pi
-        speed = random.random() * 4
-        vel = (math.cos(angle) * speed, math.sin(angle) * speed)
-        color = random.choice([RED, YELLOW, WHITE])
-        size = random.uniform(2, 4)
-        particles.append(Particle(pos, vel, color, PARTICLE_LIFETIME, size))
-    explosion_sound.play()
-
-def draw_hud(surface: pygame.Surface):
-    pygame.draw.rect(surface, BLACK, (10, 10, 104, 24), 2)
+    return np.column_stack((sound_data, sound_data))
+
+SOUND_GENERATORS = {
+    'explosion': generate_explosion_sound,
+    'shot': generate_shot_sound,
+    'pickup': generate_pickup_sound,
+}
+
+def load_sound_arrays() -> Dict[str, np.ndarray]:
+    # Synthesis is seeded, so the samples are the same on every launch and can
+    # be cached in SOUND_CACHE_FILE. Bump SOUND_CACHE_VERSION when a generator
+    # changes. A missing, stale or unwritable cache just means synthesizing.
+    try:
+        with np.load(SOUND_CACHE_FILE) as cache:
+            if int(cache['version']) == SOUND_CACHE_VERSION:
+                return {name: cache[name] for name in SOUND_GENERATORS}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+    arrays = {name: generate(np.random.default_rng(SOUND_SEED)) for name, generate in SOUND_GENERATORS.items()}
+    try:
+        np.savez(SOUND_CACHE_FILE, version=SOUND_CACHE_VERSION, **arrays)
+    except OSError:
+        pass
+    return arrays
+
+def init_mixer():
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+
+def make_sound_variants(name: str) -> List[pygame.mixer.Sound]:
+    # One Sound per (pitch, volume) pair. Pitch is shifted by resampling, so
+    # higher variants are also a little shorter.
+    init_mixer()
+    samples = assets['sound_arrays'][name].astype(np.float32)
+    variants = []
+    for pitch in SOUND_PITCHES:
+        index = np.arange(0, len(samples) - 1, pitch)
+        shifted = np.column_stack([np.interp(index, np.arange(len(samples)), samples[:, c]) for c in range(samples.shape[1])])
+        for volume in SOUND_VOLUMES:
+            sound = pygame.sndarray.make_sound(np.ascontiguousarray(shifted.astype(np.int16)))
+            sound.set_volume(volume)
+            variants.append(sound)
+    return variants
+
+class AudioBank:
+    # Plays sound effects on a fixed pool of mixer channels. A sound is skipped
+    # if it played less than its SOUND_LIMITS gap ago; past its voice limit it
+    # replaces its own oldest voice, and with every channel busy it replaces
+    # the oldest voice of any sound.
+    def __init__(self, channels: int = AUDIO_CHANNELS):
+        init_mixer()
+        pygame.mixer.set_num_channels(channels)
+        self.channels = [pygame.mixer.Channel(i) for i in range(channels)]
+        self.names = [None] * channels
+        self.started = [0.0] * channels
+        self.last_played = {}
+        self.rng = random.Random(SOUND_SEED)
+
+    def play(self, name: str, now: Optional[float] = None) -> bool:
+        now = time.perf_counter() if now is None else now
+        min_gap, max_voices = SOUND_LIMITS[name]
+        if now - self.last_played.get(name, -math.inf) < min_gap:
+            return False
+        busy = [i for i, channel in enumerate(self.channels) if channel.get_busy()]
+        voices = [i for i in busy if self.names[i] == name]
+        if len(voices) >= max_voices:
+            index = min(voices, key=self.started.__getitem__)
+        elif len(busy) < len(self.channels):
+            index = next(i for i, channel in enumerate(self.channels) if not channel.get_busy())
+        else:
+            index = min(busy, key=self.started.__getitem__)
+        self.channels[index].play(self.rng.choice(assets['sound/' + name]))
+        self.names[index] = name
+        self.started[index] = now
+        self.last_played[name] = now
+        return True
+
+assets.register('sound_arrays', load_sound_arrays)
+for name in SOUND_GENERATORS:
+    assets.register('sound/' + name, lambda name=name: make_sound_variants(name))
+assets.register('audio', AudioBank)
+
+
+@dataclass
+class WorldStats:
+    # Running totals since the last reset, for balancing runs.
+    kills: int = 0
+    bosses: int = 0
+    damage_dealt: int = 0
+    damage_taken: int = 0
+
+class World:
+    # Headless simulation: all game state plus the tick logic. Rendering and
+    # audio are optional consumers that read the state after each step and
+    # play the sound names collected in self.events.
+    #
+    # There can be several players (see add_player); self.player is the first.
+    # Enemies go for the nearest living player, kills go to the player whose
+    # bullet landed, any player's level-up pauses everyone for their upgrade
+    # choice, and the game is over once every player is down.
+    def __init__(self, width: int = MAP_WIDTH, height: int = MAP_HEIGHT, max_enemies: int = MAX_ENEMIES, seed: Optional[int] = None):
+        # Every random draw of the simulation comes from these two generators,
+        # so the seed plus the inputs of each tick reproduce a session exactly.
+        self.seed = random.randrange(2 ** 32) if seed is None else seed
+        self.rng = random.Random(self.seed)
+        self.np_rng = np.random.default_rng(self.seed)
+        self.game_map = Map(self.rng, width, height)
+        self.max_enemies = max_enemies
+        self.collider = self.game_map.collider
+        self.pathfinder = Pathfinder(self.collider)
+        self.flow_field = FlowField(self.collider)
+        self.bullets = BulletPool()
+        self.particles = ParticleEmitter()
+        self.enemies = EnemyStore()
+        self.pickup_grid = SpatialHash()
+        self.loot = LOOT_TABLES  # read here, so it can be swapped for tuning runs
+        self.events = []
+        self.players = []
+        self.next_player_id = 1
+        self.reset()
+
+    @property
+    def player(self) -> Player:
+        return self.players[0]
+
+    def reset(self):
+        # Players are respawned in place, so references held elsewhere (the
+        # server's clients) stay valid across restarts.
+        spawn = (self.game_map.width * TILE_SIZE // 2, self.game_map.height * TILE_SIZE // 2)
+        for player in self.players:
+            player.respawn(*spawn)
+        if not self.players:
+            self.players = [Player(*spawn)]
+        self.collider.follow(self.player.pos)
+        self.enemies.clear()
+        self.items = []
+        self.chests = []
+        self.boss_active = False
+        self.game_over = False
+        self.upgrade_menu_active = False
+        self.upgrade_options = []
+        self.upgrade_player = 0  # index of the player choosing
+        self.stats = WorldStats()
+        self.bullets.clear()
+        self.particles.clear()
+        self.pickup_grid.clear()
+        self.tick = 0
+
+    def setup(self):
+        for player in self.players:
+            self.arm(player)
+        self.spawn_enemy()
+        self.spawn_chest()
+
+    def arm(self, player: Player):
+        player.inventory.add_item(Item(PISTOL, (0, 0)))
+
+    def add_player(self) -> Player:
+        # A new armed player at the spawn point, stepped with the Inputs after the existing players'.
+        player = Player(self.game_map.width * TILE_SIZE // 2, self.game_map.height * TILE_SIZE // 2, self.next_player_id)
+        self.next_player_id += 1
+        self.arm(player)
+        self.players.append(player)
+        return player
+
+    def remove_player(self, player: Player):
+        # The last player stays; an upgrade choice left open by the leaving player is dropped.
+        if len(self.players) < 2:
+            return
+        index = self.players.index(player)
+        del self.players[index]
+        if self.upgrade_menu_active and index == self.upgrade_player:
+            self.upgrade_menu_active = False
+            self.upgrade_options = []
+        if self.upgrade_player > index:
+            self.upgrade_player -= 1
+        self.game_over = all(player.health <= 0 for player in self.players)
+
+    def player_distance(self, x: float, y: float) -> float:
+        # Distance from (x, y) to the nearest player.
+        return min(math.hypot(x - player.pos[0], y - player.pos[1]) for player in self.players)
+
+    def restart(self):
+        self.game_map.generate_map(self.rng)
+        self.reset()
+        self.setup()
+
+    def random_tile_center(self) -> Tuple[int, int]:
+        # Spawns are placed inside the collider's active window.
+        collider = self.collider
+        x = self.rng.randint(collider.x0, collider.x0 + collider.width - 1)
+        y = self.rng.randint(collider.y0, collider.y0 + collider.height - 1)
+        return (x * TILE_SIZE + TILE_SIZE // 2, y * TILE_SIZE + TILE_SIZE // 2)
+
+    def spawn_position(self, half: int, min_distance: float) -> Tuple[int, int]:
+        # A random tile center where a 2 * half square is clear of walls and
+        # at least min_distance from every player. After SPAWN_ATTEMPTS misses
+        # (on maps too small for min_distance) the farthest such tile is used.
+        for _ in range(SPAWN_ATTEMPTS):
+            x, y = self.random_tile_center()
+            if not self.collider.collides(pygame.Rect(x - half, y - half, half * 2, half * 2)) \
+                    and self.player_distance(x, y) >= min_distance:
+                return x, y
+        return self.farthest_open_tile(half)
+
+    def farthest_open_tile(self, half: int) -> Tuple[int, int]:
+        # The open tile center in the active window farthest from the players
+        # that fits a 2 * half square; the farthest open one if none fits.
+        collider = self.collider
+        ys, xs = np.nonzero(~collider.solid)
+        centers = np.stack([xs + collider.x0, ys + collider.y0], axis=1) * TILE_SIZE + TILE_SIZE // 2
+        dist = np.min([np.hypot(*(centers - player.pos).T) for player in self.players], axis=0)
+        order = np.argsort(-dist, kind='stable')
+        for x, y in centers[order].tolist():
+            if not self.collider.collides(pygame.Rect(x - half, y - half, half * 2, half * 2)):
+                return x, y
+        return tuple(centers[order[0]].tolist())
+
+    def spawn_enemy(self):
+        level = max(player.level for player in self.players)
+        while len(self.enemies) < self.max_enemies and not self.boss_active:
+            x, y = self.spawn_position(15, 300)
+            code = self.rng.choice(WAVE_ENEMY_CODES)
+            fire_timer = self.rng.randint(0, ENEMY_TYPES[code].fire_rate)
+            self.enemies.spawn(code, x, y, level, fire_timer)
+
+    def spawn_boss(self):
+        self.enemies.clear()
+        x, y = self.spawn_position(ENEMY_TYPES[BOSS].half, 500)
+        self.enemies.spawn(BOSS, x, y, max(player.level for player in self.players))
+
+    def spawn_item(self, pos: Tuple[float, float], level: int):
+        item = Item(self.loot['drop'].draw(self.rng, level), pos)
+        self.items.append(item)
+        self.pickup_grid.insert(item, 10)
+
+    def spawn_chest(self):
+        x, y = self.random_tile_center()
+        chest_rect = pygame.Rect(x - 10, y - 10, 20, 20)
+        if not self.collider.collides(chest_rect) and self.player_distance(x, y) > 200:
+            level = max(player.level for player in self.players)
+            count = self.rng.randint(*CHEST_ITEMS)
+            contents = [Item(prototype, (x, y)) for prototype in self.loot['chest'].sample(self.rng, level, count)]
+            chest = Chest(pos=(x, y), contents=contents)
+            self.chests.append(chest)
+            self.pickup_grid.insert(chest, 10)
+
+    def create_explosion(self, pos: Tuple[float, float]):
+        self.particles.emit(pos, 10, self.np_rng)
+        self.events.append('explosion')
+
+    def award_exp(self, amount: int, player: Player):
+        for level in player.gain_exp(amount):
+            if level % 5 == 0 and not self.boss_active:
+                self.spawn_boss()
+                self.boss_active = True
+            else:
+                self.upgrade_menu_active = True
+                self.upgrade_player = self.players.index(player)
+                self.upgrade_options = player.get_upgrade_options(self.rng)
+
+    def step(self, *inputs: Inputs):
+        # One Inputs per player, in self.players order; players without one stand still.
+        inputs = list(inputs) + [Inputs()] * (len(self.players) - len(inputs))
+        self.events.clear()
+        if self.game_over:
+            if any(player_inputs.restart for player_inputs in inputs):
+                self.restart()
+            return
+        if self.upgrade_menu_active:
+            choice = inputs[self.upgrade_player].choose_upgrade
+            if not 0 <= choice < len(self.upgrade_options):
+                return
+            self.upgrade_options[choice]["effect"]()
+            self.upgrade_menu_active = False
+        self.tick += 1
+        self.collider.follow(self.player.pos)
+        for player in self.players:
+            player.prev_pos = player.pos[:]
+        enemies = self.enemies
+        enemies.prev[:enemies.count] = enemies.pos[:enemies.count]
+        with profiler.section('actions'):
+            for player, player_inputs in zip(self.players, inputs):
+                if player.health > 0:
+                    self._apply_actions(player, player_inputs)
+        with profiler.section('player'):
+            for player, player_inputs in zip(self.players, inputs):
+                if player.health > 0:
+                    self._update_player(player, player_inputs)
+        with profiler.section('enemies'):
+            self._update_enemies()
+        with profiler.section('bullets'):
+            self._update_bullets()
+        with profiler.section('particles'):
+            self.particles.update()
+
+        # Spawn new enemies and chests
+        if self.rng.random() < 0.005:
+            self.spawn_enemy()
+        if self.rng.random() < CHEST_SPAWN_RATE:
+            self.spawn_chest()
+
+    def _apply_actions(self, player: Player, inputs: Inputs):
+        player_rect = pygame.Rect(player.pos[0] - 10, player.pos[1] - 10, 20, 20)
+        if inputs.pickup:
+            for item in self.pickup_grid.query_rect(player_rect):
+                if isinstance(item, Item):
+                    if item.type in ["health", "temp_health", "armor", "ammo"]:
+                        player.apply_item(item)
+                    elif player.inventory.add_item(item):
+                        self.items.remove(item)
+                        self.pickup_grid.remove(item)
+                        self.events.append('pickup')
+        if inputs.open_chest:
+            for chest in self.pickup_grid.query_rect(player_rect):
+                if isinstance(chest, Chest):
+                    for item in chest.contents:
+                        if item.type in ["health", "temp_health", "armor", "ammo"]:
+                            player.apply_item(item)
+                        elif player.inventory.add_item(item):
+                            self.events.append('pickup')
+                    self.chests.remove(chest)
+                    self.pickup_grid.remove(chest)
+                    self.create_explosion(chest.pos)
+        inventory = player.inventory
+        if 0 <= inputs.select_weapon < len(inventory.weapons):
+            inventory.selected_weapon = inputs.select_weapon
+        if inputs.cycle_weapon:
+            inventory.selected_weapon = (inventory.selected_weapon + inputs.cycle_weapon) % len(inventory.weapons)
+
+    def _update_player(self, player: Player, inputs: Inputs):
+        player.update()
+        player.move(inputs, self.collider)
+        if inputs.fire and player.fire_timer <= 0:
+            fired = player.shoot(inputs.aim, self.bullets, self.rng)
+            player.fire_timer = player.inventory.get_weapon().fire_rate
+            if fired:
+                self.events.append('shot')
+        if player.fire_timer > 0:
+            player.fire_timer -= 1
+
+    def _update_enemies(self):
+        targets = [player.pos for player in self.players if player.health > 0]
+        self.pathfinder.begin_tick()
+        chase_field = None
+        if PATHFINDING_MODE == 'flow_field':
+            with profiler.section('flow_field'):
+                self.flow_field.update(targets)
+            chase_field = self.flow_field
+        self.enemies.update(np.array(targets, dtype=np.float64).reshape(-1, 2), self.bullets, self.pathfinder,
+                            self.rng, chase_field)
+
+    def _update_bullets(self):
+        bullets, enemies = self.bullets, self.enemies
+        for hit_pos in bullets.step(self.collider).tolist():
+            self.create_explosion(tuple(hit_pos))
+        shots = np.flatnonzero(bullets.alive[:bullets.count] & (bullets.owner[:bullets.count] == OWNER_PLAYER))
+        targets, pairs = enemies.first_hits(bullets.boxes()[shots])
+        profiler.count('collision_broad', len(shots))
+        profiler.count('collision_narrow', pairs)
+        hit = targets >= 0
+        bullets.alive[shots[hit]] = False
+        np.subtract.at(enemies.health, targets[hit], bullets.damage[shots[hit]])
+        self.stats.damage_dealt += int(bullets.damage[shots[hit]].sum())
+        # The kill goes to the shooter of one of the bullets that hit this tick.
+        killer = np.full(enemies.count, -1, dtype=np.int64)
+        killer[targets[hit]] = bullets.shooter[shots[hit]]
+        dead = np.flatnonzero(enemies.alive[:enemies.count] & (enemies.health[:enemies.count] <= 0))
+        if len(dead):
+            deaths = list(zip(enemies.type[dead].tolist(), enemies.pos[dead].tolist(), killer[dead].tolist()))
+            enemies.alive[dead] = False
+            enemies.compact()
+            self.stats.kills += len(deaths)
+            players = {player.id: player for player in self.players}
+            for code, pos, shooter in deaths:
+                enemy_type = ENEMY_TYPES[code]
+                if code == BOSS:
+                    self.boss_active = False
+                    self.stats.bosses += 1
+                player = players.get(shooter)
+                if player is not None:
+                    self.award_exp(enemy_type.exp + player.level * enemy_type.exp_per_level, player)
+                self.create_explosion(tuple(pos))
+                for _ in range(enemy_type.chests):
+                    self.spawn_chest()
+                if enemy_type.item_chance and self.rng.random() < enemy_type.item_chance:
+                    level = player.level if player is not None else max(player.level for player in self.players)
+                    self.spawn_item(tuple(pos), level)
+        for player in self.players:
+            if player.health <= 0:
+                continue
+            player_rect = pygame.Rect(player.pos[0] - 10, player.pos[1] - 10, 20, 20)
+            for owner in (OWNER_ENEMY, OWNER_BOSS):
+                for i in bullets.overlapping(player_rect, owner).tolist():
+                    bullets.alive[i] = False
+                    health = player.health
+                    player.take_damage(int(bullets.damage[i]))
+                    self.stats.damage_taken += health - player.health
+        if all(player.health <= 0 for player in self.players):
+            self.game_over = True
+        bullets.compact()
+
+    def snapshot(self) -> bytes:
+        # The whole simulation state between ticks, one section per
+        # SNAPSHOT_SECTIONS entry. Lookup structures and caches are left out;
+        # restore() rebuilds them.
+        header = SNAPSHOT_WORLD.pack(self.seed, self.game_map.width, self.game_map.height, self.max_enemies, self.tick,
+                                     self.collider.x0, self.collider.y0, self.boss_active, self.game_over,
+                                     self.upgrade_menu_active, self.upgrade_player, self.next_player_id,
+                                     self.stats.kills, self.stats.bosses, self.stats.damage_dealt, self.stats.damage_taken)
+        return join_sections(SNAPSHOT_MAGIC, [
+            header, self._pack_rng(), self._pack_players(), self._pack_objects(), self.enemies.pack(),
+            self.pathfinder.pack(), self.bullets.pack(), self.particles.pack(), self.game_map.pack(),
+        ])
+
+    def restore(self, data: bytes):
+        # Puts back a snapshot() of a world with the same map size; stepping
+        # on from it matches the world it was taken from tick for tick.
+        header, rng, players, objects, enemies, path_cache, bullets, particles, tiles = split_sections(data, SNAPSHOT_MAGIC)
+        (seed, width, height, max_enemies, tick, x0, y0, boss_active, game_over, upgrade_menu_active,
+         upgrade_player, next_player_id, *stats) = SNAPSHOT_WORLD.unpack(header)
+        if (width, height) != (self.game_map.width, self.game_map.height):
+            raise ValueError(f'snapshot is of a {width}x{height} map, not {self.game_map.width}x{self.game_map.height}')
+        self.seed, self.max_enemies, self.tick = seed, max_enemies, tick
+        self.boss_active, self.game_over, self.upgrade_menu_active = boss_active, game_over, upgrade_menu_active
+        self.upgrade_player, self.next_player_id = upgrade_player, next_player_id
+        self.stats = WorldStats(*stats)
+        self._unpack_rng(rng)
+        self.collider.x0, self.collider.y0 = x0, y0
+        self.game_map.unpack(tiles)
+        self.pathfinder.unpack(path_cache)
+        self._unpack_players(players)
+        self._unpack_objects(objects)
+        self.enemies.unpack(enemies)
+        self.bullets.unpack(bullets)
+        self.particles.unpack(particles)
+        self.events.clear()
+
+    def _pack_rng(self) -> bytes:
+        _, words, gauss = self.rng.getstate()
+        state = self.np_rng.bit_generator.state
+        return (SNAPSHOT_RNG.pack(gauss is not None, gauss or 0.0, state['has_uint32'], state['uinteger']) +
+                state['state']['state'].to_bytes(16, 'little') + state['state']['inc'].to_bytes(16, 'little') +
+                np.array(words, dtype=np.uint32).tobytes())
+
+    def _unpack_rng(self, data: bytes):
+        has_gauss, gauss, has_uint32, uinteger = SNAPSHOT_RNG.unpack_from(data)
+        offset = SNAPSHOT_RNG.size
+        words = np.frombuffer(data, np.uint32, offset=offset + 32)
+        self.rng.setstate((3, tuple(words.tolist()), gauss if has_gauss else None))
+        self.np_rng.bit_generator.state = {
+            'bit_generator': 'PCG64', 'has_uint32': has_uint32, 'uinteger': uinteger,
+            'state': {'state': int.from_bytes(data[offset:offset + 16], 'little'),
+                      'inc': int.from_bytes(data[offset + 16:offset + 32], 'little')},
+        }
+
+    def _pack_players(self) -> bytes:
+        rows = np.array([(player.pos, player.prev_pos, player.vel, player.speed, player.damage_modifier,
+                          *(getattr(player, name) for name in PLAYER_INT_FIELDS)) for player in self.players],
+                        dtype=SNAPSHOT_PLAYER)
+        return pack_rows([rows], len(rows))
+
+    def _unpack_players(self, data: bytes):
+        (rows,), _ = unpack_rows(data, [np.zeros(0, dtype=SNAPSHOT_PLAYER)])
+        self.players = []
+        for pos, prev_pos, vel, speed, damage_modifier, *values in rows.tolist():
+            player = Player(*pos)
+            player.prev_pos, player.vel = list(prev_pos), list(vel)
+            player.speed, player.damage_modifier = speed, damage_modifier
+            for name, value in zip(PLAYER_INT_FIELDS, values):
+                setattr(player, name, value)
+            self.players.append(player)
+
+    def _pack_objects(self) -> bytes:
+        # Items on the map, in inventories and in chests, the rest of each
+        # player's inventory and the upgrade menu. Text goes into a string
+        # table and weapons into a weapon table, referred to by index.
+        inventories = [player.inventory for player in self.players]
+        chest_items = [item for chest in self.chests for item in chest.contents]
+        items = self.items + [item for inventory in inventories for item in inventory.items] + chest_items
+        strings, weapons = {}, {}
+        carried = [weapon for inventory in inventories for weapon in inventory.weapons]
+        for weapon in carried + [item.stats for item in items if isinstance(item.stats, Weapon)]:
+            weapons.setdefault(id(weapon), (len(weapons), weapon))
+
+        def ref(text: str) -> int:
+            return strings.setdefault(text, len(strings))
+
+        weapon_rows = np.array([(ref(weapon.name), weapon.damage, weapon.fire_rate, weapon.speed, weapon.spread,
+                                 weapon.bullet_count, weapon.ammo, weapon.max_ammo)
+                                for _, weapon in weapons.values()], dtype=SNAPSHOT_WEAPON)
+        item_rows = []
+        for item in items:
+            if isinstance(item.stats, Weapon):
+                stats = (ITEM_STATS_WEAPON, weapons[id(item.stats)][0])
+            elif item.stats is not None:
+                stats = (ITEM_STATS_DICT, ref(json.dumps(dict(item.stats))))
+            else:
+                stats = (ITEM_STATS_NONE, 0)
+            item_rows.append((ref(item.name), ref(item.type), item.value, item.pos, *stats))
+        item_rows = np.array(item_rows, dtype=SNAPSHOT_ITEM)
+        chest_rows = np.array([(chest.pos, len(chest.contents)) for chest in self.chests], dtype=SNAPSHOT_CHEST)
+        inventory_rows = np.array([(len(inventory.items), inventory.capacity, inventory.selected_weapon,
+                                    len(inventory.weapons), len(inventory.ammo)) for inventory in inventories],
+                                  dtype=SNAPSHOT_INVENTORY)
+        carried = np.array([weapons[id(weapon)][0] for weapon in carried], dtype=np.uint32)
+        ammo_rows = np.array([(ref(name), ammo) for inventory in inventories for name, ammo in inventory.ammo.items()],
+                             dtype=SNAPSHOT_AMMO)
+        upgrades = np.array([ref(option['name']) for option in self.upgrade_options], dtype=np.uint32)
+        text = np.frombuffer('\n'.join(strings).encode(), dtype=np.uint8)
+        return ROW_COUNT.pack(len(self.items)) + b''.join(
+            pack_rows([rows], len(rows))
+            for rows in (text, weapon_rows, item_rows, chest_rows, inventory_rows, carried, ammo_rows, upgrades))
+
+    def _unpack_objects(self, data: bytes):
+        map_items, = ROW_COUNT.unpack_from(data)
+        offset = ROW_COUNT.size
+        tables = []
+        for dtype in (np.uint8, SNAPSHOT_WEAPON, SNAPSHOT_ITEM, SNAPSHOT_CHEST, SNAPSHOT_INVENTORY, np.uint32,
+                      SNAPSHOT_AMMO, np.uint32):
+            (rows,), offset = unpack_rows(data, [np.zeros(0, dtype=dtype)], offset)
+            tables.append(rows.tolist())
+        text, weapon_rows, item_rows, chest_rows, inventory_rows, carried, ammo_rows, upgrades = tables
+        strings = bytes(text).decode().split('\n')
+        weapons = [shared_weapon(Weapon(strings[name], *stats)) for name, *stats in weapon_rows]
+        items = []
+        for name, kind, value, pos, stats_kind, stats in item_rows:
+            if stats_kind == ITEM_STATS_WEAPON:
+                stats = weapons[stats]
+            elif stats_kind == ITEM_STATS_DICT:
+                stats = read_only(json.loads(strings[stats]))
+            else:
+                stats = None
+            items.append(Item(shared_item_type(ItemType(strings[name], strings[kind], value, stats)), tuple(pos)))
+        self.items = items[:map_items]
+        start, carried_start, ammo_start = map_items, 0, 0
+        for player, (count, capacity, selected_weapon, weapon_count, ammo_count) in zip(self.players, inventory_rows):
+            inventory = player.inventory
+            inventory.items = items[start:start + count]
+            inventory.capacity, inventory.selected_weapon = capacity, selected_weapon
+            inventory.weapons = [weapons[i] for i in carried[carried_start:carried_start + weapon_count]]
+            inventory.ammo = {strings[name]: ammo for name, ammo in ammo_rows[ammo_start:ammo_start + ammo_count]}
+            start, carried_start, ammo_start = start + count, carried_start + weapon_count, ammo_start + ammo_count
+        self.chests = []
+        for pos, contents in chest_rows:
+            self.chests.append(Chest(tuple(pos), items[start:start + contents]))
+            start += contents
+        options = {option['name']: option for option in self.players[self.upgrade_player].upgrades()}
+        self.upgrade_options = [options[strings[name]] for name in upgrades]
+        self.pickup_grid.clear()
+        for obj in self.items + self.chests:
+            self.pickup_grid.insert(obj, 10)
+
+@dataclass
+class Replay:
+    # A recorded session: how its World was built plus the inputs of every tick.
+    seed: int
+    width: int
+    height: int
+    max_enemies: int
+    pathfinding: str
+    inputs: List[Inputs]
+
+REPLAY_MAGIC = b'SGRP'
+REPLAY_VERSION = 4
+# magic, version, pathfinding mode, seed, width, height, max_enemies, ticks
+REPLAY_HEADER = struct.Struct('<4sBBIHHHI')
+# button flags, aim x, aim y, select_weapon, cycle_weapon, choose_upgrade
+REPLAY_TICK = struct.Struct('<Biibbb')
+REPLAY_FLAGS = ('up', 'down', 'left', 'right', 'fire', 'pickup', 'open_chest', 'restart')
+PATHFINDING_MODES = ('flow_field', 'a_star')
+
+def pack_inputs(inputs: Inputs) -> bytes:
+    # One REPLAY_TICK record; aim must be in whole pixels.
+    flags = 0
+    for bit, name in enumerate(REPLAY_FLAGS):
+        if getattr(inputs, name):
+            flags |= 1 << bit
+    return REPLAY_TICK.pack(flags, inputs.aim[0], inputs.aim[1], inputs.select_weapon,
+                            max(-128, min(127, inputs.cycle_weapon)), inputs.choose_upgrade)
+
+def unpack_inputs(flags: int, aim_x: int, aim_y: int, select_weapon: int, cycle_weapon: int,
+                  choose_upgrade: int) -> Inputs:
+    # The Inputs of one REPLAY_TICK record, given its unpacked fields.
+    buttons = {name: bool(flags >> bit & 1) for bit, name in enumerate(REPLAY_FLAGS)}
+    return Inputs(aim=(aim_x, aim_y), select_weapon=select_weapon, cycle_weapon=cycle_weapon,
+                  choose_upgrade=choose_upgrade, **buttons)
+
+class ReplayRecorder:
+    # Packs the inputs of every World.step into 12-byte REPLAY_TICK records;
+    # save() zlib-compresses them behind a REPLAY_HEADER. aim is stored in
+    # whole pixels, so the world must be stepped with integer aims for the
+    # replay to match.
+    def __init__(self, world: World):
+        self.world_args = (world.seed, world.game_map.width, world.game_map.height, world.max_enemies)
+        self.pathfinding = PATHFINDING_MODE
+        self.data = bytearray()
+        self.ticks = 0
+
+    def record(self, inputs: Inputs):
+        self.data += pack_inputs(inputs)
+        self.ticks += 1
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, PATHFINDING_MODES.index(self.pathfinding),
+                                       *self.world_args, self.ticks))
+            f.write(zlib.compress(bytes(self.data)))
+
+    def truncate(self, ticks: int):
+        # Forgets the inputs after the first ticks, when the world is rewound.
+        del self.data[ticks * REPLAY_TICK.size:]
+        self.ticks = ticks
+
+def load_replay(path: str) -> Replay:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < REPLAY_HEADER.size:
+        raise ValueError(f'{path} is not a replay')
+    magic, version, pathfinding, seed, width, height, max_enemies, ticks = REPLAY_HEADER.unpack_from(data)
+    if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+        raise ValueError(f'{path} is not a version {REPLAY_VERSION} replay')
+    records = zlib.decompress(data[REPLAY_HEADER.size:])
+    if len(records) != ticks * REPLAY_TICK.size:
+        raise ValueError(f'{path} is truncated')
+    inputs = [unpack_inputs(*record) for record in REPLAY_TICK.iter_unpack(records)]
+    return Replay(seed, width, height, max_enemies, PATHFINDING_MODES[pathfinding], inputs)
+
+def replay_world(replay: Replay) -> World:
+    # The world as it was before the first recorded tick; run it with
+    # PATHFINDING_MODE set to replay.pathfinding.
+    world = World(replay.width, replay.height, replay.max_enemies, replay.seed)
+    world.setup()
+    return world
+
+SNAPSHOT_MAGIC = b'SGSS'
+DELTA_MAGIC = b'SGSD'
+SNAPSHOT_VERSION = 2
+# magic, version, section count; each section follows as a uint32 length and its bytes
+SNAPSHOT_HEADER = struct.Struct('<4sBB')
+SNAPSHOT_SECTIONS = ('world', 'rng', 'players', 'objects', 'enemies', 'path_cache', 'bullets', 'particles', 'tiles')
+# seed, map width, height, max_enemies, tick, collider origin, boss_active, game_over, upgrade_menu_active,
+# upgrade_player, next_player_id, stats
+SNAPSHOT_WORLD = struct.Struct('<5I2i3?2I4q')
+# has gauss_next, gauss_next, has_uint32, uinteger; then the PCG64 state and increment and the Mersenne Twister words
+SNAPSHOT_RNG = struct.Struct('<?diI')
+PLAYER_INT_FIELDS = ('id', 'health', 'max_health', 'level', 'exp', 'exp_to_next', 'resources', 'fire_timer', 'armor',
+                     'regen_timer', 'regen_rate', 'temp_health_boost', 'temp_health_timer')
+SNAPSHOT_PLAYER = np.dtype([('pos', np.float64, (2,)), ('prev_pos', np.float64, (2,)), ('vel', np.float64, (2,)),
+                            ('speed', np.float64), ('damage_modifier', np.float64)]
+                           + [(name, np.int64) for name in PLAYER_INT_FIELDS])
+# per player: item, weapon and ammo counts into the flattened tables that follow
+SNAPSHOT_INVENTORY = np.dtype([('items', np.uint32), ('capacity', np.uint32), ('selected_weapon', np.uint32),
+                               ('weapons', np.uint32), ('ammo', np.uint32)])
+SNAPSHOT_WEAPON = np.dtype([('name', np.uint32), ('damage', np.int64), ('fire_rate', np.int64), ('speed', np.float64),
+                            ('spread', np.float64), ('bullet_count', np.int64), ('ammo', np.int64), ('max_ammo', np.int64)])
+SNAPSHOT_ITEM = np.dtype([('name', np.uint32), ('type', np.uint32), ('value', np.int64), ('pos', np.float64, (2,)),
+                          ('stats_kind', np.uint8), ('stats', np.uint32)])
+SNAPSHOT_CHEST = np.dtype([('pos', np.float64, (2,)), ('contents', np.uint32)])
+SNAPSHOT_AMMO = np.dtype([('weapon', np.uint32), ('ammo', np.int64)])
+ITEM_STATS_NONE, ITEM_STATS_WEAPON, ITEM_STATS_DICT = range(3)
+DELTA_SAME, DELTA_XOR, DELTA_FULL = range(3)
+
+def join_sections(magic: bytes, sections: List[bytes]) -> bytes:
+    return SNAPSHOT_HEADER.pack(magic, SNAPSHOT_VERSION, len(sections)) + b''.join(
+        ROW_COUNT.pack(len(section)) + section for section in sections)
+
+def split_sections(data: bytes, magic: bytes) -> List[memoryview]:
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError('not a snapshot')
+    found, version, count = SNAPSHOT_HEADER.unpack_from(data)
+    if found != magic or version != SNAPSHOT_VERSION or count != len(SNAPSHOT_SECTIONS):
+        raise ValueError(f'not a version {SNAPSHOT_VERSION} snapshot')
+    view = memoryview(data)
+    sections = []
+    offset = SNAPSHOT_HEADER.size
+    for _ in range(count):
+        size, = ROW_COUNT.unpack_from(data, offset)
+        offset += ROW_COUNT.size
+        if offset + size > len(data):
+            raise ValueError('snapshot is truncated')
+        sections.append(view[offset:offset + size])
+        offset += size
+    return sections
+
+def snapshot_delta(keyframe: bytes, snapshot: bytes) -> bytes:
+    # Each section is either unchanged, XORed with the keyframe's section when
+    # both have the same size (unchanged bytes become zeros), or stored whole.
+    # zlib then squeezes out the zeros.
+    parts = []
+    for old, new in zip(split_sections(keyframe, SNAPSHOT_MAGIC), split_sections(snapshot, SNAPSHOT_MAGIC)):
+        if new == old:
+            parts.append(bytes((DELTA_SAME,)))
+        elif len(new) == len(old):
+            parts.append(bytes((DELTA_XOR,)) + (np.frombuffer(new, np.uint8) ^ np.frombuffer(old, np.uint8)).tobytes())
+        else:
+            parts.append(bytes((DELTA_FULL,)) + new)
+    return zlib.compress(join_sections(DELTA_MAGIC, parts), 1)
+
+def apply_delta(keyframe: bytes, delta: bytes) -> bytes:
+    # The snapshot that snapshot_delta(keyframe, snapshot) was made from.
+    sections = []
+    for old, part in zip(split_sections(keyframe, SNAPSHOT_MAGIC), split_sections(zlib.decompress(delta), DELTA_MAGIC)):
+        kind, body = part[0], part[1:]
+        if kind == DELTA_SAME:
+            sections.append(old)
+        elif kind == DELTA_XOR:
+            sections.append((np.frombuffer(body, np.uint8) ^ np.frombuffer(old, np.uint8)).tobytes())
+        else:
+            sections.append(body)
+    return join_sections(SNAPSHOT_MAGIC, sections)
+
+class SnapshotHistory:
+    # The last HISTORY_SECONDS of a world, one snapshot every
+    # SNAPSHOT_INTERVAL ticks. Every KEYFRAME_INTERVAL-th snapshot is kept
+    # whole (zlib-compressed) and the ones in between as deltas against it.
+    # Entries carry a mark chosen by the caller; the frontend uses its replay
+    # length so a rewind can cut the replay too.
+    def __init__(self, seconds: float = HISTORY_SECONDS):
+        self.entries = deque(maxlen=max(1, int(seconds * TICK_RATE) // SNAPSHOT_INTERVAL))
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.keyframe = None  # uncompressed, what the next deltas are taken against
+        self.packed_keyframe = None
+        self.since_keyframe = 0
+        self.last_tick = -1
+
+    def nbytes(self) -> int:
+        keyframes = {id(keyframe): len(keyframe) for _, _, keyframe, _ in self.entries}
+        return sum(keyframes.values()) + sum(len(delta) for _, _, _, delta in self.entries if delta)
+
+    def record(self, world: World, mark: int = 0):
+        # Call after every step; a world that went back in time (restart) starts a new history.
+        if world.tick < self.last_tick:
+            self.clear()
+        if world.tick == self.last_tick or world.tick % SNAPSHOT_INTERVAL:
+            return
+        self.last_tick = world.tick
+        with profiler.section('snapshot'):
+            data = world.snapshot()
+            if self.keyframe is None or self.since_keyframe >= KEYFRAME_INTERVAL:
+                self.keyframe = data
+                self.packed_keyframe = zlib.compress(data, 1)
+                self.since_keyframe = 0
+                delta = None
+            else:
+                delta = snapshot_delta(self.keyframe, data)
+            self.since_keyframe += 1
+            self.entries.append((world.tick, mark, self.packed_keyframe, delta))
+
+    def rewind(self, tick: int) -> Optional[Tuple[bytes, int]]:
+        # The newest snapshot taken at or before tick and its mark. Newer
+        # entries are dropped; None when the history does not reach back that far.
+        while self.entries and self.entries[-1][0] > tick:
+            self.entries.pop()
+        if not self.entries:
+            self.clear()
+            return None
+        entry_tick, mark, keyframe, delta = self.entries[-1]
+        data = zlib.decompress(keyframe)
+        if delta is not None:
+            data = apply_delta(data, delta)
+        self.keyframe = None
+        self.last_tick = entry_tick
+        return data, mark
+
+class TextCache:
+    # LRU cache of rendered text surfaces keyed by (font, text, color, antialias).
+    def __init__(self, capacity: int = TEXT_CACHE_SIZE):
+        self.capacity = capacity
+        self.surfaces = OrderedDict()
+
+    def render(self, font: pygame.font.Font, text: str, color: Tuple[int, int, int], antialias: bool = True) -> pygame.Surface:
+        key = (font, text, color, antialias)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = self.surfaces[key] = render_backend.convert(font.render(text, antialias, color))
+            if len(self.surfaces) > self.capacity:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+class TextWidget:
+    # A HUD line bound to some values; the text is only formatted and looked
+    # up again when one of them changes.
+    def __init__(self, template: str, color: Tuple[int, int, int] = WHITE):
+        self.template = template
+        self.color = color
+        self._key = None
+        self._surface = None
+
+    def render(self, font: pygame.font.Font, *values) -> pygame.Surface:
+        key = (font, values)
+        if key != self._key:
+            self._key = key
+            self._surface = text_cache.render(font, self.template.format(*values), self.color)
+        return self._surface
+
+text_cache = TextCache()
+resource_widget = TextWidget('Resources: {}/100')
+level_widget = TextWidget('Level: {} (EXP: {}/{})')
+weapon_widget = TextWidget('Weapon: {} (DMG: {}, Ammo: {})')
+minimap_layer = Minimap()
+
+def lerp_pos(entity, alpha: float) -> Tuple[float, float]:
+    # Position between the previous and the current tick for smooth drawing.
+    prev, pos = entity.prev_pos, entity.pos
+    return (prev[0] + (pos[0] - prev[0]) * alpha, prev[1] + (pos[1] - prev[1]) * alpha)
+
+def draw_world(surface: pygame.Surface, world: World, camera: Camera, mouse_pos: Tuple[int, int], alpha: float = 1.0,
+               dirty: Optional[List[pygame.Rect]] = None):
+    # With dirty given, the screen areas of everything but the map are added
+    # to it; the map only changes with the camera or the tiles.
+    with profiler.section('map'):
+        world.game_map.draw(surface, camera)
+
+    # Draw items and chests: only those the pickup grid finds in view.
+    batch = []
+    for obj in world.pickup_grid.query_rect(camera.view_rect()):
+        x, y = obj.pos[0] - camera.offset[0], obj.pos[1] - camera.offset[1]
+        if isinstance(obj, Chest):
+            batch.append((assets['chest'], (x - 10, y - 10)))
+        else:
+            batch.append((assets['health'] if obj.type in ["health", "temp_health"] else assets['item'], (x - 5, y - 5)))
+    blit_batch(surface, batch, dirty)
+
+    # Draw players; the aim line is the local player's, world.player
+    sprite = assets['player']
+    batch = []
+    for player in world.players:
+        if player.health > 0 or player is world.player:
+            pos = lerp_pos(player, alpha)
+            batch.append((sprite, (pos[0] - camera.offset[0] - 10, pos[1] - camera.offset[1] - 10)))
+    blit_batch(surface, batch, dirty)
+    pos = lerp_pos(world.player, alpha)
+    player_screen_pos = (pos[0] - camera.offset[0], pos[1] - camera.offset[1])
+
+    # Draw enemies on screen, each followed by its health bar, in one batch.
+    # The bar is 10 pixels narrower than the sprite and sits 10 pixels above it.
+    enemies = world.enemies
+    n = enemies.count
+    prev = enemies.prev[:n]
+    screen_pos = prev + (enemies.pos[:n] - prev) * alpha - camera.offset
+    shown = np.flatnonzero(on_screen(screen_pos))
+    sprites = [assets[enemy_type.name] for enemy_type in ENEMY_TYPES]
+    back, fill = assets['bar_back'], assets['bar_fill']
+    batch = []
+    for code, (x, y), health, max_health in zip(enemies.type[shown].tolist(), screen_pos[shown].tolist(),
+                                                enemies.health[shown].tolist(), enemies.max_health[shown].tolist()):
+        half = ENEMY_TYPES[code].half
+        bar = half * 2 - 10
+        bar_pos = (int(x - bar / 2), int(y - half - 10))
+        batch.append((sprites[code], (x - half, y - half)))
+        batch.append((back, bar_pos, (0, 0, bar, 5)))
+        batch.append((fill, bar_pos, (0, 0, int(health / max_health * bar), 5)))
+    blit_batch(surface, batch, dirty)
+
+    # Draw bullets on screen
+    bullets = world.bullets
+    n = bullets.count
+    screen_pos = bullets.pos[:n] - bullets.vel[:n] * (1 - alpha) - camera.offset
+    sprite = assets['bullet']
+    blit_batch(surface, [(sprite, (x - 3, y - 3)) for x, y in screen_pos[on_screen(screen_pos)].tolist()], dirty)
+
+    # Draw particles
+    with profiler.section('particles_draw'):
+        world.particles.draw(surface, camera, alpha, dirty)
+
+    # Draw aim line
+    dx = mouse_pos[0] - player_screen_pos[0]
+    dy = mouse_pos[1] - player_screen_pos[1]
+    angle = math.atan2(dy, dx)
+    end_pos = (player_screen_pos[0] + math.cos(angle) * 50, player_screen_pos[1] + math.sin(angle) * 50)
+    line = pygame.draw.line(surface, WHITE, player_screen_pos, end_pos, 1)
+    if dirty is not None:
+        dirty.append(line)
+
+def draw_hud(surface: pygame.Surface, world: World, dirty: Optional[List[pygame.Rect]] = None):
+    # With dirty given, the areas drawn to are added to it.
+    player = world.player
+    frame = pygame.draw.rect(surface, BLACK, (10, 10, 104, 24), 2)
     health_width = (player.health / (player.max_health + player.temp_health_boost)) * 100
     pygame.draw.rect(surface, GREEN, (12, 12, health_width, 20))
     
-    resource_text = font.render(f'Resources: {player.resources}/100', True, WHITE)
-    level_text = font.render(f'Level: {player.level} (EXP: {player.exp}/{player.exp_to_next})', True, WHITE)
-    surface.blit(resource_text, (10, 40))
-    surface.blit(level_text, (10, 60))
+    resource_text = resource_widget.render(assets['font'], player.resources)
+    level_text = level_widget.render(assets['font'], player.level, player.exp, player.exp_to_next)
+    batch = [(resource_text, (10, 40)), (level_text, (10, 60))]
     
     weapon = player.inventory.get_weapon()
-    ammo_text = font.render(f'Weapon: {weapon.name} (DMG: {weapon.damage}, Ammo: {player.inventory.ammo.get(weapon.name, "∞")})', True, WHITE)
-    surface.blit(ammo_text, (10, 80))
+    ammo_text = weapon_widget.render(assets['font'], weapon.name, weapon.damage, player.inventory.ammo.get(weapon.name, "∞"))
+    batch.append((ammo_text, (10, 80)))
     
-    inventory_text = font.render('Inventory:', True, WHITE)
-    surface.blit(inventory_text, (SCREEN_WIDTH - 150, 10))
+    inventory_text = text_cache.render(assets['font'], 'Inventory:', WHITE)
+    batch.append((inventory_text, (SCREEN_WIDTH - 150, 10)))
     for i, item in enumerate(player.inventory.items):
-        item_text = font.render(f'{item.name} ({item.type})', True, WHITE)
-        surface.blit(item_text, (SCREEN_WIDTH - 150, 30 + i * 20))
+        item_text = text_cache.render(assets['font'], f'{item.name} ({item.type})', WHITE)
+        batch.append((item_text, (SCREEN_WIDTH - 150, 30 + i * 20)))
+    blit_batch(surface, batch, dirty)
     
-    minimap_size = 100
-    minimap = pygame.Surface((minimap_size, minimap_size))
-    minimap.fill(BLACK)
-    scale = minimap_size / (MAP_WIDTH * TILE_SIZE)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            if game_map.tiles[y][x] == 1:
-                pygame.draw.rect(minimap, GRAY, (x * scale * TILE_SIZE, y * scale * TILE_SIZE, scale * TILE_SIZE, scale * TILE_SIZE))
-    pygame.draw.rect(minimap, GREEN, (player.pos[0] * scale - 2, player.pos[1] * scale - 2, 4, 4))
-    for enemy in enemies:
-        pygame.draw.rect(minimap, RED, (enemy.pos[0] * scale - 2, enemy.pos[1] * scale - 2, 4, 4))
-    for chest in chests:
-        pygame.draw.rect(minimap, PURPLE, (chest.pos[0] * scale - 2, chest.pos[1] * scale - 2, 4, 4))
-    if boss:
-        pygame.draw.rect(minimap, CYAN, (boss.pos[0] * scale - 2, boss.pos[1] * scale - 2, 4, 4))
-    surface.blit(minimap, (SCREEN_WIDTH - minimap_size - 10, SCREEN_HEIGHT - minimap_size - 10))
+    minimap_size = minimap_layer.size
+    collider = world.collider
+    minimap = minimap_layer.render(collider)
+    enemies = world.enemies
+    markers = ([(other.pos, WHITE) for other in world.players if other is not player and other.health > 0] +
+               [(player.pos, GREEN)] + [(chest.pos, PURPLE) for chest in world.chests] +
+               [(pos, ENEMY_TYPES[code].marker) for code, pos in zip(enemies.type[:enemies.count].tolist(), enemies.pos[:enemies.count].tolist())])
+    for pos, color in markers:
+        x, y = minimap_layer.to_minimap(pos, collider)
+        pygame.draw.rect(minimap, color, (x - 2, y - 2, 4, 4))
+    area = surface.blit(minimap, (SCREEN_WIDTH - minimap_size - 10, SCREEN_HEIGHT - minimap_size - 10))
+    if dirty is not None:
+        dirty += [frame, area]
+
+class ProfilerOverlay:
+    # Panel with the rolling profiler breakdown. It is only re-rendered every
+    # PROFILE_OVERLAY_REFRESH frames so that it barely shows up in the numbers.
+    def __init__(self):
+        self._panel = None
+        self._frames_left = 0
+
+    def draw(self, surface: pygame.Surface, profiler: Profiler) -> pygame.Rect:
+        self._frames_left -= 1
+        if self._panel is None or self._frames_left <= 0:
+            self._panel = self._render(profiler)
+            self._frames_left = PROFILE_OVERLAY_REFRESH
+        return surface.blit(self._panel, (10, SCREEN_HEIGHT - self._panel.get_height() - 10))
+
+    def _render(self, profiler: Profiler) -> pygame.Surface:
+        lines = [f'Profiler: {len(profiler.frames)} frames (F3 hide, F4 export)']
+        lines += [f'{name}: p50 {p50:.2f} ms  p99 {p99:.2f} ms' for name, p50, p99 in profiler.summary()]
+        if profiler.frames:
+            lines += [f'{name}: {value}' for name, value in sorted(profiler.frames[-1][1].items())]
+        font = assets['small_font']
+        line_height = font.get_linesize()
+        panel = pygame.Surface((300, len(lines) * line_height + 8), pygame.SRCALPHA)
+        panel.fill((0, 0, 0, 170))
+        for i, line in enumerate(lines):
+            panel.blit(font.render(line, True, WHITE), (6, 4 + i * line_height))
+        return render_backend.convert(panel)
+
+profiler_overlay = ProfilerOverlay()
 
 def draw_title_screen(surface: pygame.Surface):
     surface.fill(BLACK)
-    title = title_font.render("Space Survivor", True, WHITE)
-    story = font.render("You are the last survivor on a derelict space station.", True, WHITE)
-    story2 = font.render("Fight enemies, collect resources, and defeat the Core.", True, WHITE)
-    controls = font.render("WASD: Move | Mouse: Aim/Shoot | E: Items | Q: Chests | 1-3/Scroll: Switch Weapon | ESC: Pause", True, WHITE)
-    start = font.render("Press SPACE to start", True, WHITE)
+    title = text_cache.render(assets['title_font'], "Space Survivor", WHITE)
+    story = text_cache.render(assets['font'], "You are the last survivor on a derelict space station.", WHITE)
+    story2 = text_cache.render(assets['font'], "Fight enemies, collect resources, and defeat the Core.", WHITE)
+    controls = text_cache.render(assets['font'], "WASD: Move | Mouse: Aim/Shoot | E: Items | Q: Chests | 1-3/Scroll: Switch Weapon | ESC: Pause", WHITE)
+    start = text_cache.render(assets['font'], "Press SPACE to start", WHITE)
     surface.blit(title, (SCREEN_WIDTH // 2 - title.get_width() // 2, 100))
     surface.blit(story, (SCREEN_WIDTH // 2 - story.get_width() // 2, 200))
     surface.blit(story2, (SCREEN_WIDTH // 2 - story2.get_width() // 2, 230))
     surface.blit(controls, (SCREEN_WIDTH // 2 - controls.get_width() // 2, 300))
     surface.blit(start, (SCREEN_WIDTH // 2 - start.get_width() // 2, 400))
 
-def draw_upgrade_menu(surface: pygame.Surface):
+def draw_upgrade_menu(surface: pygame.Surface, upgrade_options: List[dict]):
     surface.fill(BLACK)
-    title = title_font.render("Choose an Upgrade", True, WHITE)
+    title = text_cache.render(assets['title_font'], "Choose an Upgrade", WHITE)
     surface.blit(title, (SCREEN_WIDTH // 2 - title.get_width() // 2, 100))
     for i, option in enumerate(upgrade_options):
         color = YELLOW if i == selected_upgrade else WHITE
-        text = font.render(option["name"], True, color)
+        text = text_cache.render(assets['font'], option["name"], color)
         surface.blit(text, (SCREEN_WIDTH // 2 - text.get_width() // 2, 200 + i * 40))
-    prompt = font.render("Use UP/DOWN to select, ENTER to confirm", True, WHITE)
+    prompt = text_cache.render(assets['font'], "Use UP/DOWN to select, ENTER to confirm", WHITE)
     surface.blit(prompt, (SCREEN_WIDTH // 2 - prompt.get_width() // 2, 400))
 
 def draw_pause_menu(surface: pygame.Surface):
     surface.fill(BLACK)
-    title = title_font.render("Paused", True, WHITE)
+    title = text_cache.render(assets['title_font'], "Paused", WHITE)
     options = ["Continue", "Exit"]
     surface.blit(title, (SCREEN_WIDTH // 2 - title.get_width() // 2, 200))
     for i, option in enumerate(options):
         color = YELLOW if i == pause_selection else WHITE
-        text = font.render(option, True, color)
+        text = text_cache.render(assets['font'], option, color)
         surface.blit(text, (SCREEN_WIDTH // 2 - text.get_width() // 2, 300 + i * 40))
-    prompt = font.render("Use UP/DOWN to select, ENTER to confirm", True, WHITE)
+    prompt = text_cache.render(assets['font'], "Use UP/DOWN to select, ENTER to confirm", WHITE)
     surface.blit(prompt, (SCREEN_WIDTH // 2 - prompt.get_width() // 2, 400))
 
-def setup():
-    player.inventory.add_item(Item('Pistol', 'weapon', 0, (0, 0), Weapon('Pistol', 10, 10, 10, 0.0, 1, -1, -1)))
-    spawn_enemy()
-    spawn_chest()
+def init_display():
+    # Only what the first title frame needs; the mixer starts with the first sound.
+    global screen
+    pygame.display.init()
+    pygame.font.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH, SCREEN_HEIGHT))
+    pygame.display.set_caption("Space Survivor")
+
+# Frontend state
+world = None
+recorder = None
+history = SnapshotHistory()
+quick_save = None  # (snapshot, replay length) taken with F5
+camera = Camera()
+running = True
+title_screen = True
+selected_upgrade = 0
+paused = False
+pause_selection = 0
+
+def new_world() -> World:
+    # Every world the frontend plays is recorded from its first tick; F6 saves it.
+    global recorder, quick_save
+    new = World()
+    recorder = ReplayRecorder(new)
+    history.clear()
+    quick_save = None
+    return new
+
+def load_state(data: bytes, mark: int):
+    # Restores a snapshot into the running world and cuts the replay back to
+    # the inputs that led to it.
+    world.restore(data)
+    recorder.truncate(mark)
+
+def next_inputs(inputs: Inputs) -> Inputs:
+    # Held controls carry over to the next tick; one-shot actions do not.
+    return Inputs(up=inputs.up, down=inputs.down, left=inputs.left, right=inputs.right,
+                  fire=inputs.fire, aim=inputs.aim)
 
 async def update_loop():
-    global running, game_over, title_screen, player, enemies, bullets, particles, items, walls, chests, upgrade_menu_active, selected_upgrade, paused, pause_selection, boss, boss_active
+    global world, running, title_screen, selected_upgrade, paused, pause_selection, quick_save
+    init_display()
+    frame_time = 1.0 / FPS
+    tick_time = 1.0 / TICK_RATE
+    accumulator = 0.0
+    last_time = time.perf_counter()
+    # Key presses are gathered here until the next simulation tick consumes them.
+    inputs = Inputs()
     while running:
+        frame_start = time.perf_counter()
+        elapsed = frame_start - last_time
+        last_time = frame_start
         for event in pygame.event.get():
             if event.type == pygame.QUIT:
                 running = False
@@ -663,9 +2729,38 @@ async def update_loop():
                 if event.key == pygame.K_ESCAPE:
                     paused = not paused
                     pause_selection = 0
-                elif title_screen and event.key == pygame.K_SPACE:
-                    title_screen = False
-                    setup()
+                elif event.key == pygame.K_F3:
+                    profiler.toggle()
+                elif event.key == pygame.K_F4:
+                    try:
+                        profiler.export(PROFILE_EXPORT_FILE)
+                        print(f"Profile: wrote {len(profiler.frames)} frames to {PROFILE_EXPORT_FILE}")
+                    except OSError as error:
+                        print(f"Profile: export failed: {error}")
+                elif event.key == pygame.K_F6 and recorder:
+                    try:
+                        recorder.save(REPLAY_FILE)
+                        print(f"Replay: wrote {recorder.ticks} ticks to {REPLAY_FILE}")
+                    except OSError as error:
+                        print(f"Replay: save failed: {error}")
+                elif event.key == pygame.K_F5 and world and not title_screen:
+                    quick_save = (world.snapshot(), recorder.ticks)
+                    print(f"Snapshot: saved tick {world.tick} ({len(quick_save[0])} bytes)")
+                elif event.key == pygame.K_F9 and quick_save:
+                    load_state(*quick_save)
+                    history.clear()
+                    print(f"Snapshot: loaded tick {world.tick}")
+                elif event.key == pygame.K_F7 and world and not title_screen:
+                    found = history.rewind(world.tick - REWIND_SECONDS * TICK_RATE)
+                    if found:
+                        load_state(*found)
+                        print(f"Snapshot: rewound to tick {world.tick}")
+                elif title_screen:
+                    if event.key == pygame.K_SPACE:
+                        if world is None:
+                            world = new_world()
+                        title_screen = False
+                        world.setup()
                 elif paused:
                     if event.key == pygame.K_UP:
                         pause_selection = (pause_selection - 1) % 2
@@ -676,242 +2771,124 @@ async def update_loop():
                             paused = False
                         else:
                             running = False
-                elif upgrade_menu_active:
+                elif world.upgrade_menu_active:
                     if event.key == pygame.K_UP:
-                        selected_upgrade = (selected_upgrade - 1) % len(upgrade_options)
+                        selected_upgrade = (selected_upgrade - 1) % len(world.upgrade_options)
                     elif event.key == pygame.K_DOWN:
-                        selected_upgrade = (selected_upgrade + 1) % len(upgrade_options)
+                        selected_upgrade = (selected_upgrade + 1) % len(world.upgrade_options)
                     elif event.key == pygame.K_RETURN:
-                        upgrade_options[selected_upgrade]["effect"]()
-                        upgrade_menu_active = False
+                        inputs.choose_upgrade = selected_upgrade
                         selected_upgrade = 0
                 elif event.key == pygame.K_e:
-                    player_rect = pygame.Rect(player.pos[0] - 10, player.pos[1] - 10, 20, 20)
-                    for item in items[:]:
-                        item_rect = pygame.Rect(item.pos[0] - 10, item.pos[1] - 10, 20, 20)
-                        if player_rect.colliderect(item_rect):
-                            if item.type in ["health", "temp_health", "armor", "ammo"]:
-                                player.apply_item(item)
-                            elif player.inventory.add_item(item):
-                                items.remove(item)
-                                pickup_sound.play()
+                    inputs.pickup = True
                 elif event.key == pygame.K_q:
-                    player_rect = pygame.Rect(player.pos[0] - 10, player.pos[1] - 10, 20, 20)
-                    for chest in chests[:]:
-                        chest_rect = pygame.Rect(chest.pos[0] - 10, chest.pos[1] - 10, 20, 20)
-                        if player_rect.colliderect(chest_rect):
-                            for item in chest.contents:
-                                if item.type in ["health", "temp_health", "armor", "ammo"]:
-                                    player.apply_item(item)
-                                elif player.inventory.add_item(item):
-                                    pickup_sound.play()
-                            chests.remove(chest)
-                            create_explosion(chest.pos)
+                    inputs.open_chest = True
                 elif event.key in (pygame.K_1, pygame.K_2, pygame.K_3):
-                    idx = event.key - pygame.K_1
-                    if idx < len(player.inventory.weapons):
-                        player.inventory.selected_weapon = idx
+                    inputs.select_weapon = event.key - pygame.K_1
             elif event.type == pygame.MOUSEWHEEL:
-                if not (title_screen or paused or upgrade_menu_active):
+                if not (title_screen or paused or world.upgrade_menu_active):
                     if event.y > 0:
-                        player.inventory.selected_weapon = (player.inventory.selected_weapon - 1) % len(player.inventory.weapons)
+                        inputs.cycle_weapon -= 1
                     elif event.y < 0:
-                        player.inventory.selected_weapon = (player.inventory.selected_weapon + 1) % len(player.inventory.weapons)
+                        inputs.cycle_weapon += 1
+        profiler.add('input', time.perf_counter() - frame_start)
 
+        # What the frame shows, for render_backend.present: the menus are
+        # static, so only a new scene or selection changes anything on them.
+        dirty = []
         if title_screen:
+            scene = ('title',)
             draw_title_screen(screen)
-            pygame.display.flip()
-            await asyncio.sleep(1.0 / FPS)
-            continue
-
-        if paused:
+            # Once the title is up, build the world and then the remaining
+            # assets within a small per-frame budget.
+            if 'first_frame' in startup_times:
+                if world is None:
+                    world = new_world()
+                elif 'ready' not in startup_times and assets.warm(ASSET_WARM_BUDGET):
+                    startup_times['ready'] = time.perf_counter() - IMPORT_START
+                    print(f"Startup: assets ready after {startup_times['ready'] * 1000:.0f} ms")
+        elif paused:
+            scene = ('paused', pause_selection)
             draw_pause_menu(screen)
-            pygame.display.flip()
-            await asyncio.sleep(1.0 / FPS)
-            continue
-
-        if upgrade_menu_active:
-            draw_upgrade_menu(screen)
-            pygame.display.flip()
-            await asyncio.sleep(1.0 / FPS)
-            continue
-
-        if game_over:
-            game_over_text = font.render('Game Over! Press R to Restart', True, WHITE)
-            screen.blit(game_over_text, (SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT // 2))
-            pygame.display.flip()
+        elif world.upgrade_menu_active and inputs.choose_upgrade < 0:
+            scene = ('upgrade', selected_upgrade, tuple(option['name'] for option in world.upgrade_options))
+            draw_upgrade_menu(screen, world.upgrade_options)
+        elif world.game_over:
+            # Drawn over the last frame of play.
+            scene = ('game_over',)
+            game_over_text = text_cache.render(assets['font'], 'Game Over! Press R to Restart', WHITE)
+            dirty.append(screen.blit(game_over_text, (SCREEN_WIDTH // 2 - 100, SCREEN_HEIGHT // 2)))
+            inputs.restart = pygame.key.get_pressed()[pygame.K_r]
+            if inputs.restart:
+                recorder.record(inputs)
+                world.step(inputs)
+                history.record(world, recorder.ticks)
+                inputs = next_inputs(inputs)
+                accumulator = 0.0
+        else:
             keys = pygame.key.get_pressed()
-            if keys[pygame.K_r]:
-                player = Player(MAP_WIDTH * TILE_SIZE // 2, MAP_HEIGHT * TILE_SIZE // 2)
-                enemies = []
-                bullets = []
-                particles = []
-                items = []
-                chests = []
-                boss = None
-                boss_active = False
-                game_map.generate_map()
-                walls = game_map.get_walls()
-                setup()
-                game_over = False
-            await asyncio.sleep(1.0 / FPS)
-            continue
-
-        # Update player
-        player.update()
-        keys = pygame.key.get_pressed()
-        player.move(keys, walls)
-        mouse_buttons = pygame.mouse.get_pressed()
-        if mouse_buttons[0] and player.fire_timer <= 0:
-            bullets.extend(player.shoot(pygame.mouse.get_pos()))
-            player.fire_timer = player.inventory.get_weapon().fire_rate
-            if bullets:
-                shot_sound.play()
-        if player.fire_timer > 0:
-            player.fire_timer -= 1
-
-        # Update camera
-        camera.update(player.pos)
-
-        # Update enemies
-        for enemy in enemies[:]:
-            if enemy.behavior == 'ranged':
-                dist = math.hypot(enemy.pos[0] - player.pos[0], enemy.pos[1] - player.pos[1])
-                if dist > 200:
-                    enemy.move_toward(player.pos, walls)
-                if enemy.fire_timer <= 0 and dist < 400:
-                    bullets.append(enemy.shoot(player.pos))
-                    enemy.fire_timer = enemy.fire_rate
-                else:
-                    enemy.fire_timer -= 1
-            else:
-                enemy.move_toward(player.pos, walls)
-
-        # Update boss
-        if boss:
-            dist = math.hypot(boss.pos[0] - player.pos[0], boss.pos[1] - player.pos[1])
-            boss.move_toward(player.pos, walls)
-            if boss.fire_timer <= 0 and dist < 500:
-                bullets.extend(boss.shoot(player.pos))
-                boss.fire_timer = boss.fire_rate
-            else:
-                boss.fire_timer -= 1
-
-        # Update bullets
-        for bullet in bullets[:]:
-            bullet.pos = (bullet.pos[0] + bullet.vel[0], bullet.pos[1] + bullet.vel[1])
-            bullet_rect = pygame.Rect(bullet.pos[0] - 5, bullet.pos[1] - 5, 10, 10)
-            if any(bullet_rect.colliderect(wall) for wall in walls):
-                bullets.remove(bullet)
-                create_explosion(bullet.pos)
-                continue
-            if bullet.owner == 'player':
-                for enemy in enemies[:]:
-                    enemy_rect = pygame.Rect(enemy.pos[0] - 15, enemy.pos[1] - 15, 30, 30)
-                    if bullet_rect.colliderect(enemy_rect):
-                        if enemy.take_damage(bullet.damage):
-                            enemies.remove(enemy)
-                            player.gain_exp(50 + player.level * 10 if enemy.type == 'drone' else 100 + player.level * 20)
-                            create_explosion(enemy.pos)
-                            if random.random() < 0.5:
-                                spawn_item(enemy.pos)
-                        bullets.remove(bullet)
-                        break
-                if boss:
-                    boss_rect = pygame.Rect(boss.pos[0] - 25, boss.pos[1] - 25, 50, 50)
-                    if bullet_rect.colliderect(boss_rect):
-                        if boss.take_damage(bullet.damage):
-                            boss_active = False
-                            player.gain_exp(500 + player.level * 100)
-                            create_explosion(boss.pos)
-                            spawn_chest()
-                            spawn_chest()
-                            boss = None
-                        bullets.remove(bullet)
-            elif bullet.owner in ['enemy', 'boss']:
-                player_rect = pygame.Rect(player.pos[0] - 10, player.pos[1] - 10, 20, 20)
-                if bullet_rect.colliderect(player_rect):
-                    player.take_damage(bullet.damage)
-                    bullets.remove(bullet)
-                    if player.health <= 0:
-                        game_over = True
-
-        # Update particles
-        for particle in particles[:]:
-            particle.pos = (particle.pos[0] + particle.vel[0], particle.pos[1] + particle.vel[1])
-            particle.lifetime -= 1
-            particle.size *= 0.95
-            if particle.lifetime <= 0:
-                particles.remove(particle)
-
-        # Spawn new enemies and chests
-        if random.random() < 0.005:
-            spawn_enemy()
-        if random.random() < CHEST_SPAWN_RATE:
-            spawn_chest()
-
-        # Draw everything
-        game_map.draw(screen, camera)
-        
-        # Draw items
-        for item in items:
-            screen_pos = (item.pos[0] - camera.offset[0], item.pos[1] - camera.offset[1])
-            sprite = health_sprite if item.type in ["health", "temp_health"] else item_sprite
-            screen.blit(sprite, (screen_pos[0] - 5, screen_pos[1] - 5))
-        
-        # Draw chests
-        for chest in chests:
-            screen_pos = (chest.pos[0] - camera.offset[0], chest.pos[1] - camera.offset[1])
-            screen.blit(chest_sprite, (screen_pos[0] - 10, screen_pos[1] - 10))
-        
-        # Draw player
-        screen_pos = (player.pos[0] - camera.offset[0], player.pos[1] - camera.offset[1])
-        screen.blit(player_sprite, (screen_pos[0] - 10, screen_pos[1] - 10))
-        
-        # Draw enemies
-        for enemy in enemies:
-            screen_pos = (enemy.pos[0] - camera.offset[0], enemy.pos[1] - camera.offset[1])
-            sprite = enemy_drone_sprite if enemy.type == 'drone' else enemy_tank_sprite
-            screen.blit(sprite, (screen_pos[0] - 15, screen_pos[1] - 15))
-            health_width = (enemy.health / enemy.max_health) * 20
-            pygame.draw.rect(screen, RED, (screen_pos[0] - 10, screen_pos[1] - 25, 20, 5))
-            pygame.draw.rect(screen, GREEN, (screen_pos[0] - 10, screen_pos[1] - 25, health_width, 5))
-        
-        # Draw boss
-        if boss:
-            screen_pos = (boss.pos[0] - camera.offset[0], boss.pos[1] - camera.offset[1])
-            screen.blit(boss_sprite, (screen_pos[0] - 25, screen_pos[1] - 25))
-            health_width = (boss.health / boss.max_health) * 40
-            pygame.draw.rect(screen, RED, (screen_pos[0] - 20, screen_pos[1] - 35, 40, 5))
-            pygame.draw.rect(screen, GREEN, (screen_pos[0] - 20, screen_pos[1] - 35, health_width, 5))
-        
-        # Draw bullets
-        for bullet in bullets:
-            screen_pos = (bullet.pos[0] - camera.offset[0], bullet.pos[1] - camera.offset[1])
-            pygame.draw.circle(screen, WHITE, screen_pos, 3)
-        
-        # Draw particles
-        for particle in particles:
-            screen_pos = (particle.pos[0] - camera.offset[0], particle.pos[1] - camera.offset[1])
-            pygame.draw.circle(screen, particle.color, screen_pos, int(particle.size))
-        
-        # Draw aim line
-        mouse_pos = pygame.mouse.get_pos()
-        dx = mouse_pos[0] - screen_pos[0]
-        dy = mouse_pos[1] - screen_pos[1]
-        angle = math.atan2(dy, dx)
-        end_pos = (screen_pos[0] + math.cos(angle) * 50, screen_pos[1] + math.sin(angle) * 50)
-        pygame.draw.line(screen, WHITE, screen_pos, end_pos, 1)
-        
-        # Draw HUD
-        draw_hud(screen)
-        
-        pygame.display.flip()
-        clock.tick(FPS)
-        await asyncio.sleep(1.0 / FPS)
+            inputs.up = keys[pygame.K_w]
+            inputs.down = keys[pygame.K_s]
+            inputs.left = keys[pygame.K_a]
+            inputs.right = keys[pygame.K_d]
+            inputs.fire = pygame.mouse.get_pressed()[0]
+            mouse_pos = pygame.mouse.get_pos()
+            # Whole pixels, as stored in the replay.
+            inputs.aim = (round(mouse_pos[0] + camera.offset[0]), round(mouse_pos[1] + camera.offset[1]))
+
+            # Run as many fixed ticks as the elapsed time calls for. Past
+            # MAX_CATCHUP_STEPS the backlog is dropped so a slow host loses
+            # render frames and game time instead of falling further behind.
+            accumulator += elapsed
+            steps = 0
+            while accumulator >= tick_time and steps < MAX_CATCHUP_STEPS:
+                with profiler.section('step'):
+                    recorder.record(inputs)
+                    world.step(inputs)
+                history.record(world, recorder.ticks)
+                with profiler.section('audio'):
+                    for name in world.events:
+                        assets['audio'].play(name)
+                inputs = next_inputs(inputs)
+                accumulator -= tick_time
+                steps += 1
+                if world.game_over or world.upgrade_menu_active:
+                    accumulator = 0.0
+                    break
+            profiler.set('ticks', steps)
+            profiler.set('enemies', len(world.enemies))
+            profiler.set('bullets', len(world.bullets))
+            profiler.set('particles', len(world.particles))
+            if profiler.enabled:
+                profiler.set('history_kb', history.nbytes() // 1024)
+            if steps == MAX_CATCHUP_STEPS:
+                accumulator = min(accumulator, tick_time)
+            alpha = accumulator / tick_time
+
+            # Update camera
+            camera.update(lerp_pos(world.player, alpha))
+
+            # Draw everything. The map looks the same as long as the camera
+            # and the tiles stay put.
+            scene = ('play', id(world), world.game_map.seed, world.collider.version, *camera.offset)
+            with profiler.section('draw'):
+                draw_world(screen, world, camera, mouse_pos, alpha, dirty)
+            with profiler.section('hud'):
+                draw_hud(screen, world, dirty)
+
+        if profiler.enabled:
+            dirty.append(profiler_overlay.draw(screen, profiler))
+        with profiler.section('flip'):
+            render_backend.present(scene + (profiler.enabled,), dirty)
+        profiler.add('frame', time.perf_counter() - frame_start)
+        profiler.end_frame()
+        if 'first_frame' not in startup_times:
+            startup_times['first_frame'] = time.perf_counter() - IMPORT_START
+            print(f"Startup: first frame after {startup_times['first_frame'] * 1000:.0f} ms")
+        await asyncio.sleep(max(0.0, frame_time - (time.perf_counter() - frame_start)))
 
 if platform.system() == "Emscripten":
     asyncio.ensure_future(update_loop())
 else:
     if __name__ == "__main__":
-        asyncio.run(update_loop())
\ No newline at end of file
+        asyncio.run(update_loop())
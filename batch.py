@@ -0,0 +1,236 @@
+# Batched headless runner for balancing and AI experiments. Plays many seeded
+# SimpleGame worlds across a process pool, each driven by a policy that only
+# sees arrays (the walls around the player, the nearest enemies and enemy
+# bullets), and gathers per-world outcomes into a NumPy structured array.
+#
+#   python batch.py                          64 worlds of up to 10 simulated minutes, kiting policy
+#   python batch.py -n 512 --policy scripted --out outcomes.npy
+#   python batch.py --set drone.speed=3 --set tank.health=200
+#   python batch.py --loot rare_weapons.json
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import dataclasses
+import math
+import multiprocessing
+import random
+import sys
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import SimpleGame as game
+
+DEFAULT_WORLDS = 64
+DEFAULT_MINUTES = 10.0
+DEFAULT_SEED = 1
+OBSERVATION_RADIUS = 7  # tiles on each side of the player in Observation.walls
+OBSERVED_ENEMIES = 8
+OBSERVED_BULLETS = 8
+KITE_RANGE = 250  # pixels; enemies and bullets closer than this push the kiting player away
+
+OUTCOME_DTYPE = np.dtype([
+    ('seed', np.int64), ('ticks', np.int32), ('died', bool), ('level', np.int32), ('exp', np.int32),
+    ('kills', np.int32), ('bosses', np.int32), ('damage_dealt', np.int64), ('damage_taken', np.int64),
+])
+
+@dataclass
+class Observation:
+    # What a policy sees. Offsets are in pixels from the player; rows past
+    # enemy_count / bullet_count are zero.
+    position: np.ndarray  # (2,) player position in world coordinates
+    health: float  # fraction of the current maximum
+    walls: np.ndarray  # (2r+1, 2r+1) bool around the player's tile; off the active window reads as wall
+    enemies: np.ndarray  # (OBSERVED_ENEMIES, 4): dx, dy, type code, health fraction; nearest first
+    enemy_count: int
+    bullets: np.ndarray  # (OBSERVED_BULLETS, 4): dx, dy, vx, vy of enemy bullets; nearest first
+    bullet_count: int
+    upgrades: int  # upgrade options on offer, 0 when the menu is closed
+
+@dataclass
+class RunConfig:
+    policy: str
+    max_ticks: int
+    width: int
+    height: int
+    enemies: int
+
+def nearest(offsets: np.ndarray, k: int) -> np.ndarray:
+    # Indices of the k shortest (N, 2) offsets, nearest first.
+    dist = (offsets ** 2).sum(axis=1)
+    index = np.argpartition(dist, k)[:k] if len(dist) > k else np.arange(len(dist))
+    return index[np.argsort(dist[index], kind='stable')]
+
+def observe(world: game.World) -> Observation:
+    player = world.player
+    origin = np.array(player.pos, dtype=np.float64)
+    collider = world.collider
+    r = OBSERVATION_RADIUS
+    tx = int(origin[0] // game.TILE_SIZE) - collider.x0
+    ty = int(origin[1] // game.TILE_SIZE) - collider.y0
+    walls = np.ones((2 * r + 1, 2 * r + 1), dtype=bool)
+    x0, y0 = max(tx - r, 0), max(ty - r, 0)
+    x1, y1 = min(tx + r + 1, collider.width), min(ty + r + 1, collider.height)
+    if x0 < x1 and y0 < y1:
+        walls[y0 - ty + r:y1 - ty + r, x0 - tx + r:x1 - tx + r] = collider.solid[y0:y1, x0:x1]
+
+    enemies = world.enemies
+    offsets = enemies.pos[:enemies.count] - origin
+    index = nearest(offsets, OBSERVED_ENEMIES)
+    enemy_rows = np.zeros((OBSERVED_ENEMIES, 4))
+    enemy_rows[:len(index), :2] = offsets[index]
+    enemy_rows[:len(index), 2] = enemies.type[index]
+    enemy_rows[:len(index), 3] = enemies.health[index] / enemies.max_health[index]
+
+    bullets = world.bullets
+    hostile = np.flatnonzero(bullets.alive[:bullets.count] & (bullets.owner[:bullets.count] != game.OWNER_PLAYER))
+    offsets = bullets.pos[hostile] - origin
+    index = nearest(offsets, OBSERVED_BULLETS)
+    bullet_rows = np.zeros((OBSERVED_BULLETS, 4))
+    bullet_rows[:len(index), :2] = offsets[index]
+    bullet_rows[:len(index), 2:] = bullets.vel[hostile[index]]
+
+    return Observation(origin, player.health / (player.max_health + player.temp_health_boost), walls,
+                       enemy_rows, min(enemies.count, OBSERVED_ENEMIES), bullet_rows, len(index),
+                       len(world.upgrade_options) if world.upgrade_menu_active else 0)
+
+def scripted_policy(obs: Observation, tick: int, rng: random.Random) -> game.Inputs:
+    # The benchmark's player: walk a square, fire at the nearest enemy and
+    # take the first upgrade.
+    side = (tick // 60) % 4
+    aim = obs.position + (obs.enemies[0, :2] if obs.enemy_count else (100, 0))
+    return game.Inputs(up=side == 0, right=side == 1, down=side == 2, left=side == 3,
+                       fire=True, aim=tuple(aim.tolist()), choose_upgrade=0)
+
+def kite_policy(obs: Observation, tick: int, rng: random.Random) -> game.Inputs:
+    # Fire at the nearest enemy and step into the open neighbouring tile that
+    # points furthest away from the enemies and bullets within KITE_RANGE;
+    # with nothing close, wander like the scripted player. Picks up
+    # everything and chooses upgrades at random.
+    push = np.zeros(2)
+    for rows, count in ((obs.enemies, obs.enemy_count), (obs.bullets, obs.bullet_count)):
+        offsets = rows[:count, :2]
+        dist = np.hypot(offsets[:, 0], offsets[:, 1])
+        close = (dist > 0) & (dist < KITE_RANGE)
+        push -= (offsets[close] / dist[close, None] ** 2).sum(axis=0)
+    r = OBSERVATION_RADIUS
+    if push.any():
+        move, best = (0, 0), 0.0
+        for dx, dy in ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+            score = (dx * push[0] + dy * push[1]) / math.hypot(dx, dy)
+            if score > best and not obs.walls[r + dy, r + dx]:
+                move, best = (dx, dy), score
+    else:
+        move = ((0, -1), (1, 0), (0, 1), (-1, 0))[(tick // 60) % 4]
+    aim = obs.position + (obs.enemies[0, :2] if obs.enemy_count else (100, 0))
+    return game.Inputs(up=move[1] < 0, down=move[1] > 0, left=move[0] < 0, right=move[0] > 0,
+                       fire=obs.enemy_count > 0, aim=tuple(aim.tolist()), pickup=True, open_chest=True,
+                       choose_upgrade=rng.randrange(obs.upgrades) if obs.upgrades else -1)
+
+POLICIES: Dict[str, Callable[[Observation, int, random.Random], game.Inputs]] = {
+    'scripted': scripted_policy,
+    'kite': kite_policy,
+}
+
+def apply_overrides(overrides: List[str]):
+    # 'drone.speed=3' assignments to numeric ENEMY_TYPES fields. Worlds
+    # created afterwards use the new values.
+    types = {enemy_type.name: enemy_type for enemy_type in game.ENEMY_TYPES}
+    for assignment in overrides:
+        target, _, value = assignment.partition('=')
+        name, _, field = target.partition('.')
+        current = getattr(types.get(name), field, None) if field else None
+        if not isinstance(current, (int, float)) or not value:
+            raise ValueError(f'cannot set {assignment!r}; expected type.field=number for a numeric EnemyType field')
+        types[name] = dataclasses.replace(types[name], **{field: type(current)(value)})
+    game.ENEMY_TYPES = tuple(types[enemy_type.name] for enemy_type in game.ENEMY_TYPES)
+
+# Set in each worker by init_worker.
+config: Optional[RunConfig] = None
+
+def init_worker(run_config: RunConfig, overrides: List[str], loot: Optional[str] = None):
+    global config
+    config = run_config
+    apply_overrides(overrides)
+    if loot:
+        game.LOOT_TABLES = game.load_loot_tables(loot)
+
+def run_world(seed: int) -> tuple:
+    # Plays one world until the player dies or max_ticks pass; one row of OUTCOME_DTYPE.
+    policy = POLICIES[config.policy]
+    rng = random.Random(seed)
+    world = game.World(config.width, config.height, config.enemies, seed)
+    world.setup()
+    for tick in range(config.max_ticks):
+        if world.game_over:
+            break
+        world.step(policy(observe(world), tick, rng))
+    player, stats = world.player, world.stats
+    return (seed, world.tick, world.game_over, player.level, player.exp,
+            stats.kills, stats.bosses, stats.damage_dealt, stats.damage_taken)
+
+def run_batch(run_config: RunConfig, seeds: range, workers: int, overrides: List[str],
+              loot: Optional[str] = None) -> np.ndarray:
+    if workers > 1:
+        chunksize = max(1, len(seeds) // (workers * 4))
+        with multiprocessing.Pool(workers, init_worker, (run_config, overrides, loot)) as pool:
+            rows = pool.map(run_world, seeds, chunksize)
+    else:
+        init_worker(run_config, overrides, loot)
+        rows = [run_world(seed) for seed in seeds]
+    return np.array(rows, dtype=OUTCOME_DTYPE)
+
+def print_summary(outcomes: np.ndarray):
+    columns = [('survived (min)', outcomes['ticks'] / game.TICK_RATE / 60), ('level', outcomes['level']),
+               ('kills', outcomes['kills']), ('damage dealt', outcomes['damage_dealt']),
+               ('damage taken', outcomes['damage_taken'])]
+    print(f"{'':<16}{'mean':>10}{'p10':>10}{'median':>10}{'p90':>10}")
+    for name, values in columns:
+        p10, median, p90 = np.percentile(values, (10, 50, 90))
+        print(f'{name:<16}{values.mean():>10.1f}{p10:>10.1f}{median:>10.1f}{p90:>10.1f}')
+    print(f"died in {int(outcomes['died'].sum())} of {len(outcomes)} worlds, {int(outcomes['bosses'].sum())} bosses killed")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Play many seeded SimpleGame worlds headlessly in parallel.')
+    parser.add_argument('-n', '--worlds', type=int, default=DEFAULT_WORLDS)
+    parser.add_argument('--minutes', type=float, default=DEFAULT_MINUTES, help='simulated minutes per world at most')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='seed of the first world; world i uses seed + i')
+    parser.add_argument('--policy', choices=sorted(POLICIES), default='kite')
+    parser.add_argument('--width', type=int, default=game.MAP_WIDTH)
+    parser.add_argument('--height', type=int, default=game.MAP_HEIGHT)
+    parser.add_argument('--enemies', type=int, default=game.MAX_ENEMIES)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--set', dest='overrides', action='append', default=[], metavar='TYPE.FIELD=VALUE',
+                        help='override a numeric ENEMY_TYPES stat, e.g. drone.speed=3')
+    parser.add_argument('--loot', metavar='PATH', help='draw drops from the loot tables in this JSON file, in the loot.json format')
+    parser.add_argument('--out', help='save the outcomes to this .npy file')
+    args = parser.parse_args()
+    try:
+        apply_overrides(args.overrides)
+        if args.loot:
+            game.load_loot_tables(args.loot)
+    except (OSError, ValueError, KeyError, TypeError) as error:
+        parser.error(str(error))
+
+    run_config = RunConfig(args.policy, int(args.minutes * 60 * game.TICK_RATE), args.width, args.height, args.enemies)
+    start = time.perf_counter()
+    outcomes = run_batch(run_config, range(args.seed, args.seed + args.worlds), args.workers, args.overrides,
+                         args.loot)
+    elapsed = time.perf_counter() - start
+
+    simulated = outcomes['ticks'].sum() / game.TICK_RATE / 60
+    print(f'{args.worlds} worlds, policy {args.policy}, {args.workers} workers: {simulated:.0f} simulated minutes '
+          f'in {elapsed:.1f} s ({simulated / elapsed * 60:.0f} per minute)')
+    print_summary(outcomes)
+    if args.out:
+        np.save(args.out, outcomes)
+        print(f'Saved outcomes to {args.out}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,175 @@
+# Headless benchmark for SimpleGame: seeded, scripted World scenarios run
+# without a display or audio device. Reports simulation ticks per second and
+# the time per tick spent in each profiled subsystem, and compares the tick
+# rate against a stored baseline.
+#
+#   python benchmark.py                    run every scenario
+#   python benchmark.py chase_64 boss      run only the named scenarios
+#   python benchmark.py --save-baseline    store these results as the baseline
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import json
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import pygame
+
+import SimpleGame as game
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+DEFAULT_TICKS = 600
+DEFAULT_SEED = 1
+REGRESSION_TOLERANCE = 0.15
+# Profiler sections reported per tick, in column order. 'step' is the whole
+# World.step; 'draw' is draw_world, which includes 'map'.
+SUBSYSTEMS = ('step', 'enemies', 'a_star', 'flow_field', 'bullets', 'particles', 'draw', 'map', 'hud')
+
+@dataclass
+class Scenario:
+    name: str
+    width: int = game.MAP_WIDTH
+    height: int = game.MAP_HEIGHT
+    enemies: int = game.MAX_ENEMIES
+    pathfinding: str = 'flow_field'
+    boss: bool = False
+    weapon: Optional[game.Weapon] = None
+
+SCENARIOS = [
+    Scenario('chase_8'),
+    Scenario('chase_64', enemies=64),
+    Scenario('chase_512', enemies=512),
+    Scenario('chase_4096', enemies=4096),
+    Scenario('chase_64_a_star', enemies=64, pathfinding='a_star'),
+    Scenario('boss', boss=True),
+    Scenario('flamethrower', enemies=64, weapon=game.Weapon('Flamethrower', 5, 3, 10, 0.4, 3, 150, 200)),
+    Scenario('map_100', width=100, height=100),
+    Scenario('map_200', width=200, height=200),
+    Scenario('map_4000', width=4000, height=4000),
+]
+
+def scripted_inputs(world: game.World, tick: int) -> game.Inputs:
+    # Walk a square, always fire at the nearest enemy and take the first upgrade.
+    player = world.player
+    enemies = world.enemies
+    if len(enemies):
+        offset = enemies.pos[:enemies.count] - player.pos
+        target = enemies.pos[int(np.argmin((offset ** 2).sum(axis=1)))]
+        aim = (float(target[0]), float(target[1]))
+    else:
+        aim = (player.pos[0] + 100, player.pos[1])
+    side = (tick // 60) % 4
+    return game.Inputs(up=side == 0, right=side == 1, down=side == 2, left=side == 3,
+                       fire=True, aim=aim, choose_upgrade=0)
+
+def run_scenario(scenario: Scenario, ticks: int, seed: int) -> dict:
+    profiler = game.profiler
+    pathfinding_mode = game.PATHFINDING_MODE
+    game.PATHFINDING_MODE = scenario.pathfinding
+    if not profiler.enabled:
+        profiler.toggle()
+    try:
+        world = game.World(scenario.width, scenario.height, scenario.enemies, seed)
+        world.setup()
+        player = world.player
+        # The scenarios measure load, not survival.
+        player.max_health = player.health = 10 ** 9
+        weapon = scenario.weapon
+        if weapon:
+            player.inventory.add_item(game.Item(game.ItemType(weapon.name, 'weapon', 0, weapon), (0, 0)))
+            player.inventory.selected_weapon = len(player.inventory.weapons) - 1
+        if scenario.boss:
+            world.boss_active = True
+            world.spawn_boss()
+        surface = pygame.Surface((game.SCREEN_WIDTH, game.SCREEN_HEIGHT))
+        camera = game.Camera()
+        mouse_pos = (game.SCREEN_WIDTH // 2, game.SCREEN_HEIGHT // 2)
+        totals = {}
+        for tick in range(ticks):
+            inputs = scripted_inputs(world, tick)
+            if weapon:
+                player.inventory.ammo[weapon.name] = weapon.max_ammo
+            with profiler.section('step'):
+                world.step(inputs)
+            camera.update(player.pos)
+            with profiler.section('draw'):
+                game.draw_world(surface, world, camera, mouse_pos)
+            with profiler.section('hud'):
+                game.draw_hud(surface, world)
+            profiler.end_frame()
+            for name, seconds in profiler.frames[-1][0].items():
+                totals[name] = totals.get(name, 0.0) + seconds
+    finally:
+        game.PATHFINDING_MODE = pathfinding_mode
+        profiler.toggle()
+    return {
+        'ticks_per_sec': ticks / totals['step'],
+        'ms_per_tick': {name: totals.get(name, 0.0) * 1000 / ticks for name in SUBSYSTEMS},
+        'enemies': len(world.enemies),
+        'bullets': len(world.bullets),
+    }
+
+def load_baseline(path: str) -> Dict[str, dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)['scenarios']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+def print_report(results: Dict[str, dict], baseline: Dict[str, dict]):
+    print(f"{'scenario':<16}{'ticks/s':>9}{'vs base':>9}" + ''.join(f'{name:>11}' for name in SUBSYSTEMS))
+    for name, result in results.items():
+        base = baseline.get(name)
+        change = f"{result['ticks_per_sec'] / base['ticks_per_sec'] - 1:+.0%}" if base else '-'
+        times = ''.join(f"{result['ms_per_tick'][subsystem]:>11.3f}" for subsystem in SUBSYSTEMS)
+        print(f"{name:<16}{result['ticks_per_sec']:>9.0f}{change:>9}{times}")
+    print('(subsystem columns are milliseconds per tick)')
+
+def find_regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result['ticks_per_sec'] < base['ticks_per_sec'] * (1 - tolerance):
+            regressions.append(f"{name}: {result['ticks_per_sec']:.0f} ticks/s, baseline {base['ticks_per_sec']:.0f}")
+    return regressions
+
+def main() -> int:
+    names = [scenario.name for scenario in SCENARIOS]
+    parser = argparse.ArgumentParser(description='Headless SimpleGame benchmark.')
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help='scenarios to run (default: all of ' + ', '.join(names) + ')')
+    parser.add_argument('--ticks', type=int, default=DEFAULT_TICKS)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE,
+                        help='allowed ticks/s drop against the baseline (default: %(default)s)')
+    args = parser.parse_args()
+    unknown = sorted(set(args.scenarios) - set(names))
+    if unknown:
+        parser.error('unknown scenario: ' + ', '.join(unknown))
+
+    pygame.font.init()
+    selected = [scenario for scenario in SCENARIOS if not args.scenarios or scenario.name in args.scenarios]
+    results = {}
+    for scenario in selected:
+        results[scenario.name] = run_scenario(scenario, args.ticks, args.seed)
+    baseline = load_baseline(args.baseline)
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'ticks': args.ticks, 'seed': args.seed, 'scenarios': {**baseline, **results}}, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+        return 0
+    regressions = find_regressions(results, baseline, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+# Re-simulates a replay recorded by SimpleGame (F6 in game writes
+# last_replay.sgr) without a display, as fast as possible. Prints the tick
+# rate, the slowest ticks and a digest of the final world state; the same
+# replay run under two builds gives the same digest unless game behaviour
+# changed.
+#
+#   python replay.py                       replay last_replay.sgr
+#   python replay.py session.sgr --profile show a profiler breakdown of the slowest ticks
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import argparse
+import hashlib
+import heapq
+import sys
+import time
+
+import SimpleGame as game
+
+def world_digest(world: game.World) -> str:
+    player, enemies = world.player, world.enemies
+    n = enemies.count
+    state = [world.tick, world.game_over, player.pos, player.health, player.level, player.exp,
+             enemies.type[:n].tobytes(), enemies.pos[:n].tobytes(), enemies.health[:n].tobytes(),
+             world.bullets.pos[:world.bullets.count].tobytes(), len(world.items), len(world.chests)]
+    return hashlib.sha1(repr(state).encode()).hexdigest()[:16]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Replay a recorded SimpleGame session headlessly.')
+    parser.add_argument('path', nargs='?', default=game.REPLAY_FILE)
+    parser.add_argument('--profile', action='store_true', help='break the slowest ticks down by profiler section')
+    parser.add_argument('--slowest', type=int, default=5, help='how many of the slowest ticks to list')
+    args = parser.parse_args()
+
+    try:
+        replay = game.load_replay(args.path)
+    except (OSError, ValueError) as error:
+        print(f'Cannot load replay: {error}')
+        return 1
+    pathfinding_mode = game.PATHFINDING_MODE
+    game.PATHFINDING_MODE = replay.pathfinding
+    profiler = game.profiler
+    if args.profile:
+        profiler.toggle()
+    try:
+        world = game.replay_world(replay)
+        # Min-heap of (seconds, tick, sections) holding the slowest ticks.
+        slowest = []
+        start = time.perf_counter()
+        for tick, inputs in enumerate(replay.inputs):
+            tick_start = time.perf_counter()
+            world.step(inputs)
+            seconds = time.perf_counter() - tick_start
+            sections = profiler.times
+            profiler.end_frame()
+            if len(slowest) < args.slowest:
+                heapq.heappush(slowest, (seconds, tick, sections))
+            elif seconds > slowest[0][0]:
+                heapq.heapreplace(slowest, (seconds, tick, sections))
+        total = time.perf_counter() - start
+    finally:
+        game.PATHFINDING_MODE = pathfinding_mode
+        if args.profile:
+            profiler.toggle()
+
+    ticks = len(replay.inputs)
+    print(f'{args.path}: {ticks} ticks, seed {replay.seed}, {replay.width}x{replay.height}, {replay.pathfinding}')
+    print(f'{ticks / total if total else 0:.0f} ticks/s ({total:.2f} s)')
+    for seconds, tick, sections in sorted(slowest, reverse=True):
+        breakdown = ', '.join(f'{name} {value * 1000:.2f}' for name, value in sorted(sections.items(), key=lambda item: -item[1]))
+        print(f'  tick {tick}: {seconds * 1000:.2f} ms' + (f' ({breakdown})' if breakdown else ''))
+    print(f'final state digest {world_digest(world)}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,437 @@
+# Multiplayer server for SimpleGame. One World runs at TICK_RATE behind an
+# asyncio TCP server and every connection plays one of its players. Clients
+# send their inputs as 12-byte REPLAY_TICK records whenever they like; the
+# held controls carry over and one-shot actions wait for the next tick. Every
+# SEND_INTERVAL ticks each client gets a frame with only what changed inside
+# its interest area, the view around its player plus INTEREST_MARGIN:
+# players and enemies entering (full row), moving (int8 offsets) or leaving,
+# bullets once when they enter (the client extrapolates them from their
+# velocity) and when they go, and items and chests appearing or disappearing.
+#
+#   python server.py                             serve on DEFAULT_PORT
+#   python server.py --bots 8 --seconds 30       serve 8 loopback bots, then report tick times and bandwidth
+#   python server.py --connect host:7777 --bots 2  play 2 bots against a running server
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+import argparse
+import asyncio
+import dataclasses
+import math
+import random
+import struct
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pygame
+
+import SimpleGame as game
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7777
+DEFAULT_SEED = 1
+SEND_INTERVAL = 3  # ticks between frames, 20 per second at TICK_RATE 60
+INTEREST_MARGIN = 200  # pixels past each side of the view that a client is kept up to date on
+POSITION_SCALE = 4  # positions are sent in quarter pixels
+VELOCITY_SCALE = 64  # bullet velocities in 1/64 pixel per tick
+RESTART_DELAY = 3  # seconds from game over until the server restarts the world
+SEND_BUFFER_LIMIT = 256 * 1024  # bytes queued for a client before its frames are skipped
+
+NET_MAGIC = b'SGNW'
+NET_VERSION = 1
+# length of the message that follows; every server message is framed this way
+MESSAGE = struct.Struct('<I')
+# magic, version, player id, world seed, map width, height, tick rate, send interval
+WELCOME = struct.Struct('<4sBIIHHBB')
+# tick, map seed, FRAME_FLAGS bits, then the client's player: health, max_health, level, exp, exp_to_next
+FRAME_HEADER = struct.Struct('<IIBiiiii')
+FRAME_FLAGS = ('alive', 'game_over', 'choosing', 'boss_active')
+# Actors are players (kind ACTOR_PLAYER, key id << 1) and enemies (kind 1 +
+# ENEMY_TYPES code, key id << 1 | 1). health is a fraction of 255.
+ACTOR_PLAYER = 0
+ACTOR_ROW = np.dtype([('key', np.uint32), ('kind', np.uint8), ('health', np.uint8), ('x', np.int32), ('y', np.int32)])
+ACTOR_MOVE = np.dtype([('key', np.uint32), ('dx', np.int8), ('dy', np.int8), ('health', np.uint8)])
+BULLET_ROW = np.dtype([('id', np.uint32), ('owner', np.uint8), ('x', np.int32), ('y', np.int32),
+                       ('vx', np.int16), ('vy', np.int16)])
+STATIC_ROW = np.dtype([('kind', np.uint8), ('x', np.int32), ('y', np.int32)])
+STATIC_KINDS = ('chest', 'health', 'item')
+# Each frame is FRAME_HEADER followed by these pack_rows sections: actors
+# entered, moved and left, bullets entered and left, statics entered and left,
+# and the '\n'-joined upgrade names while the client's player is choosing.
+FRAME_SECTIONS = (ACTOR_ROW, ACTOR_MOVE, np.uint32, BULLET_ROW, np.uint32, STATIC_ROW, STATIC_ROW, np.uint8)
+
+def quantize(pos: np.ndarray) -> np.ndarray:
+    return np.rint(pos * POSITION_SCALE).astype(np.int32)
+
+def health_fraction(health: np.ndarray, max_health: np.ndarray) -> np.ndarray:
+    return np.minimum(np.maximum(health * 255 // np.maximum(max_health, 1), 0), 255).astype(np.uint8)
+
+class ClientView:
+    # What one client has been sent so far; the next frame is the difference
+    # between this and what is inside its interest area now.
+    def __init__(self):
+        self.actors = np.zeros(0, dtype=ACTOR_ROW)  # sorted by key
+        self.bullets = np.zeros(0, dtype=np.uint32)  # sorted
+        self.statics = Counter()  # (kind, x, y) -> how many
+
+def interest_area(player: game.Player) -> Tuple[np.ndarray, np.ndarray]:
+    # Center and half extents of the area a client is kept up to date on.
+    center = np.array(player.pos, dtype=np.float64)
+    return center, np.array((game.SCREEN_WIDTH / 2 + INTEREST_MARGIN, game.SCREEN_HEIGHT / 2 + INTEREST_MARGIN))
+
+def visible_actors(world: game.World, center: np.ndarray, half: np.ndarray) -> np.ndarray:
+    enemies = world.enemies
+    n = enemies.count
+    shown = np.flatnonzero((np.abs(enemies.pos[:n] - center) <= half).all(axis=1))
+    players = [player for player in world.players
+               if player.health > 0 and abs(player.pos[0] - center[0]) <= half[0]
+               and abs(player.pos[1] - center[1]) <= half[1]]
+    rows = np.zeros(len(shown) + len(players), dtype=ACTOR_ROW)
+    k = len(shown)
+    rows['key'][:k] = enemies.id[shown] << np.uint32(1) | np.uint32(1)
+    rows['kind'][:k] = enemies.type[shown] + 1
+    rows['health'][:k] = health_fraction(enemies.health[shown], enemies.max_health[shown])
+    for i, player in enumerate(players, k):
+        rows[i] = (player.id << 1, ACTOR_PLAYER, 0, 0, 0)
+        rows['health'][i] = health_fraction(player.health, player.max_health + player.temp_health_boost)
+    positions = np.concatenate((enemies.pos[shown], np.array([player.pos for player in players]).reshape(-1, 2)))
+    q = quantize(positions)
+    rows['x'], rows['y'] = q[:, 0], q[:, 1]
+    return rows[np.argsort(rows['key'], kind='stable')]
+
+def diff_actors(view: ClientView, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Actors new to the client, or moved too far for an int8 offset, are sent
+    # whole; the rest only when they moved or their health changed.
+    known = view.actors
+    index = np.minimum(np.searchsorted(known['key'], rows['key']), max(len(known) - 1, 0))
+    old = known[index] if len(known) else np.zeros(len(rows), dtype=ACTOR_ROW)
+    found = (len(known) > 0) & (old['key'] == rows['key']) & (old['kind'] == rows['kind'])
+    dx = rows['x'] - old['x']
+    dy = rows['y'] - old['y']
+    small = found & (np.abs(dx) <= 127) & (np.abs(dy) <= 127)
+    changed = np.flatnonzero(small & ((dx != 0) | (dy != 0) | (rows['health'] != old['health'])))
+    moved = np.zeros(len(changed), dtype=ACTOR_MOVE)
+    moved['key'], moved['dx'], moved['dy'] = rows['key'][changed], dx[changed], dy[changed]
+    moved['health'] = rows['health'][changed]
+    left = known['key'][~np.isin(known['key'], rows['key'], assume_unique=True)]
+    view.actors = rows
+    return rows[~small], moved, left
+
+def diff_bullets(world: game.World, view: ClientView, center: np.ndarray, half: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    bullets = world.bullets
+    n = bullets.count
+    shown = np.flatnonzero(bullets.alive[:n] & (np.abs(bullets.pos[:n] - center) <= half).all(axis=1))
+    shown = shown[np.argsort(bullets.id[shown], kind='stable')]
+    ids = bullets.id[shown]
+    new = shown[~np.isin(ids, view.bullets, assume_unique=True)]
+    entered = np.zeros(len(new), dtype=BULLET_ROW)
+    entered['id'], entered['owner'] = bullets.id[new], bullets.owner[new]
+    q = quantize(bullets.pos[new])
+    entered['x'], entered['y'] = q[:, 0], q[:, 1]
+    v = np.minimum(np.maximum(np.rint(bullets.vel[new] * VELOCITY_SCALE), -32768), 32767).astype(np.int16)
+    entered['vx'], entered['vy'] = v[:, 0], v[:, 1]
+    left = view.bullets[~np.isin(view.bullets, ids, assume_unique=True)]
+    view.bullets = ids
+    return entered, left
+
+def diff_statics(world: game.World, view: ClientView, center: np.ndarray, half: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    rect = pygame.Rect(int(center[0] - half[0]), int(center[1] - half[1]), int(half[0] * 2), int(half[1] * 2))
+    current = Counter()
+    for obj in world.pickup_grid.query_rect(rect):
+        if isinstance(obj, game.Chest):
+            kind = 0
+        else:
+            kind = 1 if obj.type in ('health', 'temp_health') else 2
+        current[(kind, round(obj.pos[0] * POSITION_SCALE), round(obj.pos[1] * POSITION_SCALE))] += 1
+    entered = np.array(list((current - view.statics).elements()), dtype=np.int64).reshape(-1, 3)
+    left = np.array(list((view.statics - current).elements()), dtype=np.int64).reshape(-1, 3)
+    view.statics = current
+    rows = []
+    for values in (entered, left):
+        table = np.zeros(len(values), dtype=STATIC_ROW)
+        table['kind'], table['x'], table['y'] = values[:, 0], values[:, 1], values[:, 2]
+        rows.append(table)
+    return rows[0], rows[1]
+
+def encode_frame(world: game.World, player: game.Player, view: ClientView, tick: int) -> bytes:
+    center, half = interest_area(player)
+    entered, moved, left = diff_actors(view, visible_actors(world, center, half))
+    bullets_entered, bullets_left = diff_bullets(world, view, center, half)
+    statics_entered, statics_left = diff_statics(world, view, center, half)
+    choosing = world.upgrade_menu_active and world.players[world.upgrade_player] is player
+    names = '\n'.join(option['name'] for option in world.upgrade_options) if choosing else ''
+    text = np.frombuffer(names.encode(), dtype=np.uint8)
+    flags = 0
+    for bit, value in enumerate((player.health > 0, world.game_over, choosing, world.boss_active)):
+        if value:
+            flags |= 1 << bit
+    header = FRAME_HEADER.pack(tick, world.game_map.seed & 0xFFFFFFFF, flags, player.health,
+                               player.max_health + player.temp_health_boost, player.level, player.exp,
+                               player.exp_to_next)
+    payload = header + b''.join(game.pack_rows([rows], len(rows)) for rows in (
+        entered, moved, left, bullets_entered, bullets_left, statics_entered, statics_left, text))
+    return MESSAGE.pack(len(payload)) + payload
+
+def decode_frame(payload: bytes) -> Tuple[tuple, List[np.ndarray]]:
+    # The FRAME_HEADER fields and the FRAME_SECTIONS tables of a frame.
+    header = FRAME_HEADER.unpack_from(payload)
+    offset = FRAME_HEADER.size
+    sections = []
+    for dtype in FRAME_SECTIONS:
+        (rows,), offset = game.unpack_rows(payload, [np.zeros(0, dtype=dtype)], offset)
+        sections.append(rows)
+    return header, sections
+
+class Client:
+    # One connection to the server and the player it controls.
+    def __init__(self, player: game.Player, writer: asyncio.StreamWriter):
+        self.player = player
+        self.writer = writer
+        self.inputs = game.Inputs()
+        self.view = ClientView()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def receive(self, inputs: game.Inputs):
+        # Held controls are replaced; one-shot actions not yet used by a tick
+        # are kept. Only the server restarts the world.
+        pending = self.inputs
+        self.inputs = dataclasses.replace(
+            inputs, pickup=inputs.pickup or pending.pickup, open_chest=inputs.open_chest or pending.open_chest,
+            select_weapon=inputs.select_weapon if inputs.select_weapon >= 0 else pending.select_weapon,
+            cycle_weapon=pending.cycle_weapon + inputs.cycle_weapon,
+            choose_upgrade=inputs.choose_upgrade if inputs.choose_upgrade >= 0 else pending.choose_upgrade,
+            restart=False)
+
+class GameServer:
+    # Steps the world at TICK_RATE while anyone is connected and sends each
+    # client its frames. The first client takes over the world's only player;
+    # later ones get a new player each, which leaves with them.
+    def __init__(self, world: game.World):
+        self.world = world
+        self.clients: Dict[int, Client] = {}  # by player id
+        self.ticks = 0
+        self.restart_timer = 0
+        self.tick_times: List[float] = []  # seconds per tick, stepping and sending
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        world = self.world
+        client = Client(self.join(), writer)
+        self.clients[client.player.id] = client
+        welcome = WELCOME.pack(NET_MAGIC, NET_VERSION, client.player.id, world.seed & 0xFFFFFFFF,
+                               world.game_map.width, world.game_map.height, game.TICK_RATE, SEND_INTERVAL)
+        writer.write(MESSAGE.pack(len(welcome)) + welcome)
+        try:
+            while True:
+                record = await reader.readexactly(game.REPLAY_TICK.size)
+                client.bytes_received += len(record)
+                client.receive(game.unpack_inputs(*game.REPLAY_TICK.unpack(record)))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.leave(client)
+            writer.close()
+
+    def join(self) -> game.Player:
+        world = self.world
+        if self.clients:
+            return world.add_player()
+        if world.game_over:
+            world.restart()
+        return world.player
+
+    def leave(self, client: Client):
+        del self.clients[client.player.id]
+        self.world.remove_player(client.player)
+
+    def tick(self):
+        world = self.world
+        if world.game_over:
+            self.restart_timer += 1
+            if self.restart_timer >= RESTART_DELAY * game.TICK_RATE:
+                self.restart_timer = 0
+                world.restart()
+        clients = [self.clients.get(player.id) for player in world.players]
+        world.step(*[client.inputs if client else game.Inputs() for client in clients])
+        for client in self.clients.values():
+            client.inputs = game.next_inputs(client.inputs)
+        self.ticks += 1
+        if self.ticks % SEND_INTERVAL == 0:
+            for client in self.clients.values():
+                # A client that cannot keep up misses frames; the next one it
+                # gets is still relative to what it was last sent.
+                if client.writer.transport.get_write_buffer_size() > SEND_BUFFER_LIMIT:
+                    continue
+                frame = encode_frame(world, client.player, client.view, world.tick)
+                client.writer.write(frame)
+                client.bytes_sent += len(frame)
+
+    async def run(self, stop: asyncio.Event):
+        # Fixed-rate loop like the frontend's: at most MAX_CATCHUP_STEPS ticks
+        # at once, then sleep until the next one is due. Paused while nobody
+        # is connected.
+        loop = asyncio.get_running_loop()
+        tick_time = 1.0 / game.TICK_RATE
+        next_tick = loop.time()
+        while not stop.is_set():
+            if not self.clients:
+                await asyncio.sleep(tick_time)
+                next_tick = loop.time()
+                continue
+            steps = 0
+            while loop.time() >= next_tick and steps < game.MAX_CATCHUP_STEPS:
+                start = time.perf_counter()
+                self.tick()
+                self.tick_times.append(time.perf_counter() - start)
+                next_tick += tick_time
+                steps += 1
+            next_tick = max(next_tick, loop.time() - tick_time)
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+class Bot:
+    # A scripted client. Keeps the replicated state decoded from its frames
+    # (actors, bullets extrapolated from where they entered, items and
+    # chests) and plays on it: wander, fire at the nearest enemy, pick
+    # everything up and take the first upgrade.
+    def __init__(self, seed: int):
+        self.rng = random.Random(seed)
+        self.player_id = 0
+        self.tick = 0
+        self.header = None
+        self.actors: Dict[int, list] = {}  # key -> [kind, health, x, y]
+        self.bullets: Dict[int, tuple] = {}  # id -> (tick, owner, x, y, vx, vy)
+        self.statics = Counter()  # (kind, x, y) -> how many
+        self.upgrades: List[str] = []
+        self.move = (0, 0)
+
+    def apply(self, payload: bytes):
+        self.header, sections = decode_frame(payload)
+        self.tick = self.header[0]
+        entered, moved, left, bullets_entered, bullets_left, statics_entered, statics_left, text = sections
+        for key, kind, health, x, y in entered.tolist():
+            self.actors[key] = [kind, health, x, y]
+        for key, dx, dy, health in moved.tolist():
+            actor = self.actors[key]
+            actor[1] = health
+            actor[2] += dx
+            actor[3] += dy
+        for key in left.tolist():
+            del self.actors[key]
+        for bullet_id, *row in bullets_entered.tolist():
+            self.bullets[bullet_id] = (self.tick, *row)
+        for bullet_id in bullets_left.tolist():
+            del self.bullets[bullet_id]
+        self.statics.update(map(tuple, statics_entered.tolist()))
+        self.statics.subtract(map(tuple, statics_left.tolist()))
+        self.statics = +self.statics
+        self.upgrades = bytes(text).decode().split('\n') if len(text) else []
+
+    def bullet_positions(self) -> List[Tuple[float, float]]:
+        # Where the bullets should be now, in pixels.
+        positions = []
+        for tick, owner, x, y, vx, vy in self.bullets.values():
+            age = self.tick - tick
+            positions.append((x / POSITION_SCALE + vx * age / VELOCITY_SCALE,
+                              y / POSITION_SCALE + vy * age / VELOCITY_SCALE))
+        return positions
+
+    def inputs(self) -> game.Inputs:
+        me = self.actors.get(self.player_id << 1)
+        if me is None:
+            return game.Inputs()
+        x, y = me[2] / POSITION_SCALE, me[3] / POSITION_SCALE
+        if self.tick % 60 < SEND_INTERVAL:
+            self.move = (self.rng.randint(-1, 1), self.rng.randint(-1, 1))
+        enemies = [(actor[2] / POSITION_SCALE - x, actor[3] / POSITION_SCALE - y)
+                   for actor in self.actors.values() if actor[0] != ACTOR_PLAYER]
+        target = min(enemies, key=lambda offset: math.hypot(*offset)) if enemies else (100, 0)
+        return game.Inputs(up=self.move[1] < 0, down=self.move[1] > 0, left=self.move[0] < 0, right=self.move[0] > 0,
+                           fire=bool(enemies), aim=(int(x + target[0]), int(y + target[1])), pickup=True,
+                           open_chest=True, choose_upgrade=0 if self.upgrades else -1)
+
+async def read_message(reader: asyncio.StreamReader) -> bytes:
+    size, = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+    return await reader.readexactly(size)
+
+async def run_bot(host: str, port: int, bot: Bot, stop: asyncio.Event):
+    # Plays until stop is set, answering every frame with the bot's inputs.
+    reader, writer = await asyncio.open_connection(host, port)
+    magic, version, bot.player_id, *_ = WELCOME.unpack(await read_message(reader))
+    if magic != NET_MAGIC or version != NET_VERSION:
+        raise ValueError(f'{host}:{port} is not a version {NET_VERSION} SimpleGame server')
+    try:
+        while not stop.is_set():
+            bot.apply(await read_message(reader))
+            writer.write(game.pack_inputs(bot.inputs()))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def wait_and_stop(seconds: Optional[float], stop: asyncio.Event):
+    if seconds is not None:
+        await asyncio.sleep(seconds)
+        stop.set()
+
+async def serve(args: argparse.Namespace) -> int:
+    world = game.World(args.width, args.height, args.enemies, args.seed)
+    world.setup()
+    server = GameServer(world)
+    stop = asyncio.Event()
+    listener = await asyncio.start_server(server.handle, args.host, args.port)
+    port = listener.sockets[0].getsockname()[1]
+    print(f'Serving on {args.host}:{port}')
+    bots = [asyncio.create_task(run_bot(args.host, port, Bot(args.seed + i), stop)) for i in range(args.bots)]
+    async with listener:
+        await asyncio.gather(server.run(stop), wait_and_stop(args.seconds, stop))
+        clients = list(server.clients.values())
+        for client in clients:
+            client.writer.close()
+    await asyncio.gather(*bots)
+    if server.tick_times and clients:
+        p50, p99 = np.percentile(np.array(server.tick_times) * 1000, (50, 99))
+        seconds = server.ticks / game.TICK_RATE
+        sent = sum(client.bytes_sent for client in clients) / len(clients) / seconds
+        received = sum(client.bytes_received for client in clients) / len(clients) / seconds
+        print(f'{server.ticks} ticks, {len(clients)} players, {len(world.enemies)} enemies: '
+              f'{p50:.2f} ms p50, {p99:.2f} ms p99 per tick')
+        print(f'{sent:.0f} B/s down and {received:.0f} B/s up per player')
+    return 0
+
+async def connect(args: argparse.Namespace) -> int:
+    host, _, port = args.connect.rpartition(':')
+    stop = asyncio.Event()
+    bots = [Bot(args.seed + i) for i in range(max(args.bots, 1))]
+    await asyncio.gather(wait_and_stop(args.seconds, stop), *(run_bot(host, int(port), bot, stop) for bot in bots))
+    for bot in bots:
+        print(f'player {bot.player_id}: tick {bot.tick}, {len(bot.actors)} actors, {len(bot.bullets)} bullets, '
+              f'{sum(bot.statics.values())} items and chests in view')
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Serve a SimpleGame world to several players over TCP.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--width', type=int, default=game.MAP_WIDTH)
+    parser.add_argument('--height', type=int, default=game.MAP_HEIGHT)
+    parser.add_argument('--enemies', type=int, default=game.MAX_ENEMIES)
+    parser.add_argument('--bots', type=int, default=0, help='scripted clients to run in this process')
+    parser.add_argument('--seconds', type=float, help='stop after this long (default: run until interrupted)')
+    parser.add_argument('--connect', metavar='HOST:PORT', help='only run the bots, against this server')
+    args = parser.parse_args()
+    try:
+        return asyncio.run(connect(args) if args.connect else serve(args))
+    except KeyboardInterrupt:
+        return 0
+    except (OSError, ValueError) as error:
+        print(f'Server error: {error}')
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())